@@ -0,0 +1,66 @@
+from globals import *
+
+"""
+Models of the Panda client.
+
+Every model is loaded from disk once, and kept out of the scene as a template. Each
+object showing it gets its own node with an instance of the template under it, so
+they share geometry but move independently. When an object is deleted, its node is
+detached and kept in a pool (up to CLIENT_MODEL_POOL_SIZE per model), to be reused by
+the next object showing that model, e.g. when avatars leave and reenter interest.
+
+`preload()` loads models in the background, so that they are ready by the time they
+are needed, instead of loading while an avatar or zone is entered.
+"""
+
+
+class ModelCache:
+    def __init__(self, pool_size=CLIENT_MODEL_POOL_SIZE):
+        self.pool_size = pool_size
+        self.loader = None
+        self.templates = {}  # path -> NodePath, never in the scene
+        self.pools = {}  # path -> [detached NodePath]
+
+    def preload(self, loader, paths=CLIENT_PRELOAD_MODELS, callback=None):
+        self.loader = loader
+        pending = [path for path in paths if path not in self.templates]
+        if not pending:
+            if callback:
+                callback()
+            return
+
+        def loaded(models):
+            # Panda hands the models of a list of paths over as one list
+            for path, model in zip(pending, models):
+                # A model needed before it was preloaded has been loaded already by then.
+                self.templates.setdefault(path, model)
+            if callback:
+                callback()
+        loader.load_model(pending, callback=loaded)
+
+    def template(self, path):
+        template = self.templates.get(path)
+        if template is None:
+            loader = self.loader or base.loader
+            template = self.templates[path] = loader.load_model(path)
+        return template
+
+    def acquire(self, path, parent):
+        pool = self.pools.get(path)
+        if pool:
+            node = pool.pop()
+            node.reparent_to(parent)
+            return node
+        return self.template(path).instance_under_node(parent, path)
+
+    def release(self, path, node):
+        node.detach_node()
+        node.clear_transform()
+        pool = self.pools.setdefault(path, [])
+        if len(pool) < self.pool_size:
+            pool.append(node)
+        else:
+            node.remove_node()
+
+
+models = ModelCache()
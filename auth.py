@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from globals import *
+import asyncio
+import hashlib
+import time
+
+"""
+Authentication backend of the LoginManager.
+
+Credentials are verified against a pluggable CredentialStore on a worker pool, so a
+slow store never holds up the server frame. Logins that arrive within the same
+event loop iteration (e.g. a storm of reconnects after a restart) are verified in
+batches of up to AUTH_BATCH_SIZE per store call, and successful verifications are
+remembered for AUTH_CACHE_TTL seconds in an LRU cache of AUTH_CACHE_SIZE entries.
+`verify()` is awaited on the runtime's loop, so whatever the caller does with the
+result (setting the client state, creating the avatar) happens back on the AI loop.
+"""
+
+
+class CredentialStore:
+    def verify_many(self, credentials):
+        """
+        Takes a list of (username, password) tuples, and returns a list of
+        booleans telling which are valid. Runs on a worker thread.
+        """
+        raise NotImplementedError
+
+
+class GuestCredentialStore(CredentialStore):
+    def verify_many(self, credentials):
+        return [(username == "guest") and (password == "guest") for username, password in credentials]
+
+
+class Authenticator:
+    def __init__(self, store, workers=AUTH_WORKERS, batch_size=AUTH_BATCH_SIZE,
+                 cache_ttl=AUTH_CACHE_TTL, cache_size=AUTH_CACHE_SIZE):
+        self.store = store
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="auth")
+        self.batch_size = batch_size
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # credentials digest -> expiry time
+        self.pending = []  # (username, password, future) waiting for the next batch
+        self.flush_scheduled = False
+
+    @staticmethod
+    def digest(username, password):
+        # Only a digest of the credentials is cached, never the password itself.
+        return hashlib.sha256(("%s\0%s" % (username, password)).encode('utf-8')).digest()
+
+    def cached(self, key):
+        expiry = self.cache.get(key)
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            del self.cache[key]
+            return False
+        self.cache.move_to_end(key)
+        return True
+
+    def remember(self, key):
+        self.cache[key] = time.monotonic() + self.cache_ttl
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def verify(self, username, password):
+        key = self.digest(username, password)
+        if self.cached(key):
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((username, password, future))
+        if not self.flush_scheduled:
+            # Let every login of this loop iteration queue up before sending the batch
+            self.flush_scheduled = True
+            loop.call_soon(self.flush)
+        valid = await future
+        if valid:
+            self.remember(key)
+        return valid
+
+    def flush(self):
+        self.flush_scheduled = False
+        pending, self.pending = self.pending, []
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            credentials = [(username, password) for username, password, _ in batch]
+            result = asyncio.wrap_future(self.executor.submit(self.store.verify_many, credentials))
+            result.add_done_callback(lambda result, batch=batch: self.resolve(batch, result))
+
+    @staticmethod
+    def resolve(batch, result):
+        if result.exception() is not None:
+            print("Authenticator: credential store failed (%s); rejecting %d logins" %
+                  (result.exception(), len(batch)))
+            valid = [False] * len(batch)
+        else:
+            valid = result.result()
+        for (_, _, future), ok in zip(batch, valid):
+            if not future.done():
+                future.set_result(bool(ok))
+
+
+authenticator = Authenticator(GuestCredentialStore())
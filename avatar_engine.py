@@ -0,0 +1,258 @@
+from broadcast import RateLimit, moves, pipeline
+from globals import *
+from interest import grid
+from movement import XY_SCALE, XY_STEPS, H_SCALE, H_STEPS
+import numpy as np
+
+"""
+Struct-of-arrays simulation of every DistributedAvatarAI in this process.
+
+Instead of each avatar view running its own per-frame task, positions, headings and
+movement intents of all avatars are kept in contiguous NumPy arrays, and all moving
+avatars are advanced in one batched step per server frame. Avatars with no movement
+intent (turn == forward == 0) are not part of the active set and cost nothing per frame.
+Their moves are quantized, deduplicated against the last move sent and rate limited
+over the same arrays, so per avatar Python only runs for the few that cross cells.
+Avatars that stopped, or stand still, are sent again as keyframes now and then; see
+movement.py.
+"""
+
+
+class AvatarEngine:
+    def __init__(self, capacity=AVATAR_ENGINE_CAPACITY, max_rate=AI_MAX_SEND_RATE, ack_interval=AI_ACK_INTERVAL):
+        self.capacity = capacity
+        self.ack_interval = ack_interval
+        self.rate = RateLimit(max_rate)
+        self.size = 0  # One past the highest slot ever handed out
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.z = np.zeros(capacity)
+        self.h = np.zeros(capacity)
+        self.turn = np.zeros(capacity)
+        self.forward = np.zeros(capacity)
+        self.cell = np.zeros(capacity, dtype=np.intp)  # Interest grid cell, which is also the zone
+        self.do_id = np.zeros(capacity, dtype=np.int64)  # 0 for free slots
+        self.owner = np.zeros(capacity, dtype=np.uint64)  # Owning client channel
+        self.intent_seq = np.zeros(capacity, dtype=np.int64)  # Sequence number of the owner's last intent
+        self.intent_time = np.zeros(capacity)  # Clock when it arrived
+        self.ack_time = np.zeros(capacity)  # Clock when the owner was last sent an `ack_move`
+        # The last move sent (quantized; -1 before the first), and where; see MoveBroadcaster
+        self.sent_qx = np.full(capacity, -1, dtype=np.int64)
+        self.sent_qy = np.full(capacity, -1, dtype=np.int64)
+        self.sent_qh = np.full(capacity, -1, dtype=np.int64)
+        self.sent_zone = np.full(capacity, -1, dtype=np.intp)
+        self.sent_count = np.zeros(capacity, dtype=np.int64)  # Moves sent since the last keyframe
+        self.next_send = np.zeros(capacity)  # Clock from which the next move may be sent
+        self.clock = 0.0  # Seconds simulated
+        self.views = [None] * capacity
+        self.slots = {}  # do_id -> slot
+        self.free_slots = []
+        # Slots with nonzero intent; the index array is rebuilt lazily on intent changes.
+        self.active = set()
+        self.active_index = np.zeros(0, dtype=np.intp)
+        self.active_dirty = False
+        # Slots that stopped, and may not have sent where they stopped yet
+        self.settling = set()
+        self.refreshing = {}  # Zone that came into an owner's interest -> clock to send its avatars again at
+        self.idle_cursor = 0  # Next slot of the round of keyframes of avatars standing still
+        self.idle_share = 0.0  # Slots of that round due, but not sent yet
+
+    def __len__(self):
+        return self.size - len(self.free_slots)
+
+    def add(self, view):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            if self.size == self.capacity:
+                self.grow(self.capacity * 2)
+            slot = self.size
+            self.size += 1
+        self.x[slot], self.y[slot], self.z[slot], self.h[slot] = 0.0, 0.0, 0.0, 0.0
+        self.turn[slot], self.forward[slot] = 0.0, 0.0
+        self.intent_seq[slot], self.intent_time[slot], self.ack_time[slot] = 0, self.clock, self.clock
+        self.cell[slot] = view.zone
+        self.do_id[slot], self.owner[slot] = view.do_id, 0
+        self.sent_qx[slot], self.sent_qy[slot], self.sent_qh[slot], self.sent_zone[slot] = -1, -1, -1, -1
+        self.sent_count[slot], self.next_send[slot] = 0, 0.0
+        self.views[slot] = view
+        self.slots[view.do_id] = slot
+        return slot
+
+    def remove(self, slot):
+        self.set_intent(slot, 0.0, 0.0)
+        self.settling.discard(slot)
+        pipeline.forget(self.views[slot].do_id)
+        del self.slots[self.views[slot].do_id]
+        self.do_id[slot] = 0
+        self.views[slot] = None
+        self.free_slots.append(slot)
+
+    def grow(self, capacity):
+        for name in ('x', 'y', 'z', 'h', 'turn', 'forward', 'cell', 'do_id', 'owner', 'intent_seq', 'intent_time', 'ack_time',
+                     'sent_qx', 'sent_qy', 'sent_qh', 'sent_zone', 'sent_count', 'next_send'):
+            array = np.zeros(capacity, dtype=getattr(self, name).dtype)
+            array[:self.capacity] = getattr(self, name)
+            setattr(self, name, array)
+        self.views.extend([None] * (capacity - self.capacity))
+        self.capacity = capacity
+
+    def set_owner(self, do_id, owner):
+        slot = self.slots.get(do_id)
+        if slot is not None:
+            self.owner[slot] = owner
+
+    def set_intent(self, slot, turn, forward, seq=0):
+        self.turn[slot], self.forward[slot] = turn, forward
+        self.intent_seq[slot], self.intent_time[slot] = seq, self.clock
+        moving = (turn != 0.0) or (forward != 0.0)
+        if moving and slot not in self.active:
+            self.active.add(slot)
+            self.active_dirty = True
+        elif not moving and slot in self.active:
+            self.active.discard(slot)
+            self.active_dirty = True
+            self.settling.add(slot)
+
+    def active_slots(self):
+        if self.active_dirty:
+            self.active_index = np.fromiter(self.active, dtype=np.intp, count=len(self.active))
+            self.active_index.sort()
+            self.active_dirty = False
+        return self.active_index
+
+    def step(self, dt):
+        """
+        Advances every moving avatar by `dt` seconds and returns the slots that were advanced.
+        This is the same math `DistributedAvatarAI.update_position()` used to run per avatar,
+        and `movement.step_move()` runs for a single one: a Z-axis rotation of the local
+        forward vector, rounded, then clamped to the map.
+        """
+        idx = self.active_slots()
+        if idx.size == 0:
+            return idx
+
+        # Calculate new avatar headings, wrapped into [0, 360)
+        turn = self.turn[idx]
+        h = self.h[idx] + np.fmod(turn * avatar_rotation_speed * dt, 360.0)
+        h = np.where(h >= 360.0, h - 360.0, h)
+        h = np.where(h < 0.0, h + 360.0, h)
+        self.h[idx] = h
+
+        # Rotate the local vector (0, -speed * forward * dt, 0) about the Z axis
+        h_rads = np.radians(h)
+        local_y = -1.0 * avatar_speed * self.forward[idx] * dt
+        x = self.x[idx] + np.round(-1.0 * np.sin(h_rads) * local_y, pos_float_accuracy)
+        y = self.y[idx] + np.round(np.cos(h_rads) * local_y, pos_float_accuracy)
+
+        # limit x and y coords to (WORLD_MIN <= n <= WORLD_MAX)
+        self.x[idx] = np.clip(x, WORLD_MIN, WORLD_MAX)
+        self.y[idx] = np.clip(y, WORLD_MIN, WORLD_MAX)
+        return idx
+
+    def quantized(self, idx):
+        # Same as `movement.quantize()`, for many avatars at once
+        qx = np.clip(np.rint((self.x[idx] - WORLD_MIN) * XY_SCALE), 0, XY_STEPS).astype(np.int64)
+        qy = np.clip(np.rint((self.y[idx] - WORLD_MIN) * XY_SCALE), 0, XY_STEPS).astype(np.int64)
+        qh = np.rint(self.h[idx] * H_SCALE).astype(np.int64) % H_STEPS
+        return qx, qy, qh
+
+    def broadcast(self, idx, keyframes=False):
+        """
+        Sends the moves of the slots `idx` whose quantized move differs from the last
+        one they sent, unless that was less than `rate.interval` ago. Returns the slots
+        held back by that, whose moves are still to be sent. With `keyframes`, they are
+        sent as keyframes, as are the unchanged ones that last sent a delta.
+        """
+        qx, qy, qh = self.quantized(idx)
+        changed = (qx != self.sent_qx[idx]) | (qy != self.sent_qy[idx]) | (qh != self.sent_qh[idx])
+        if keyframes:
+            changed |= self.sent_count[idx] != 0
+        due = self.rate.due(self.next_send[idx], self.clock)
+        send = changed & due
+        if send.any():
+            slots = idx[send]
+            self.next_send[slots] = self.clock + self.rate.interval
+            moves.send(self, slots, qx[send], qy[send], qh[send], keyframes)
+        return idx[changed & ~due]
+
+    def refresh(self, zones, dt):
+        """
+        Sends the avatars standing still in `zones` as keyframes, along with the share
+        of a frame of `dt` seconds of all the others standing still, so each of them is
+        sent every MOVE_IDLE_KEYFRAME_INTERVAL seconds. Moving avatars send keyframes
+        of their own.
+        """
+        size = self.size
+        # Fewer avatars than frames in a round get a frame now and then, not every frame
+        self.idle_share = min(self.idle_share + size * dt / MOVE_IDLE_KEYFRAME_INTERVAL, size)
+        count = int(self.idle_share)
+        self.idle_share -= count
+        idx = (self.idle_cursor + np.arange(count)) % size
+        self.idle_cursor = (self.idle_cursor + count) % size
+        if zones:
+            idx = np.union1d(idx, np.flatnonzero(np.isin(self.cell[:size], list(zones))))
+        idx = idx[(self.do_id[idx] != 0) & (self.turn[idx] == 0.0) & (self.forward[idx] == 0.0)]
+        if self.settling:
+            idx = idx[~np.isin(idx, list(self.settling))]
+        if idx.size:
+            moves.send(self, idx, *self.quantized(idx), keyframes=True)
+
+    def acks(self, idx):
+        """
+        The `ack_move` arguments of the slots `idx`: the owner's last intent, for how many
+        milliseconds it has been simulated, and where that got the avatar.
+        """
+        factor = pow(10, pos_float_accuracy)
+        # Clients send a held intent again long before it would run out (CLIENT_INTENT_REFRESH)
+        elapsed = np.minimum(np.rint((self.clock - self.intent_time[idx]) * 1000.0), 65535).astype(np.int64)
+        return (self.intent_seq[idx].tolist(), elapsed.tolist(),
+                np.rint(self.x[idx] * factor).astype(np.int64).tolist(),
+                np.rint(self.y[idx] * factor).astype(np.int64).tolist(),
+                (np.rint(self.h[idx] * 100.0).astype(np.int64) % 36000).tolist())
+
+    def acknowledge(self, slot):
+        self.ack_time[slot] = self.clock
+        seq, elapsed, x, y, h = self.acks(np.array([slot]))
+        pipeline.queue(self.views[slot], 'ack_move', seq[0], elapsed[0], x[0], y[0], h[0])
+
+    def tick(self, dt):
+        self.clock += dt
+        idx = self.step(dt)
+        if self.settling:
+            # Where they stopped still goes out as a keyframe, even once the rate limit
+            # lets it, for clients that missed a delta since their last one
+            settling = np.fromiter(self.settling, dtype=np.intp, count=len(self.settling))
+            self.settling = set(self.broadcast(settling, keyframes=True).tolist())
+        # Owners whose interest gained zones since the last frame get the avatars there
+        # once their Client Agent has opened them
+        for zone in grid.gained:
+            self.refreshing.setdefault(zone, self.clock + MOVE_REFRESH_DELAY)
+        grid.gained.clear()
+        zones = [zone for zone, due in self.refreshing.items() if self.rate.due(due, self.clock)]
+        for zone in zones:
+            del self.refreshing[zone]
+        if self.size:
+            self.refresh(zones, dt)
+        if idx.size == 0:
+            return
+        views, queue = self.views, pipeline.queue
+        # Move avatars that crossed into another interest cell to that cell's zone
+        crossed, cells = grid.crossed(self.x, self.y, self.cell, idx)
+        if crossed.size:
+            self.cell[crossed] = cells
+            for slot, cell in zip(crossed.tolist(), cells.tolist()):
+                grid.relocate(views[slot], cell)
+        self.broadcast(idx)
+        # Owners predict their avatars' movement, and reconcile it with the acks of their
+        # intents (see prediction.py); while it goes on, they are corrected now and then.
+        due = idx[self.rate.due(self.ack_time[idx] + self.ack_interval, self.clock)]
+        if due.size:
+            self.ack_time[due] = self.clock
+            for slot, seq, elapsed, x, y, h in zip(due.tolist(), *self.acks(due)):
+                queue(views[slot], 'ack_move', seq, elapsed, x, y, h)
+
+
+engine = AvatarEngine()
+# A single task advances all avatars of this process every server frame.
+AI_TASKS.add_task(engine.tick)
@@ -0,0 +1,276 @@
+from avatar_engine import AvatarEngine, engine
+from broadcast import moves
+from dcfields import get_index
+from globals import *
+from interest import grid
+from mocks import MockRepository, MockView
+from shards import context
+from statistics import median
+from stats import percentile
+from time import perf_counter
+from wire import *
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import random
+import sys
+
+"""
+Benchmarks of the AI simulation, for telling whether a change helps or hurts.
+
+Nothing connects to an Astron cluster: the views run against a MockRepository,
+which records every update and message they send instead. The suite has
+* movement: one `AvatarEngine.step()` of 1, 100, 1k and 10k moving avatars
+* tick: a whole AI_TASKS frame (simulation, interest, update pipeline and move
+  batching) with 1k and 10k moving avatars
+* bytes: the field updates those frames send, encoded as datagrams to the State
+  Server, and as fanned out to the clients interested in their zones
+* login: logins per second of a burst of logins through LoginManagerAE.login(),
+  up to the avatars being created, with the credential cache cold and warm; these
+  need the views, and with them the astron library (but no daemon)
+
+The suite runs --runs times, each in a fresh process, and every result is the median
+of its runs. It's saved with --json as a value, its unit, whether lower or higher is
+better and whether it's a timing. Run with --baseline to compare to saved results:
+any result that got worse by more than its tolerance fails the run with exit code 1.
+Timings vary from run to run, so they get --timing-tolerance; counts of updates and
+bytes are the same on every run, and get the much tighter --tolerance. Movement
+steps are timed as the best of a few repeats, frames as the mean and 90th
+percentile of a run of them; only compare timings taken on the same machine.
+
+Usage: bench.py [--json FILE] [--baseline FILE] [--runs N] [--tolerance FRACTION]
+                [--timing-tolerance FRACTION] [--quick] [-v]
+"""
+
+BENCH_FRAME = 1.0 / AI_FRAME_RATE
+BENCH_SEED = 20  # Of the avatars' positions and intents, so every run sends the same
+MOVEMENT_SIZES = [1, 100, 1000, 10000]
+TICK_SIZES = [1000, 10000]
+LOGIN_BURST = 1000
+
+# Bytes of a field update besides its arguments, framed on the wire
+SET_FIELD_OVERHEAD = 2 + len(internal_datagram([0], 0, STATESERVER_OBJECT_SET_FIELD).uint32(0).uint16(0).data())
+CLIENT_SET_FIELD_OVERHEAD = 2 + len(client_datagram(CLIENT_OBJECT_SET_FIELD).uint32(0).uint16(0).data())
+
+
+def best_of(func, repeat, number):
+    """
+    Seconds per call of `func`, the best average of `repeat` runs of `number` calls.
+    """
+    best = float('inf')
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = perf_counter()
+            for _ in range(number):
+                func()
+            best = min(best, (perf_counter() - started) / number)
+    finally:
+        gc.enable()
+    return best
+
+
+def result(value, unit, better='lower', timing=True):
+    return {'value': value, 'unit': unit, 'better': better, 'timing': timing}
+
+
+def spread(avatars, rng):
+    """
+    Puts `avatars` (engine, slot, view) at random spots of the map, moving in random ways.
+    """
+    for avatar_engine, slot, view in avatars:
+        x, y = rng.uniform(WORLD_MIN, WORLD_MAX), rng.uniform(WORLD_MIN, WORLD_MAX)
+        avatar_engine.x[slot], avatar_engine.y[slot], avatar_engine.h[slot] = x, y, rng.uniform(0.0, 360.0)
+        if view is not None:
+            view.zone = avatar_engine.cell[slot] = grid.cell_at(x, y)
+        avatar_engine.set_intent(slot, rng.choice((-1.0, 0.0, 1.0)), rng.choice((0.5, 1.0)))
+
+
+def bench_movement(results, quick):
+    rng = random.Random(BENCH_SEED)
+    for count in MOVEMENT_SIZES:
+        movers = AvatarEngine(capacity=count)
+        avatars = []
+        for do_id in range(1, count + 1):
+            view = MockView(None, 'DistributedAvatar', do_id, DistributedWorldId, 0)
+            avatars.append((movers, movers.add(view), None))
+        spread(avatars, rng)
+        number = max(10000 // count, 10) if quick else max(100000 // count, 50)
+        seconds = best_of(lambda: movers.step(BENCH_FRAME), 3 if quick else 7, number)
+        results['movement_step_%d_us' % (count, )] = result(seconds * 1e6, 'us')
+
+
+def update_sizes(updates):
+    """
+    Bytes of `updates` sent to the State Server, and as received by all clients interested in them.
+    """
+    index = get_index()
+    viewers = {}  # zone -> owners of avatars interested in it
+    size = engine.size
+    for cell in engine.cell[:size][engine.do_id[:size] != 0].tolist():
+        for zone in grid.neighbour_zones(cell):
+            viewers[zone] = viewers.get(zone, 0) + 1
+    sent, received = 0, 0
+    for view, field, args in updates:
+        size = index.field(view.dclass, field).size(args)
+        sent += SET_FIELD_OVERHEAD + size
+        if field != 'ack_move':  # ownrecv; only the owner gets it
+            received += viewers.get(view.zone, 0) * (CLIENT_SET_FIELD_OVERHEAD + size)
+        else:
+            received += CLIENT_SET_FIELD_OVERHEAD + size
+    return sent, received
+
+
+def bench_tick(results, quick):
+    """
+    Runs the AI_TASKS frames of this process (with its AvatarEngine, UpdatePipeline and
+    MoveBroadcaster) with more and more moving avatars, topping them up between sizes.
+    """
+    rng = random.Random(BENCH_SEED)
+    repo = MockRepository()
+    for zone in range(WORLD_GRID_CELLS * WORLD_GRID_CELLS):
+        batch = MockView(repo, 'DistributedMoveBatch', context.doids.allocate(), DistributedWorldId, zone)
+        moves.batches[zone] = batch
+    avatars = []
+    for count in TICK_SIZES:
+        added = []
+        while len(avatars) + len(added) < count:
+            view = MockView(repo, 'DistributedAvatar', context.doids.allocate(), DistributedWorldId, 0)
+            view.slot = engine.add(view)
+            added.append((engine, view.slot, view))
+        spread(added, rng)
+        avatars += added
+        # Until every avatar has sent a keyframe, and the rate limit has settled in
+        for _ in range(int(AI_FRAME_RATE)):
+            AI_TASKS.tick(BENCH_FRAME)
+        repo.clear()
+
+        ticks = 30 if quick else 150
+        costs = []
+        gc.disable()
+        try:
+            for _ in range(ticks):
+                started = perf_counter()
+                AI_TASKS.tick(BENCH_FRAME)
+                costs.append(perf_counter() - started)
+        finally:
+            gc.enable()
+        sent, received = update_sizes(repo.updates)
+        results['tick_%d_ms' % (count, )] = result(sum(costs) / ticks * 1000.0, 'ms')
+        results['tick_%d_p90_ms' % (count, )] = result(percentile(costs, 0.9) * 1000.0, 'ms')
+        results['tick_%d_updates' % (count, )] = result(float(len(repo.updates)) / ticks, 'updates/tick',
+                                                        timing=False)
+        results['tick_%d_messages' % (count, )] = result(float(len(repo.messages)) / ticks, 'messages/tick',
+                                                         timing=False)
+        results['tick_%d_bytes' % (count, )] = result(float(sent) / ticks, 'bytes/tick', timing=False)
+        results['tick_%d_fanout_bytes' % (count, )] = result(float(received) / ticks, 'bytes/tick', timing=False)
+        repo.clear()
+
+
+async def login_burst(views, count):
+    from runtime import runtime
+    runtime.loop = asyncio.get_running_loop()
+    repo = MockRepository(views)
+    context.attach(repo, views.DistributedWorldAI.spawn_avatar)
+    world = MockView(repo, 'DistributedWorld', DistributedWorldId, RootID, WORLD_ZONE, views.DistributedWorldAI)
+    manager = MockView(repo, 'LoginManager', LoginManagerId, RootID, LOGIN_ZONE, views.LoginManagerAE)
+    manager.world_view = world
+
+    rates = []
+    for burst in range(2):  # The second one finds the credentials cached
+        started = perf_counter()
+        for client in range(count):
+            manager.login((burst * count + client) << 32, "guest", "guest")
+        await runtime.settle()
+        rates.append(count / (perf_counter() - started))
+    spawned = sum(1 for view in repo.objects.values() if view.dclass == 'DistributedAvatar')
+    if spawned != 2 * count:
+        raise RuntimeError("%d logins spawned %d avatars" % (2 * count, spawned))
+    return rates
+
+
+def bench_login(results, quick):
+    try:
+        import views
+    except ImportError as e:
+        print("Skipping the login benchmarks: %s" % (e, ), file=sys.__stdout__)
+        return
+    cold, warm = asyncio.run(login_burst(views, LOGIN_BURST // 4 if quick else LOGIN_BURST))
+    results['login_cold_per_s'] = result(cold, 'logins/s', 'higher')
+    results['login_warm_per_s'] = result(warm, 'logins/s', 'higher')
+
+
+def run_suite(quick, verbose):
+    if not verbose:
+        # Every view prints on creation and login; that's a lot of output for a burst.
+        sys.stdout = open(os.devnull, 'w')
+    results = {}
+    bench_movement(results, quick)
+    bench_tick(results, quick)
+    bench_login(results, quick)
+    sys.stdout = sys.__stdout__
+    return results
+
+
+def median_results(runs):
+    """
+    Returns every result of the suite's `runs` with the median of its values.
+    """
+    return {name: dict(first, value=median(run[name]['value'] for run in runs))
+            for name, first in runs[0].items()}
+
+
+def compare(results, baseline, tolerance, timing_tolerance):
+    """
+    Prints every result next to its baseline, and the baseline results missing from
+    `results`, and returns the names of those that regressed.
+    """
+    regressions = []
+    for name, current in results.items():
+        line = "%-28s %16.3f %-13s" % (name, current['value'], current['unit'])
+        previous = baseline.get(name)
+        if previous is not None and previous['value']:
+            change = (current['value'] - previous['value']) / previous['value']
+            worse = change if current['better'] == 'lower' else -change
+            line += " baseline %16.3f %+7.1f%%" % (previous['value'], change * 100.0)
+            if worse > (timing_tolerance if current.get('timing', True) else tolerance):
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    for name in sorted(set(baseline) - set(results)):
+        print("%-28s %16s %-13s baseline %16.3f" % (name, "missing", baseline[name]['unit'], baseline[name]['value']))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the AI simulation against a mock repository.")
+    parser.add_argument('--json', help="file to save the results to")
+    parser.add_argument('--baseline', help="results saved with --json to compare to")
+    parser.add_argument('--runs', type=int, default=5, help="runs of the suite to take the median of")
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help="fraction a count may get worse by before it counts as a regression")
+    parser.add_argument('--timing-tolerance', type=float, default=0.5,
+                        help="fraction a timing may get worse by before it counts as a regression")
+    parser.add_argument('--quick', action='store_true', help="fewer repeats and a smaller login burst")
+    parser.add_argument('-v', '--verbose', action='store_true', help="keep the views' output")
+    args = parser.parse_args()
+
+    # Every run in a fresh process, as a run leaves this one's engine full of avatars
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        results = median_results(pool.starmap(run_suite, [(args.quick, args.verbose)] * args.runs))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.timing_tolerance)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print("%d of %d results regressed by more than their tolerance: %s" %
+              (len(regressions), len(results), ", ".join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,169 @@
+from astron.object_repository import ClientRepository
+from globals import *
+from multiprocessing import Pool
+from stats import percentile
+from time import perf_counter, sleep
+import argparse
+import os
+import random
+import sys
+import views
+
+"""
+Headless bot swarm for load testing the cluster.
+
+Every bot is a plain ClientRepository, with no Panda3D involved: it connects to the
+Client Agent, logs in through the AnonymousContact, waits for its DistributedAvatarOV
+and then keeps sending `indicate_intent` updates following a movement pattern.
+Bots are driven by a single poll loop per process, optionally over a pool of
+processes, and the swarm reports connect/login latency percentiles and the rate of
+moves received.
+
+Usage: bots.py [-n BOTS] [-p PROCESSES] [-d SECONDS] [--pattern random|circle|zigzag|idle]
+"""
+
+BOT_POLL_RATE = 60.0  # Times per second every bot's repository is polled
+BOT_INTENT_INTERVAL = 1.0  # Seconds between intent changes of the 'random' pattern
+
+# Scripted patterns; lists of (seconds, turn, forward) steps, looped
+PATTERNS = {
+    'circle': [(1.0, 1, 1)],
+    'zigzag': [(1.0, 0, 1), (0.5, 1, 0), (1.0, 0, 1), (0.5, -1, 0)],
+    'idle': [(1.0, 0, 0)],
+}
+
+
+class Bot:
+    def __init__(self, swarm, pattern):
+        self.swarm = swarm
+        self.pattern = pattern
+        self.repo = ClientRepository(VERSION_STRING, DC_FILE)
+        self.avatar_ov = None
+        self.connect_started = None
+        self.login_started = None
+        self.step, self.next_step = 0, 0.0
+        self.updates = 0
+
+    def connect(self):
+        self.connect_started = perf_counter()
+        self.repo.connect(self.connection_success, self.connection_failure, self.connection_eject,
+                          host=CA_HOST, port=CA_PORT)
+
+    def connection_success(self):
+        self.login_started = perf_counter()
+        self.swarm.connect_latencies.append(self.login_started - self.connect_started)
+        anonymous_contact = self.repo.create_distobjglobal_view("AnonymousContact", AnonymousContactID)
+        anonymous_contact.login("guest", "guest")
+
+    def connection_failure(self):
+        self.swarm.failures += 1
+
+    def connection_eject(self, code, reason):
+        self.swarm.ejects += 1
+
+    def got_avatar(self, owner_view):
+        self.swarm.login_latencies.append(perf_counter() - self.login_started)
+        self.avatar_ov = owner_view
+
+    def update(self, now):
+        if self.avatar_ov is None or now < self.next_step:
+            return
+        if self.pattern == 'random':
+            turn, forward = random.choice((-1, 0, 1)), random.choice((-1, 0, 1))
+            self.next_step = now + random.uniform(0.5, 1.5) * BOT_INTENT_INTERVAL
+        else:
+            steps = PATTERNS[self.pattern]
+            duration, turn, forward = steps[self.step % len(steps)]
+            self.step += 1
+            self.next_step = now + duration
+        self.avatar_ov.indicate_intent(turn, forward)
+
+
+class Swarm:
+    def __init__(self, count, pattern, connect_rate):
+        self.count = count
+        self.pattern = pattern
+        self.connect_rate = connect_rate
+        self.bots = []
+        self.bots_by_repo = {}
+        self.connect_latencies, self.login_latencies = [], []
+        self.failures, self.ejects = 0, 0
+        views.HEADLESS_LISTENERS["avatar_ov"] = [self.got_avatar]
+        views.HEADLESS_LISTENERS["set_move"] = [self.got_update]
+
+    def got_avatar(self, owner_view):
+        self.bots_by_repo[id(owner_view.repo)].got_avatar(owner_view)
+
+    def got_update(self, view):
+        self.bots_by_repo[id(view.repo)].updates += 1
+
+    def run(self, duration):
+        started = perf_counter()
+        connect_interval = 1.0 / self.connect_rate
+        next_connect = started
+        while perf_counter() - started < duration:
+            now = perf_counter()
+            while len(self.bots) < self.count and now >= next_connect:
+                bot = Bot(self, self.pattern)
+                self.bots.append(bot)
+                self.bots_by_repo[id(bot.repo)] = bot
+                bot.connect()
+                next_connect += connect_interval
+            for bot in self.bots:
+                bot.repo.poll_till_empty()
+                bot.update(now)
+            sleep(1.0 / BOT_POLL_RATE)
+        return {
+            'bots': len(self.bots),
+            'logged_in': len(self.login_latencies),
+            'failures': self.failures,
+            'ejects': self.ejects,
+            'connect_latencies': self.connect_latencies,
+            'login_latencies': self.login_latencies,
+            'updates': sum(bot.updates for bot in self.bots),
+            'duration': perf_counter() - started,
+        }
+
+
+def run_swarm(args):
+    count, pattern, connect_rate, duration = args
+    # Every view prints on creation; that's a lot of output for thousands of bots.
+    sys.stdout = open(os.devnull, 'w')
+    return Swarm(count, pattern, connect_rate).run(duration)
+
+
+def report(results):
+    connect = [latency for result in results for latency in result['connect_latencies']]
+    login = [latency for result in results for latency in result['login_latencies']]
+    bots = sum(result['bots'] for result in results)
+    updates = sum(result['updates'] for result in results)
+    duration = max(result['duration'] for result in results)
+    print("Bots: %d, logged in: %d, connection failures: %d, ejects: %d" %
+          (bots, len(login), sum(r['failures'] for r in results), sum(r['ejects'] for r in results)))
+    for name, latencies in (("Connect", connect), ("Login", login)):
+        print("%s latency (ms): p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" %
+              (name, percentile(latencies, 0.5) * 1000.0, percentile(latencies, 0.9) * 1000.0,
+               percentile(latencies, 0.99) * 1000.0, percentile(latencies, 1.0) * 1000.0))
+    print("Moves received: %d (%.1f/s total, %.2f/s per bot)" %
+          (updates, updates / duration, updates / duration / max(bots, 1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless bot swarm load generator.")
+    parser.add_argument('-n', '--bots', type=int, default=100, help="bots in total")
+    parser.add_argument('-p', '--processes', type=int, default=1, help="processes to spread the bots over")
+    parser.add_argument('-d', '--duration', type=float, default=60.0, help="seconds to run for")
+    parser.add_argument('-r', '--connect-rate', type=float, default=50.0, help="connects per second per process")
+    parser.add_argument('--pattern', choices=['random'] + sorted(PATTERNS), default='random')
+    args = parser.parse_args()
+
+    shares = [args.bots // args.processes + (1 if i < args.bots % args.processes else 0)
+              for i in range(args.processes)]
+    jobs = [(share, args.pattern, args.connect_rate, args.duration) for share in shares]
+    if args.processes == 1:
+        results = [run_swarm(jobs[0])]
+        sys.stdout = sys.__stdout__
+    else:
+        with Pool(args.processes) as pool:
+            results = pool.map(run_swarm, jobs)
+    report(results)
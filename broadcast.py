@@ -0,0 +1,170 @@
+from globals import *
+from movement import H_STEPS
+import numpy as np
+import struct
+
+"""
+Outbound field update stage for AI objects.
+
+Instead of calling `send_update()` directly, AI code queues its updates here, and
+all of them are flushed once at the end of the server frame. An update whose
+arguments equal the last ones sent for that object and field is dropped, only the
+latest update per object and field survives until the flush, and each object is
+held to at most `max_rate` flushed updates per second.
+
+Avatar moves don't go through the pipeline: there's one per moving avatar and frame,
+so the AvatarEngine drops and rate limits them itself, over arrays of all avatars,
+and hands the rest to the MoveBroadcaster, which encodes them (see movement.py) and
+sends them at the end of the frame as well.
+"""
+
+# movement.KEYFRAME and movement.DELTA, as records of NumPy arrays
+KEYFRAME_RECORD = np.dtype([('do_id', '<u4'), ('move', '<u4')])
+DELTA_RECORD = np.dtype([('do_id', '<u4'), ('dx', 'i1'), ('dy', 'i1'), ('dh', 'i1')])
+
+
+class RateLimit:
+    """
+    At most `max_rate` sends per second, or no limit for 0. Frames are not exactly
+    1/AI_FRAME_RATE apart, so a send is let through up to half a frame early rather
+    than skipping a frame over jitter.
+    """
+    def __init__(self, max_rate):
+        self.interval = (1.0 / float(max_rate)) if max_rate else 0.0
+        self.tolerance = 0.5 / float(AI_FRAME_RATE)
+
+    def due(self, at, clock):
+        # Whether what is due at `at` (a clock, or an array of them) may be sent at `clock`
+        return at <= clock + self.tolerance
+
+
+class UpdatePipeline:
+    def __init__(self, max_rate=AI_MAX_SEND_RATE):
+        self.rate = RateLimit(max_rate)
+        self.clock = 0.0
+        self.pending = {}  # (do_id, field) -> (view, args)
+        self.last_sent = {}  # do_id -> {field: args}
+        self.last_time = {}  # do_id -> clock of last flushed update
+        self.sent, self.dropped = 0, 0
+
+    def queue(self, view, field, *args):
+        key = (view.do_id, field)
+        if self.last_sent.get(view.do_id, {}).get(field) == args:
+            # Nothing changed (e.g. an avatar pushed against the map boundary)
+            self.pending.pop(key, None)
+            self.dropped += 1
+            return
+        self.pending[key] = (view, args)
+
+    def forget(self, do_id):
+        for key in [key for key in self.pending if key[0] == do_id]:
+            del self.pending[key]
+        self.last_sent.pop(do_id, None)
+        self.last_time.pop(do_id, None)
+
+    def flush(self, dt):
+        self.clock += dt
+        if not self.pending:
+            return
+        clock, last_time, rate = self.clock, self.last_time, self.rate
+        never = -rate.interval
+        flushed = []
+        for key, (view, args) in self.pending.items():
+            if not rate.due(last_time.get(key[0], never) + rate.interval, clock):
+                continue  # Rate limited; stays pending until a later frame
+            view.send_update(key[1], *args)
+            self.last_sent.setdefault(key[0], {})[key[1]] = args
+            flushed.append(key)
+        for key in flushed:
+            del self.pending[key]
+            last_time[key[0]] = clock
+        self.sent += len(flushed)
+
+
+class MoveBroadcaster:
+    """
+    Sends the quantized moves of AvatarEngine slots as keyframes or deltas, in the
+    zone's batch or on their own.
+    """
+    def __init__(self, keyframe_interval=MOVE_KEYFRAME_INTERVAL, batching=MOVE_BATCHING):
+        self.keyframe_interval = keyframe_interval
+        self.batching = batching
+        self.batches = {}  # zone -> this shard's DistributedMoveBatchAI there
+        self.pending = []  # (zones, keyframe mask, do_ids, packed moves, dx, dy, dh) arrays of the current frame
+        self.keyframes, self.deltas = 0, 0
+
+    def create_batches(self, repo, doids, zones=range(WORLD_GRID_CELLS * WORLD_GRID_CELLS)):
+        if not self.batching:
+            return
+        for zone in zones:
+            # The view registers itself in `batches` once created.
+            repo.create_distobj('DistributedMoveBatch', doids.allocate(), DistributedWorldId, zone, set_ai=True)
+
+    def send(self, engine, idx, qx, qy, qh, keyframes=False):
+        """
+        Sends the moves `qx`, `qy`, `qh` of the engine's slots `idx`: as deltas to the
+        last move sent for a slot (kept in the engine's `sent_*` arrays) where they fit,
+        as keyframes where they don't, or all of them as keyframes with `keyframes`.
+        At most one move per slot and frame, or the deltas of a batch would be applied
+        after its keyframes.
+        """
+        zones = engine.cell[idx]
+        dx, dy = qx - engine.sent_qx[idx], qy - engine.sent_qy[idx]
+        dh = (qh - engine.sent_qh[idx] + H_STEPS // 2) % H_STEPS - H_STEPS // 2  # The shorter way around
+        keyframe = (keyframes | (engine.sent_zone[idx] != zones) | (engine.sent_count[idx] >= self.keyframe_interval) |
+                    (np.minimum(np.minimum(dx, dy), dh) < -128) | (np.maximum(np.maximum(dx, dy), dh) > 127))
+        engine.sent_qx[idx], engine.sent_qy[idx], engine.sent_qh[idx] = qx, qy, qh
+        engine.sent_zone[idx] = zones
+        engine.sent_count[idx] = np.where(keyframe, 0, engine.sent_count[idx] + 1)
+        packed = qx | (qy << MOVE_XY_BITS) | (qh << (2 * MOVE_XY_BITS))
+        keyframes = int(np.count_nonzero(keyframe))
+        self.keyframes += keyframes
+        self.deltas += len(idx) - keyframes
+
+        batched = np.isin(zones, list(self.batches))
+        if batched.all():
+            self.pending.append((zones, keyframe, engine.do_id[idx], packed, dx, dy, dh))
+            return
+        if batched.any():
+            self.pending.append((zones[batched], keyframe[batched], engine.do_id[idx[batched]], packed[batched],
+                                 dx[batched], dy[batched], dh[batched]))
+        # Zones without a batch (or no batching at all) get an update per avatar
+        alone = ~batched
+        for slot, is_keyframe, move, delta_x, delta_y, delta_h in zip(
+                *(array[alone].tolist() for array in (idx, keyframe, packed, dx, dy, dh))):
+            if is_keyframe:
+                engine.views[slot].send_update('set_move', move)
+            else:
+                engine.views[slot].send_update('set_move_delta', delta_x, delta_y, delta_h)
+
+    def flush(self, dt=None):
+        if not self.pending:
+            return
+        zones, keyframe, do_ids, packed, dx, dy, dh = (np.concatenate(arrays) for arrays in zip(*self.pending))
+        self.pending = []
+        key, delta = np.flatnonzero(keyframe), np.flatnonzero(~keyframe)
+        # Records of every zone in one run, in the order they were sent
+        key = key[np.argsort(zones[key], kind='stable')]
+        delta = delta[np.argsort(zones[delta], kind='stable')]
+        keyframes = np.empty(len(key), dtype=KEYFRAME_RECORD)
+        keyframes['do_id'], keyframes['move'] = do_ids[key], packed[key]
+        deltas = np.empty(len(delta), dtype=DELTA_RECORD)
+        deltas['do_id'], deltas['dx'], deltas['dy'], deltas['dh'] = do_ids[delta], dx[delta], dy[delta], dh[delta]
+        key_zones, delta_zones = zones[key], zones[delta]
+        for zone in np.unique(zones).tolist():
+            zone_keyframes = keyframes[np.searchsorted(key_zones, zone):np.searchsorted(key_zones, zone, 'right')]
+            zone_deltas = deltas[np.searchsorted(delta_zones, zone):np.searchsorted(delta_zones, zone, 'right')]
+            batch = self.batches[zone]
+            # Keep every blob within MOVE_BATCH_SIZE keyframes and as many deltas
+            for start in range(0, max(len(zone_keyframes), len(zone_deltas)), MOVE_BATCH_SIZE):
+                chunk = zone_keyframes[start:start + MOVE_BATCH_SIZE]
+                # Same layout as movement.encode_batch()
+                batch.send_update('set_moves', struct.pack('<H', len(chunk)) + chunk.tobytes() +
+                                  zone_deltas[start:start + MOVE_BATCH_SIZE].tobytes())
+
+
+pipeline = UpdatePipeline()
+moves = MoveBroadcaster()
+# Both flush after every other task of the frame has queued its updates.
+AI_TASKS.add_task(pipeline.flush, priority=100, stage='send')
+AI_TASKS.add_task(moves.flush, priority=100, stage='send')
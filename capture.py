@@ -0,0 +1,117 @@
+from globals import *
+from wire import *
+import struct
+
+"""
+Capture of the datagrams a Services repository receives, for replay.py.
+
+The capture log is a binary file starting with CAPTURE_MAGIC, the uint32 id of the
+shard that wrote it and the state of its doId allocator when the capture started
+(uint32 min and max id and next fresh id, then a uint32 count and that many uint32
+ids, of the ids handed out and then of the free ones), so a replay runs as the same
+shard and allocates the same doIds. Then follow records:
+* a datagram: uint8 0, uint32 tick, uint16 length, and the datagram itself
+* a tick: uint8 1, uint32 tick, float64 dt
+all little endian. A datagram's tick is the frame of the AI_TASKS scheduler that
+first got to see it, and a tick record is written when that frame starts, so every
+tick's datagrams come right before its tick record.
+"""
+
+CAPTURE_MAGIC = b'AIDGLOG3'
+SHARD_STATE = struct.Struct('<IIII')
+DATAGRAM_RECORD = struct.Struct('<BIH')
+TICK_RECORD = struct.Struct('<BId')
+
+
+class CaptureSocket(StandInSocket):
+    """
+    Stands in for a repository's socket, and logs every datagram read from it.
+    """
+    def __init__(self, sock, recorder):
+        StandInSocket.__init__(self, sock)
+        self.recorder = recorder
+        self.inbound = DatagramStream()
+
+    def received(self, data):
+        for datagram in self.inbound.feed(data):
+            self.recorder.datagram(datagram)
+
+
+class Recorder:
+    def __init__(self):
+        self.file = None
+        self.scheduler = None
+        self.datagrams = 0
+
+    def install(self, repo, scheduler, path, shard_id, doids):
+        self.scheduler = scheduler
+        self.file = open(path, 'wb')
+        self.file.write(CAPTURE_MAGIC + SHARD_STATE.pack(shard_id, doids.min_id, doids.max_id, doids.next_fresh))
+        for ids in (doids.used_ids(), doids.free_ids):
+            self.file.write(struct.pack('<I%dI' % (len(ids), ), len(ids), *ids))
+        repo.socket = CaptureSocket(repo.socket, self)
+        # Before any other task, so the tick is logged before anything it causes
+        scheduler.add_task(self.tick, priority=-1000)
+
+    def datagram(self, datagram):
+        self.file.write(DATAGRAM_RECORD.pack(0, self.scheduler.frame, len(datagram)) + datagram)
+        self.datagrams += 1
+
+    def tick(self, dt):
+        frame = self.scheduler.frame
+        self.file.write(TICK_RECORD.pack(1, frame, dt))
+        if frame % int(AI_FRAME_RATE) == 0:
+            self.file.flush()
+
+
+def read_header(data, path):
+    """
+    Returns the shard id and doId allocator state of a capture log's `data`
+    (shard_id, min_id, max_id, next_fresh, used_ids, free_ids), and the offset of
+    its first record.
+    """
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError("%s is not a capture log" % (path, ))
+    offset = len(CAPTURE_MAGIC) + SHARD_STATE.size
+    state = list(SHARD_STATE.unpack_from(data, len(CAPTURE_MAGIC)))
+    for _ in range(2):
+        count, = struct.unpack_from('<I', data, offset)
+        state.append(list(struct.unpack_from('<%dI' % (count, ), data, offset + 4)))
+        offset += 4 + 4 * count
+    return tuple(state), offset
+
+
+def read_start(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return read_header(data, path)[0]
+
+
+def read_capture(path):
+    """
+    Yields the (tick, dt, [datagrams]) of every tick in a capture log.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    _, offset = read_header(data, path)
+    datagrams = []
+    # A log cut short by a crash ends with its last complete tick.
+    while offset < len(data):
+        if data[offset] == 0:
+            if offset + DATAGRAM_RECORD.size > len(data):
+                return
+            _, tick, length = DATAGRAM_RECORD.unpack_from(data, offset)
+            offset += DATAGRAM_RECORD.size + length
+            if offset > len(data):
+                return
+            datagrams.append(data[offset - length:offset])
+        else:
+            if offset + TICK_RECORD.size > len(data):
+                return
+            _, tick, dt = TICK_RECORD.unpack_from(data, offset)
+            offset += TICK_RECORD.size
+            yield tick, dt, datagrams
+            datagrams = []
+
+
+recorder = Recorder()
@@ -0,0 +1,216 @@
+from avatar_engine import engine
+from broadcast import moves
+from globals import *
+from interest import grid
+from time import perf_counter
+import numpy as np
+import os
+
+"""
+Checkpoints of the AI state of a Services shard, for warm restarts.
+
+Every CHECKPOINT_INTERVAL seconds, the state of every avatar in the AvatarEngine
+(doId, owner, zone, position, heading and intent) is copied, array by array, into a
+memory-mapped file of fixed layout: a header, followed by two regions of records.
+A checkpoint is written into the region not holding the last complete one, and only
+once it is flushed does the header switch over to it, so a crash halfway through
+writing leaves the previous checkpoint intact. When the file needs a new layout (more
+avatars than it has room for), the new file is written next to the old one, and only
+replaces it once it holds a complete checkpoint of its own.
+
+When a shard starts, it reads the last checkpoint of its previous run, and hands
+every avatar in it off to no AI and right back to itself with
+STATESERVER_OBJECT_SET_AI. (The avatars still have this shard's channel as their AI,
+and setting the AI an object already has does nothing.) Avatars whose objects
+survived on the State Server (along with their owners' sessions) enter this shard's
+repository again, and come back where they were; the clients never notice. The ones
+that don't come back within CHECKPOINT_RESTORE_TIMEOUT are gone, and their doIds are
+freed.
+
+The header also holds the doIds of the shard's DistributedMoveBatch objects, one per
+zone, which are taken back the same way; new batches are only created for the zones
+whose batch doesn't come back, instead of every restart leaving a full set behind.
+"""
+
+CHECKPOINT_MAGIC = b'AICHKPT2'
+
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('capacity', '<u4'),  # Records per region
+    ('active', '<u4'),  # Region of the last complete checkpoint
+    ('generation', '<u8'),  # Checkpoints written
+    ('doid_range', '<u8', 2),  # Of the allocator the avatar doIds came from
+    ('next_fresh', '<u8', 2),  # Of that allocator, per region
+    ('count', '<u4', 2),  # Records, per region
+    ('batch_ids', '<u4', WORLD_GRID_CELLS * WORLD_GRID_CELLS),  # Of the move batch per zone, 0 for none
+])
+
+RECORD = np.dtype([
+    ('do_id', '<u4'),
+    ('owner', '<u8'),
+    ('cell', '<i4'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+    ('h', '<f8'),
+    ('turn', '<f8'),
+    ('forward', '<f8'),
+    ('intent_seq', '<u2'),
+])
+
+
+class Checkpointer:
+    def __init__(self, interval=CHECKPOINT_INTERVAL):
+        self.interval = interval
+        self.path = None
+        self.doids = None
+        self.file = None  # np.memmap of the whole file
+        self.header = None
+        self.regions = None
+        self.replacing = False  # Whether `file` is a new file, to replace the one at `path` once complete
+        self.repo = None
+        self.restoring = {}  # do_id -> record of avatars whose AI was requested back
+        self.restoring_batches = {}  # do_id -> zone of move batches whose AI was requested back
+        self.restore_deadline = 0.0  # perf_counter() by which they're given up on
+        self.write_time = 0.0  # Seconds the last checkpoint took
+
+    def start(self, repo, shard):
+        self.path = CHECKPOINT_FILE % (shard.shard_id, )
+        self.doids = shard.doids
+        self.restore(repo, shard.channel)
+        AI_TASKS.add_task(self.write, priority=1000, divisor=max(int(self.interval * AI_FRAME_RATE), 1))
+
+    def open(self, capacity):
+        size = HEADER.itemsize + 2 * capacity * RECORD.itemsize
+        # Keep the previous checkpoint around until the first new one is complete
+        self.replacing = not (os.path.exists(self.path) and os.path.getsize(self.path) == size)
+        if self.replacing:
+            self.file = np.memmap(self.path + '.new', dtype=np.uint8, mode='w+', shape=(size, ))
+        else:
+            self.file = np.memmap(self.path, dtype=np.uint8, mode='r+', shape=(size, ))
+        self.header = self.file[:HEADER.itemsize].view(HEADER)[0:1]
+        records = self.file[HEADER.itemsize:].view(RECORD)
+        self.regions = (records[:capacity], records[capacity:])
+        if self.header['magic'][0] != CHECKPOINT_MAGIC:
+            self.header['active'] = 0
+        self.header['magic'] = CHECKPOINT_MAGIC
+        self.header['capacity'] = capacity
+        self.header['doid_range'] = (self.doids.min_id, self.doids.max_id)
+
+    def read(self):
+        """
+        Returns the records, allocator watermark and move batch doIds of the last
+        complete checkpoint, or None if there is none usable.
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER.itemsize:
+            return None
+        data = np.fromfile(self.path, dtype=np.uint8)
+        header = data[:HEADER.itemsize].view(HEADER)[0]
+        if header['magic'] != CHECKPOINT_MAGIC or tuple(header['doid_range']) != (self.doids.min_id, self.doids.max_id):
+            print("Checkpointer: ignoring %s, it's not a checkpoint of this shard" % (self.path, ))
+            return None
+        capacity, active = int(header['capacity']), int(header['active'])
+        if len(data) < HEADER.itemsize + 2 * capacity * RECORD.itemsize:
+            return None
+        region = data[HEADER.itemsize:].view(RECORD)[active * capacity:(active + 1) * capacity]
+        return (region[:int(header['count'][active])].copy(), int(header['next_fresh'][active]),
+                header['batch_ids'].tolist())
+
+    def restore(self, repo, channel):
+        started = perf_counter()
+        checkpoint = self.read()
+        if checkpoint is None:
+            return
+        self.repo = repo
+        records, next_fresh, batch_ids = checkpoint
+        self.doids.restore(next_fresh, records['do_id'].tolist() + [do_id for do_id in batch_ids if do_id])
+        for zone, do_id in enumerate(batch_ids):
+            if do_id:
+                self.restoring_batches[do_id] = zone
+                repo.send_STATESERVER_OBJECT_SET_AI(do_id, 0)
+                repo.send_STATESERVER_OBJECT_SET_AI(do_id, channel)
+        for record in records:
+            do_id = int(record['do_id'])
+            self.restoring[do_id] = record
+            # Off and back on, so the State Server sends the avatar's AI entry again
+            repo.send_STATESERVER_OBJECT_SET_AI(do_id, 0)
+            repo.send_STATESERVER_OBJECT_SET_AI(do_id, channel)
+        self.restore_deadline = perf_counter() + CHECKPOINT_RESTORE_TIMEOUT
+        print("Checkpointer: requested %d avatars and %d move batches back from %s in %.1f ms" %
+              (len(records), len(self.restoring_batches), self.path, (perf_counter() - started) * 1000.0))
+
+    def batch_zones(self):
+        # Zones whose move batch is being taken back, and needs no new one
+        return set(self.restoring_batches.values())
+
+    def expire(self):
+        # The objects that haven't come back by now are gone from the State Server.
+        print("Checkpointer: %d avatars and %d move batches of the checkpoint didn't come back" %
+              (len(self.restoring), len(self.restoring_batches)))
+        for do_id in list(self.restoring) + list(self.restoring_batches):
+            self.doids.free(do_id)
+        zones = sorted(self.restoring_batches.values())
+        self.restoring = {}
+        self.restoring_batches = {}
+        moves.create_batches(self.repo, self.doids, zones)
+
+    def adopt_batch(self, view):
+        # Called for every new DistributedMoveBatchAI
+        return self.restoring_batches.pop(view.do_id, None) is not None
+
+    def adopt(self, view):
+        """
+        Called for every new DistributedAvatarAI; if it's one taken back from the
+        checkpoint, puts it back into the state it was checkpointed in.
+        """
+        record = self.restoring.pop(view.do_id, None)
+        if record is None:
+            return False
+        slot = view.slot
+        engine.x[slot], engine.y[slot], engine.h[slot] = record['x'], record['y'], record['h']
+        engine.owner[slot] = record['owner']
+        engine.set_intent(slot, float(record['turn']), float(record['forward']), int(record['intent_seq']))
+        # The zone it's in on the State Server is the one its cell starts out as, see AvatarEngine.add()
+        grid.enter(view.repo, view.do_id, int(record['owner']), view.zone)
+        return True
+
+    def write(self, dt=None):
+        started = perf_counter()
+        if self.restoring and started > self.restore_deadline:
+            self.expire()
+        live = np.flatnonzero(engine.do_id[:engine.size])
+        if self.file is None or len(live) > int(self.header['capacity'][0]):
+            self.open(max(engine.capacity, len(live)))
+        header = self.header
+        target = 1 - int(header['active'][0])
+        region, count = self.regions[target], len(live)
+        region['do_id'][:count] = engine.do_id[live]
+        region['owner'][:count] = engine.owner[live]
+        region['cell'][:count] = engine.cell[live]
+        region['x'][:count] = engine.x[live]
+        region['y'][:count] = engine.y[live]
+        region['h'][:count] = engine.h[live]
+        region['turn'][:count] = engine.turn[live]
+        region['forward'][:count] = engine.forward[live]
+        region['intent_seq'][:count] = engine.intent_seq[live]
+        header['count'][0, target] = count
+        header['next_fresh'][0, target] = self.doids.next_fresh
+        # Including the batches still on their way back, so a crash before then doesn't lose them
+        batch_ids = np.zeros(WORLD_GRID_CELLS * WORLD_GRID_CELLS, dtype=np.uint32)
+        for zone, batch in moves.batches.items():
+            batch_ids[zone] = batch.do_id
+        for do_id, zone in self.restoring_batches.items():
+            batch_ids[zone] = do_id
+        header['batch_ids'][0] = batch_ids
+        self.file.flush()
+        # Only now that the new checkpoint is complete on disk, switch over to it
+        header['active'] = target
+        header['generation'] += 1
+        self.file.flush()
+        if self.replacing:
+            # The mapping follows the file to its new name
+            os.replace(self.path + '.new', self.path)
+            self.replacing = False
+        self.write_time = perf_counter() - started
+
+
+checkpoints = Checkpointer()
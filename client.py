@@ -1,9 +1,11 @@
 # FIXME: Insure that in the repo heartbeat is started/stopped.
 
+from assets import models
 from astron.object_repository import ClientRepository
 from direct.showbase.ShowBase import ShowBase
 from direct.task import Task
 from globals import *
+from receiver import BudgetedReceiver
 import sys
 
 
@@ -41,14 +43,20 @@ class SimpleClient(ShowBase):
         """
 
         self.repo = ClientRepository(VERSION_STRING, DC_FILE)
+        self.receiver = None  # Reads the repository's datagrams once connected
         self.notify.info("Connecting...")
         self.repo.connect(self.connection_success, self.connection_failure, self.connection_eject,
                           host=CA_HOST, port=CA_PORT)
         # set task to poll datagrams every frame
         self.task_mgr.add(self.poll_datagrams, 'poll datagrams')
+        # and to move the avatar by the current intent after that
+        self.task_mgr.add(self.predict_avatar, 'predict avatar', sort=1)
 
     def poll_datagrams(self, task):
-        self.repo.poll_till_empty()
+        if self.receiver:
+            self.receiver.poll()
+        else:
+            self.repo.poll_till_empty()
         return Task.cont
 
     #
@@ -60,6 +68,7 @@ class SimpleClient(ShowBase):
     # the connection and actually interacting with the server.
     def connection_success(self):
         self.notify.info("Connected!")
+        self.receiver = BudgetedReceiver(self.repo)
         self.client_is_handshaked()
 
     def connection_failure(self):
@@ -82,12 +91,16 @@ class SimpleClient(ShowBase):
     # Client has received CLIENT_HELLO_RESP and now is in state UNKNOWN.
     def client_is_handshaked(self):
         anonymous_contact = self.repo.create_distobjglobal_view("AnonymousContact", AnonymousContactID)
-        # Attach map to scene graph
-        self.map = self.loader.load_model("./resources/map.egg")
-        self.map.reparent_to(self.render)
+        # Load the map and avatar models in the background while logging in
+        self.map = None
+        models.preload(self.loader, callback=self.attach_map)
         # Log in and receive; leads to enter_owner (ownership of avatar)
         anonymous_contact.login("guest", "guest")
 
+    # Attach map to scene graph
+    def attach_map(self):
+        self.map = models.acquire(MAP_MODEL, self.render)
+
     def avatar_leaves(self, do_id):
         self.notify.info("Avatar leaving: " + str(do_id))
 
@@ -98,7 +111,7 @@ class SimpleClient(ShowBase):
     # Interface
     #
 
-    # Adjust current intention and send it.
+    # Adjust current intention; it is sampled and sent once per frame.
     def indicate_movement(self, heading, speed):
         if self.avatar_ov and self.avatar_ready:
             # FIXME: Not really graceful to just ignore this.
@@ -106,10 +119,14 @@ class SimpleClient(ShowBase):
 
             self.movement_heading += heading
             self.movement_speed += speed
-            self.avatar_ov.indicate_intent(self.movement_heading, self.movement_speed)
         else:
             print("Avatar not complete yet!")
 
+    def predict_avatar(self, task):
+        if self.avatar_ov and self.avatar_ready:
+            self.avatar_ov.predict(self.movement_heading, self.movement_speed, globalClock.get_dt())
+        return Task.cont
+
     # A DistributedAvatarOV was created, here is it.
     def get_avatar(self, owner_view):
         print("Received DistributedAvatarOV in client")
@@ -0,0 +1,159 @@
+from globals import *
+import hashlib
+import marshal
+import os
+
+"""
+Index of the distributed classes and fields of a DC file.
+
+This only reads what the tools around the repositories need to make sense of raw
+datagrams (numbers, names, keywords and argument types of classes and fields), not
+how to pack fields; packing is left to the repositories. Like Astron, classes and
+structs are numbered in declaration order, and fields are numbered in declaration
+order across the whole file, with inherited fields keeping the number of their
+declaration.
+
+A parsed index is cached next to the DC file (DC_CACHE_FILE) in marshal format, keyed
+on the SHA-256 of the DC file, which covers its import list as well. When the file
+changes, the next process to load it parses it again, and replaces the cache.
+The cache is only for the users of this index (the client's receiver, metrics,
+local_cluster.py and bench.py); it doesn't make the repositories start any faster,
+as they parse the DC file with Astron's own parser, which can't be handed an index.
+"""
+
+DC_CACHE_VERSION = 2  # Bump when the format of the cached index changes
+
+# Packed sizes of the fixed size types; strings and blobs are a uint16 length and their bytes
+TYPE_SIZES = {
+    'int8': 1, 'uint8': 1, 'char': 1, 'bool': 1,
+    'int16': 2, 'uint16': 2,
+    'int32': 4, 'uint32': 4, 'float32': 4,
+    'int64': 8, 'uint64': 8, 'float64': 8,
+}
+
+
+class DCField:
+    def __init__(self, number, name, dclass, keywords, types=()):
+        self.number = number
+        self.name = name
+        self.dclass = dclass
+        self.keywords = keywords
+        self.types = types  # Of the arguments, with typedefs resolved
+
+    def size(self, args):
+        # Packed size of an update of this field with `args`
+        return sum(TYPE_SIZES[kind] if kind in TYPE_SIZES else 2 + len(arg.encode('utf-8') if isinstance(arg, str) else arg)
+                   for kind, arg in zip(self.types, args))
+
+    def __repr__(self):
+        return "<DCField %d %s.%s>" % (self.number, self.dclass, self.name)
+
+
+class DCIndex:
+    def __init__(self, dc_file=DC_FILE):
+        self.classes = []  # Class names by number
+        self.class_numbers = {}  # Class name -> number
+        self.class_fields = {}  # Class name -> {field name: DCField}, including inherited fields
+        self.fields = []  # DCField by number
+        self.imports = []  # (module, [symbols]) of the `from x import y` lines
+        with open(dc_file, 'rb') as f:
+            source = f.read()
+        key = '%d:%s' % (DC_CACHE_VERSION, hashlib.sha256(source).hexdigest())
+        cache_file = DC_CACHE_FILE % (dc_file, )
+        if not self.load(cache_file, key):
+            self.parse(source.decode('utf-8'))
+            self.save(cache_file, key)
+
+    def load(self, cache_file, key):
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = marshal.loads(f.read())
+            if cached['key'] != key:
+                return False
+            self.classes = cached['classes']
+            self.fields = [DCField(number, name, dclass, keywords, types)
+                           for number, (name, dclass, keywords, types) in enumerate(cached['fields'])]
+            self.class_fields = {name: {self.fields[number].name: self.fields[number] for number in numbers}
+                                 for name, numbers in cached['class_fields'].items()}
+            self.imports = [(module, symbols) for module, symbols in cached['imports']]
+        except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+            return False
+        self.class_numbers = {name: number for number, name in enumerate(self.classes)}
+        return True
+
+    def save(self, cache_file, key):
+        cached = {
+            'key': key,
+            'classes': self.classes,
+            'fields': [(field.name, field.dclass, field.keywords, field.types) for field in self.fields],
+            'class_fields': {name: [field.number for field in fields.values()]
+                             for name, fields in self.class_fields.items()},
+            'imports': self.imports,
+        }
+        # Written aside and renamed, so other processes never load a half written cache
+        partial = '%s.%d.tmp' % (cache_file, os.getpid())
+        try:
+            with open(partial, 'wb') as f:
+                marshal.dump(cached, f)
+            os.replace(partial, cache_file)
+        except OSError:
+            pass  # e.g. a read-only checkout; just parse every time
+
+    def parse(self, source):
+        import re  # Only needed when the cache misses
+        source = re.sub(r'//[^\n]*|/\*.*?\*/', '', source, flags=re.S)
+        self.typedefs = dict((alias, kind) for kind, alias in re.findall(r'\btypedef\s+(\w+)\s+(\w+)\s*;', source))
+        for module, symbols in re.findall(r'from\s+([\w.]+)\s+import\s+([^\n;]+)', source):
+            self.imports.append((module, [symbol.strip() for symbol in symbols.split(',')]))
+        for kind, name, parents, body in re.findall(
+                r'\b(dclass|struct)\s+(\w+)\s*(?::\s*([\w\s,]+?))?\s*\{(.*?)\}\s*;', source, flags=re.S):
+            self.class_numbers[name] = len(self.classes)
+            self.classes.append(name)
+            fields = {}
+            for parent in (parents or '').split(','):
+                fields.update(self.class_fields.get(parent.strip(), {}))
+            for declaration in body.split(';'):
+                field = self.parse_field(name, declaration.strip())
+                if field is not None:
+                    fields[field.name] = field
+            self.class_fields[name] = fields
+
+    def parse_field(self, dclass, declaration):
+        if not declaration:
+            return None
+        if '(' in declaration:
+            # Atomic field: name(args) keywords
+            name = declaration[:declaration.index('(')].split()[-1]
+            keywords = declaration[declaration.rindex(')') + 1:].split()
+            args = declaration[declaration.index('(') + 1:declaration.rindex(')')]
+            types = [arg.split()[0] for arg in args.split(',') if arg.strip()]
+        elif ':' in declaration:
+            # Molecular field: name : field, field
+            name, keywords, types = declaration[:declaration.index(':')].strip(), [], []
+        else:
+            # Parameter field: type name [= default] keywords
+            words = declaration.split('=')[0].split()
+            name, keywords, types = words[1], words[2:], words[:1]
+            if '=' in declaration:
+                keywords = declaration.split('=', 1)[1].split()[1:]
+        types = [self.typedefs.get(kind, kind) for kind in types]
+        field = DCField(len(self.fields), name, dclass, keywords, types)
+        self.fields.append(field)
+        return field
+
+    def field(self, dclass, name):
+        return self.class_fields[dclass][name]
+
+    def field_number(self, dclass, name):
+        return self.class_fields[dclass][name].number
+
+
+index = None
+
+
+def get_index():
+    # Parsed on first use only; most processes never need it.
+    global index
+    if index is None:
+        index = DCIndex()
+    return index
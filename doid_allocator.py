@@ -0,0 +1,83 @@
+"""
+Allocation of doIds out of a fixed range.
+
+Ids that were never handed out are tracked by a single watermark, ids given back by
+`free()` go on a free list to be reused first, and a bitmap with one bit per id
+guards against double frees. Allocating and freeing are both O(1).
+
+A contiguous block of never-used ids can be leased off an allocator as an allocator
+of its own, which is how every Services shard gets a range to allocate from without
+asking anyone else.
+"""
+
+
+class DoIdAllocator:
+    def __init__(self, min_id, max_id):
+        self.min_id = min_id
+        self.max_id = max_id
+        self.next_fresh = min_id  # Every id from here to max_id has never been handed out
+        self.free_ids = []
+        self.used = bytearray((max_id - min_id) // 8 + 1)
+
+    def __len__(self):
+        # Ids currently handed out
+        return (self.next_fresh - self.min_id) - len(self.free_ids)
+
+    def is_used(self, do_id):
+        offset = do_id - self.min_id
+        return bool(self.used[offset >> 3] & (1 << (offset & 7)))
+
+    def mark(self, do_id, used):
+        offset = do_id - self.min_id
+        if used:
+            self.used[offset >> 3] |= 1 << (offset & 7)
+        else:
+            self.used[offset >> 3] &= ~(1 << (offset & 7))
+
+    def allocate(self):
+        if self.free_ids:
+            do_id = self.free_ids.pop()
+        elif self.next_fresh <= self.max_id:
+            do_id = self.next_fresh
+            self.next_fresh += 1
+        else:
+            raise RuntimeError("doId range %d-%d is exhausted" % (self.min_id, self.max_id))
+        self.mark(do_id, True)
+        return do_id
+
+    def free(self, do_id):
+        if not (self.min_id <= do_id <= self.max_id) or not self.is_used(do_id):
+            print("DoIdAllocator: ignoring free of unallocated doId %d" % (do_id, ))
+            return
+        self.mark(do_id, False)
+        self.free_ids.append(do_id)
+
+    def used_ids(self):
+        # Ids currently handed out, lowest first
+        return [self.min_id + offset
+                for offset in range(self.next_fresh - self.min_id)
+                if self.used[offset >> 3] & (1 << (offset & 7))]
+
+    def restore(self, next_fresh, used_ids, free_ids=()):
+        """
+        Resumes where an allocator of the same range left off before a restart, with
+        `used_ids` still handed out. Ids below `next_fresh` are never handed out again,
+        other than `used_ids` once they are freed, and `free_ids`, which are handed out
+        first, in the same order as by the allocator they're from.
+        """
+        self.next_fresh = min(max(self.next_fresh, next_fresh), self.max_id + 1)
+        for do_id in used_ids:
+            if self.min_id <= do_id < self.next_fresh:
+                self.mark(do_id, True)
+        self.free_ids += [do_id for do_id in free_ids
+                          if self.min_id <= do_id < self.next_fresh and not self.is_used(do_id)]
+
+    def lease(self, size):
+        """
+        Hands a block of `size` never-used ids over to a new allocator.
+        """
+        if self.next_fresh + size - 1 > self.max_id:
+            raise RuntimeError("doId range %d-%d can't lease a block of %d" % (self.min_id, self.max_id, size))
+        block = DoIdAllocator(self.next_fresh, self.next_fresh + size - 1)
+        self.next_fresh += size
+        return block
@@ -1,7 +1,69 @@
+from scheduler import TickScheduler
+
 VERSION_STRING = 'libastron Example v1.0'
 DC_FILE = 'example.dc'
+DC_CACHE_FILE = '%s.cache'  # Of the parsed DC file, see dcfields.py
 AI_FRAME_RATE = 30.0
-AI_TASKS = []
+AI_MAX_CATCHUP_FRAMES = 5  # Frames' worth of time the frame after an overrun may make up for
+AI_TASKS = TickScheduler(AI_FRAME_RATE, AI_MAX_CATCHUP_FRAMES)
+AI_MAX_SEND_RATE = 15.0  # Max field updates per second per object; 0 for no limit
+AI_ACK_INTERVAL = 1.0  # Seconds between corrections of a moving avatar's prediction, besides acks of its intents
+
+# Instrumentation of the Services frame (see metrics.py)
+METRICS_ENABLED = True
+METRICS_SNAPSHOT_FILE = 'services_metrics_%d.txt'  # Per shard id
+METRICS_SNAPSHOT_INTERVAL = 10.0  # Seconds
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0  # Port to serve the metrics as text over HTTP on, plus the shard id; 0 to not serve them
+
+# Warm restarts of the Services (see checkpoint.py)
+CHECKPOINT_ENABLED = True
+CHECKPOINT_FILE = 'services_checkpoint_%d.bin'  # Per shard id
+CHECKPOINT_INTERVAL = 1.0  # Seconds
+CHECKPOINT_RESTORE_TIMEOUT = 10.0  # Seconds to wait for checkpointed avatars to come back after a restart
+
+# Capture of received datagrams for replay.py (see capture.py)
+CAPTURE_ENABLED = False
+CAPTURE_FILE = 'services_capture_%d.bin'  # Per shard id
+
+# Avatars
+avatar_speed = 3.0
+avatar_rotation_speed = 90.0
+pos_float_accuracy = 3
+AVATAR_ENGINE_CAPACITY = 1024  # Initial slot count; doubles when full
+
+# Authentication
+AUTH_WORKERS = 4  # Threads verifying credentials off the server frame
+AUTH_BATCH_SIZE = 64  # Max logins verified per credential store call
+AUTH_CACHE_TTL = 300.0  # Seconds a successful verification is remembered
+AUTH_CACHE_SIZE = 10000  # Max remembered verifications
+
+# World
+WORLD_MIN, WORLD_MAX = -10.0, 10.0  # Avatars are kept within (WORLD_MIN <= x, y <= WORLD_MAX)
+WORLD_GRID_CELLS = 4  # The world is split into this many interest cells per side
+WORLD_GRID_HYSTERESIS = 1.0  # How far past a cell border an avatar goes before changing zone
+
+# Movement encoding (see movement.py); 2 * MOVE_XY_BITS + MOVE_H_BITS must fit into a uint32
+MOVE_XY_BITS = 12  # Per axis, across the map
+MOVE_H_BITS = 8  # Over the full circle
+MOVE_KEYFRAME_INTERVAL = 15  # Max deltas sent after a full move of an avatar
+MOVE_BATCHING = True  # Send the moves of a shard's avatars per zone in one batch update
+MOVE_BATCH_SIZE = 1024  # Max keyframes (and deltas) per batch update
+MOVE_REFRESH_DELAY = 0.1  # Seconds after an owner's interest gained a zone until its avatars are sent again as keyframes
+MOVE_IDLE_KEYFRAME_INTERVAL = 5.0  # Seconds between keyframes of an avatar standing still
+
+# Client smoothing of avatar movement (see smoothing.py)
+CLIENT_RENDER_DELAY = 0.15  # Seconds avatars are drawn in the past; keep above 2 / AI_MAX_SEND_RATE
+CLIENT_MAX_EXTRAPOLATION = 0.1  # Seconds to keep moving an avatar past its newest position
+CLIENT_SAMPLE_BUFFER = 16  # Positions kept per avatar
+CLIENT_PREDICTION_HISTORY = 600  # Frames of input kept for replay; covers the longest round trip expected
+CLIENT_INTENT_REFRESH = 30.0  # Seconds a held intent is sent again after; keep well below 65.535 (uint16 ms of an ack)
+CLIENT_RECEIVE_BUDGET = 0.004  # Seconds per frame the client may spend handling datagrams
+CLIENT_RECEIVE_BATCH = 8  # Datagrams handed to the repository between checks of the budget
+MAP_MODEL = "./resources/map.egg"
+AVATAR_MODEL = "./resources/smiley.egg"
+CLIENT_PRELOAD_MODELS = [MAP_MODEL, AVATAR_MODEL]  # Loaded in the background while logging in
+CLIENT_MODEL_POOL_SIZE = 64  # Detached nodes kept per model for reuse
 
 # Network
 CA_HOST = "127.0.0.1"
@@ -9,7 +71,8 @@ CA_PORT = 6667
 MD_HOST = "127.0.0.1"
 MD_PORT = 7199
 # Channels
-ServicesChannel = 300000
+ServicesChannel = 300000  # Shard n of the Services uses ServicesChannel + n as its AI channel
+SERVICES_SHARDS = 1  # Number of Services processes to spread the AI simulation over
 SSChannel = 402000
 # Static IDs
 AnonymousContactID = 20000
@@ -17,6 +80,9 @@ RootID = 30000
 # Root Zones
 LOGIN_ZONE = 0
 WORLD_ZONE = 1
-# TODO: Temp; libastron.python can't allocate random doIDs
+# TODO: Temp; libastron.python can't allocate random doIDs.
+# These must stay outside of the dynamically allocated doId ranges below.
 LoginManagerId = 1562641
 DistributedWorldId = 1562642
+# Dynamic doIds; split evenly between the Services shards
+AVATAR_DOID_MIN, AVATAR_DOID_MAX = 1000000, 1499999
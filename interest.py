@@ -0,0 +1,79 @@
+from globals import *
+import numpy as np
+
+"""
+Area of interest for the DistributedWorld.
+
+The map is split into a grid of WORLD_GRID_CELLS x WORLD_GRID_CELLS cells, and the
+zone of every cell under the world is simply its cell index (row-major). Avatars
+live in the zone of the cell they stand in, and every owning client is interested
+in its avatar's cell plus the eight cells around it, so it only receives updates
+from avatars nearby. An avatar only changes cells once it is more than
+WORLD_GRID_HYSTERESIS past the border of its current cell, so walking along a
+border doesn't make it, or its owner's interest, flip back and forth. The zones an
+owner's interest gains are kept in `gained`, for the AvatarEngine to send the
+avatars standing there again (see movement.py).
+"""
+
+
+class InterestGrid:
+    def __init__(self, cells=WORLD_GRID_CELLS, hysteresis=WORLD_GRID_HYSTERESIS):
+        self.cells = cells
+        self.cell_size = (WORLD_MAX - WORLD_MIN) / float(cells)
+        self.hysteresis = hysteresis
+        self.owners = {}  # avatar do_id -> owning client channel
+        self.interests = {}  # owning client channel -> zones it's interested in
+        self.gained = set()  # Zones that came into some owner's interest since the AvatarEngine last took them
+
+    def cell_at(self, x, y):
+        return int(self.cells_at(np.array([x]), np.array([y]))[0])
+
+    def cells_at(self, x, y):
+        cx = np.clip(np.floor((x - WORLD_MIN) / self.cell_size), 0, self.cells - 1).astype(np.intp)
+        cy = np.clip(np.floor((y - WORLD_MIN) / self.cell_size), 0, self.cells - 1).astype(np.intp)
+        return cy * self.cells + cx
+
+    def neighbour_zones(self, cell):
+        cx, cy = cell % self.cells, cell // self.cells
+        return [ny * self.cells + nx
+                for ny in range(max(cy - 1, 0), min(cy + 2, self.cells))
+                for nx in range(max(cx - 1, 0), min(cx + 2, self.cells))]
+
+    def crossed(self, x, y, cell, idx):
+        """
+        Of the slots `idx` of the engine arrays, returns the ones that left their
+        cell beyond the hysteresis margin, along with the cells they are now in.
+        """
+        c = cell[idx]
+        lo_x = WORLD_MIN + (c % self.cells) * self.cell_size - self.hysteresis
+        lo_y = WORLD_MIN + (c // self.cells) * self.cell_size - self.hysteresis
+        span = self.cell_size + 2.0 * self.hysteresis
+        px, py = x[idx], y[idx]
+        out = (px < lo_x) | (px > lo_x + span) | (py < lo_y) | (py > lo_y + span)
+        if not out.any():
+            return idx[:0], idx[:0]
+        return idx[out], self.cells_at(px[out], py[out])
+
+    def enter(self, repo, do_id, client_id, cell):
+        self.owners[do_id] = client_id
+        self.set_interest(repo, client_id, cell)
+
+    def leave(self, do_id):
+        self.interests.pop(self.owners.pop(do_id, None), None)
+
+    def relocate(self, view, cell):
+        view.repo.send_STATESERVER_OBJECT_SET_LOCATION(view.do_id, DistributedWorldId, cell)
+        view.zone = cell
+        client_id = self.owners.get(view.do_id)
+        if client_id is not None:
+            self.set_interest(view.repo, client_id, cell)
+
+    def set_interest(self, repo, client_id, cell):
+        # Re-adding interest_id 0 replaces the client's previous set of zones.
+        zones = self.neighbour_zones(cell)
+        repo.send_CLIENTAGENT_ADD_INTEREST_MULTIPLE(client_id, 0, DistributedWorldId, zones)
+        self.gained.update(set(zones) - self.interests.get(client_id, set()))
+        self.interests[client_id] = set(zones)
+
+
+grid = InterestGrid()
@@ -0,0 +1,561 @@
+from dcfields import get_index
+from globals import *
+from wire import *
+import asyncio
+import threading
+
+"""
+In-process stand-in for the Astron cluster described in astrond.yml.
+
+It speaks enough of the Message Director, State Server and Client Agent protocols
+for `InterestInternalRepository` and `ClientRepository` to connect to it over
+localhost: channel subscriptions and post-removes, object creation, location, AI and
+ownership, field updates routed by their DC keywords and fanned out to interested
+clients, client interest, session objects and ejects. It's meant for repeatable
+benchmarks and tests on a plain machine, not as a server: there's no database, no
+event logger, and required field values are stored as sent at creation time.
+
+Usage: local_cluster.py   (serves on MD_HOST:MD_PORT and CA_HOST:CA_PORT until killed)
+   or: cluster = LocalCluster(); cluster.start(); ...; cluster.stop()
+"""
+
+# Client states, as set through CLIENTAGENT_SET_STATE
+CLIENT_STATE_NEW = 0
+CLIENT_STATE_ANONYMOUS = 1
+CLIENT_STATE_ESTABLISHED = 2
+
+# UberDOGs clients may talk to, by doId -> whether anonymous clients may too
+UBERDOGS = {AnonymousContactID: True}
+CLIENT_CHANNEL_MIN, CLIENT_CHANNEL_MAX = 100100, 299999
+
+
+class Participant:
+    """
+    Something connected to the Message Director, that datagrams get routed to.
+    """
+    def __init__(self, md):
+        self.md = md
+        self.sender = 0  # Sender of datagrams originating here, unless given
+        self.channels = set()
+        self.ranges = []
+        self.post_removes = []
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        self.md.channels.setdefault(channel, set()).add(self)
+
+    def unsubscribe(self, channel):
+        self.channels.discard(channel)
+        subscribers = self.md.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.md.channels[channel]
+
+    def unsubscribe_all(self):
+        for channel in list(self.channels):
+            self.unsubscribe(channel)
+        self.ranges = []
+        self.md.participants.discard(self)
+
+    def wants(self, channel):
+        return any(low <= channel <= high for low, high in self.ranges)
+
+    def deliver(self, datagram):
+        raise NotImplementedError
+
+    def send(self, recipients, msgtype, body=b'', sender=None):
+        datagram = internal_datagram(recipients, self.sender if sender is None else sender, msgtype)
+        self.md.route(datagram.raw(body).data(), origin=self)
+
+
+class MessageDirector:
+    def __init__(self):
+        self.channels = {}  # channel -> set of subscribed Participants
+        self.participants = set()  # Participants with channel ranges
+        self.routed = 0
+
+    def route(self, datagram, origin=None):
+        recipients, _, _, _ = read_internal_header(datagram)
+        targets = set()
+        for channel in recipients:
+            targets.update(self.channels.get(channel, ()))
+            for participant in self.participants:
+                if participant.wants(channel):
+                    targets.add(participant)
+        targets.discard(origin)
+        for target in targets:
+            target.deliver(datagram)
+        self.routed += 1
+
+
+class RemoteParticipant(Participant):
+    """
+    A repository connected to the Message Director over TCP.
+    """
+    def __init__(self, md, writer):
+        Participant.__init__(self, md)
+        self.writer = writer
+
+    def deliver(self, datagram):
+        self.writer.write(frame(datagram))
+
+    def handle(self, datagram):
+        recipients, sender, msgtype, reader = read_internal_header(datagram)
+        if sender is not None:
+            self.md.route(datagram, origin=self)
+        elif msgtype == CONTROL_ADD_CHANNEL:
+            self.subscribe(reader.uint64())
+        elif msgtype == CONTROL_REMOVE_CHANNEL:
+            self.unsubscribe(reader.uint64())
+        elif msgtype == CONTROL_ADD_RANGE:
+            self.ranges.append((reader.uint64(), reader.uint64()))
+            self.md.participants.add(self)
+        elif msgtype == CONTROL_REMOVE_RANGE:
+            low_high = (reader.uint64(), reader.uint64())
+            self.ranges = [r for r in self.ranges if r != low_high]
+        elif msgtype == CONTROL_ADD_POST_REMOVE:
+            reader.uint64()  # sender
+            self.post_removes.append(reader.blob())
+        elif msgtype == CONTROL_CLEAR_POST_REMOVES:
+            self.post_removes = []
+        # CONTROL_SET_CON_NAME, CONTROL_SET_CON_URL and CONTROL_LOG_MESSAGE are accepted and ignored.
+
+    def disconnected(self):
+        self.unsubscribe_all()
+        for datagram in self.post_removes:
+            self.md.route(datagram, origin=self)
+
+
+class StateObject:
+    def __init__(self, do_id, parent, zone, dclass, fields, other):
+        self.do_id = do_id
+        self.parent, self.zone = parent, zone
+        self.dclass = dclass
+        self.fields = fields  # Packed required (and, if `other`, other) fields, as sent
+        self.other = other
+        self.ai, self.ai_explicit = 0, False
+        self.owner = 0
+        self.children = set()
+
+    def body(self):
+        return (DatagramWriter().uint32(self.do_id).uint32(self.parent).uint32(self.zone)
+                .uint16(self.dclass).raw(self.fields).data())
+
+
+class StateServer(Participant):
+    def __init__(self, md, control=SSChannel):
+        Participant.__init__(self, md)
+        self.control = control
+        self.objects = {}
+        self.dc = get_index()
+        self.subscribe(control)
+
+    def deliver(self, datagram):
+        recipients, sender, msgtype, reader = read_internal_header(datagram)
+        body = reader.offset
+        for channel in recipients:
+            reader.offset = body  # Every recipient reads the body from its start
+            if channel == self.control:
+                self.handle_control(sender, msgtype, reader)
+            elif channel in self.objects:
+                self.handle_object(self.objects[channel], datagram, recipients, sender, msgtype, reader)
+
+    def handle_control(self, sender, msgtype, reader):
+        if msgtype in (STATESERVER_CREATE_OBJECT_WITH_REQUIRED, STATESERVER_CREATE_OBJECT_WITH_REQUIRED_OTHER):
+            do_id, parent, zone, dclass = reader.uint32(), reader.uint32(), reader.uint32(), reader.uint16()
+            if do_id in self.objects:
+                print("LocalCluster: ignoring creation of existing object %d" % (do_id, ))
+                return
+            obj = StateObject(do_id, parent, zone, dclass, reader.remainder(),
+                              msgtype == STATESERVER_CREATE_OBJECT_WITH_REQUIRED_OTHER)
+            self.objects[do_id] = obj
+            self.subscribe(do_id)
+            parent_obj = self.objects.get(parent)
+            if parent_obj is not None:
+                parent_obj.children.add(do_id)
+                if parent_obj.ai:
+                    self.set_ai(obj, parent_obj.ai, explicit=False)
+            self.enter_location(obj)
+        elif msgtype == STATESERVER_DELETE_AI_OBJECTS:
+            ai = reader.uint64()
+            for obj in [obj for obj in self.objects.values() if obj.ai == ai]:
+                if obj.do_id in self.objects:  # Not already gone with its parent
+                    self.delete(obj)
+
+    def handle_object(self, obj, datagram, recipients, sender, msgtype, reader):
+        do_id = obj.do_id
+        if msgtype == STATESERVER_OBJECT_SET_FIELD:
+            reader.uint32()
+            field = self.dc.fields[reader.uint16()]
+            targets = []
+            if 'broadcast' in field.keywords:
+                targets.append(location_channel(obj.parent, obj.zone))
+            if 'airecv' in field.keywords and obj.ai and obj.ai != sender:
+                targets.append(obj.ai)
+            if 'ownrecv' in field.keywords and obj.owner and obj.owner != sender:
+                targets.append(obj.owner)
+            if targets:
+                body = datagram[reader.offset - 6:]  # doId and field number onwards
+                self.send(targets, STATESERVER_OBJECT_SET_FIELD, body, sender=sender)
+        elif msgtype == STATESERVER_OBJECT_SET_LOCATION:
+            self.set_location(obj, reader.uint32(), reader.uint32())
+        elif msgtype == STATESERVER_OBJECT_SET_AI:
+            self.set_ai(obj, reader.uint64(), explicit=True)
+        elif msgtype == STATESERVER_OBJECT_SET_OWNER:
+            owner = reader.uint64()
+            if obj.owner:
+                body = DatagramWriter().uint32(do_id).uint64(owner).uint64(obj.owner).data()
+                self.send([obj.owner], STATESERVER_OBJECT_CHANGING_OWNER, body, sender=do_id)
+            obj.owner = owner
+            if owner:
+                self.send([owner], STATESERVER_OBJECT_ENTER_OWNER_WITH_REQUIRED_OTHER if obj.other else
+                          STATESERVER_OBJECT_ENTER_OWNER_WITH_REQUIRED, obj.body(), sender=do_id)
+        elif msgtype == STATESERVER_OBJECT_DELETE_RAM:
+            self.delete(obj)
+        elif msgtype == STATESERVER_OBJECT_GET_ZONES_OBJECTS:
+            context, _ = reader.uint32(), reader.uint32()  # The parent is the object itself
+            zones = set(reader.uint32() for _ in range(reader.uint16()))
+            found = [self.objects[child] for child in obj.children if self.objects[child].zone in zones]
+            self.send([sender], STATESERVER_OBJECT_GET_ZONES_COUNT_RESP,
+                      DatagramWriter().uint32(context).uint32(len(found)).data(), sender=do_id)
+            for child in found:
+                self.send([sender], STATESERVER_OBJECT_ENTER_INTEREST_WITH_REQUIRED_OTHER if child.other else
+                          STATESERVER_OBJECT_ENTER_INTEREST_WITH_REQUIRED,
+                          DatagramWriter().uint32(context).raw(child.body()).data(), sender=child.do_id)
+
+    def enter_location(self, obj):
+        self.send([location_channel(obj.parent, obj.zone)], STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER
+                  if obj.other else STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED, obj.body(), sender=obj.do_id)
+
+    def set_location(self, obj, parent, zone):
+        old_parent, old_zone = obj.parent, obj.zone
+        if (parent, zone) == (old_parent, old_zone):
+            return
+        if old_parent in self.objects:
+            self.objects[old_parent].children.discard(obj.do_id)
+        obj.parent, obj.zone = parent, zone
+        if parent in self.objects:
+            self.objects[parent].children.add(obj.do_id)
+        body = DatagramWriter().uint32(obj.do_id).uint32(parent).uint32(zone).uint32(old_parent).uint32(old_zone)
+        targets = [location_channel(old_parent, old_zone)] + [c for c in (obj.ai, obj.owner) if c]
+        self.send(targets, STATESERVER_OBJECT_CHANGING_LOCATION, body.data(), sender=obj.do_id)
+        self.enter_location(obj)
+
+    def set_ai(self, obj, ai, explicit):
+        if obj.ai == ai:
+            obj.ai_explicit = obj.ai_explicit or explicit
+            return
+        if obj.ai:
+            body = DatagramWriter().uint32(obj.do_id).uint64(ai).uint64(obj.ai).data()
+            self.send([obj.ai], STATESERVER_OBJECT_CHANGING_AI, body, sender=obj.do_id)
+        obj.ai, obj.ai_explicit = ai, explicit
+        # An AI of 0 leaves the object without one, until it's set again
+        if ai:
+            self.send([ai], STATESERVER_OBJECT_ENTER_AI_WITH_REQUIRED_OTHER if obj.other else
+                      STATESERVER_OBJECT_ENTER_AI_WITH_REQUIRED, obj.body(), sender=obj.do_id)
+        # Children that didn't get an AI of their own follow their parent's
+        for child in obj.children:
+            child = self.objects[child]
+            if not child.ai_explicit:
+                self.set_ai(child, ai, explicit=False)
+
+    def delete(self, obj):
+        for child in list(obj.children):
+            if child in self.objects:
+                self.delete(self.objects[child])
+        del self.objects[obj.do_id]
+        self.unsubscribe(obj.do_id)
+        if obj.parent in self.objects:
+            self.objects[obj.parent].children.discard(obj.do_id)
+        targets = [location_channel(obj.parent, obj.zone)] + [c for c in (obj.ai, obj.owner) if c]
+        self.send(targets, STATESERVER_OBJECT_DELETE_RAM, DatagramWriter().uint32(obj.do_id).data(),
+                  sender=obj.do_id)
+
+
+class ClientConnection(Participant):
+    def __init__(self, ca, channel, writer):
+        Participant.__init__(self, ca.md)
+        self.ca = ca
+        self.channel = self.sender = channel
+        self.writer = writer
+        self.state = CLIENT_STATE_NEW
+        self.interests = {}  # interest_id -> (parent, set of zones)
+        self.visible = {}  # doId -> location channel it was seen in
+        self.owned = set()
+        self.session_objects = set()
+        self.next_context = 0
+        self.closed = False
+        self.subscribe(channel)
+
+    def send_client(self, writer):
+        if not self.closed:
+            self.writer.write(frame(writer.data()))
+
+    def eject(self, reason, message):
+        self.send_client(client_datagram(CLIENT_EJECT).uint16(reason).string(message))
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        self.unsubscribe_all()
+        for do_id in self.session_objects:
+            self.send([do_id], STATESERVER_OBJECT_DELETE_RAM, DatagramWriter().uint32(do_id).data())
+
+    # From the client
+
+    def handle(self, datagram):
+        reader = DatagramReader(datagram)
+        msgtype = reader.uint16()
+        if msgtype == CLIENT_HELLO:
+            reader.uint32()  # DC hash; not checked, like manual_dc_hash
+            if reader.string() != VERSION_STRING:
+                self.eject(124, "Client version mismatch")
+                return
+            self.state = CLIENT_STATE_ANONYMOUS
+            self.send_client(client_datagram(CLIENT_HELLO_RESP))
+        elif self.state == CLIENT_STATE_NEW:
+            self.eject(107, "First datagram is not CLIENT_HELLO")
+        elif msgtype == CLIENT_OBJECT_SET_FIELD:
+            do_id, number = reader.uint32(), reader.uint16()
+            if not self.may_send(do_id, number):
+                self.eject(113, "Client tried to send update to non-sendable field %d of %d" % (number, do_id))
+                return
+            self.send([do_id], STATESERVER_OBJECT_SET_FIELD, datagram[2:])
+        elif msgtype == CLIENT_DISCONNECT:
+            self.close()
+        elif msgtype in (CLIENT_ADD_INTEREST, CLIENT_ADD_INTEREST_MULTIPLE, CLIENT_REMOVE_INTEREST):
+            self.eject(115, "Client is not allowed to manage its interests")  # add_interest: disabled
+        # CLIENT_HEARTBEAT and CLIENT_OBJECT_LOCATION need no handling here.
+
+    def may_send(self, do_id, number):
+        field = self.ca.dc.fields[number] if number < len(self.ca.dc.fields) else None
+        if field is None:
+            return False
+        if self.state != CLIENT_STATE_ESTABLISHED:
+            return UBERDOGS.get(do_id, False) and 'clsend' in field.keywords
+        if 'ownsend' in field.keywords and do_id in self.owned:
+            return True
+        return 'clsend' in field.keywords and (do_id in self.visible or do_id in self.owned or do_id in UBERDOGS)
+
+    # From the cluster
+
+    def deliver(self, datagram):
+        recipients, sender, msgtype, reader = read_internal_header(datagram)
+        if msgtype == STATESERVER_OBJECT_SET_FIELD:
+            do_id = reader.uint32()
+            if do_id in self.visible or do_id in self.owned:
+                self.send_client(client_datagram(CLIENT_OBJECT_SET_FIELD).raw(datagram[reader.offset - 4:]))
+        elif msgtype in (STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED,
+                         STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER):
+            self.enter(reader, msgtype == STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER)
+        elif msgtype in (STATESERVER_OBJECT_ENTER_INTEREST_WITH_REQUIRED,
+                         STATESERVER_OBJECT_ENTER_INTEREST_WITH_REQUIRED_OTHER):
+            reader.uint32()  # context
+            self.enter(reader, msgtype == STATESERVER_OBJECT_ENTER_INTEREST_WITH_REQUIRED_OTHER)
+        elif msgtype in (STATESERVER_OBJECT_ENTER_OWNER_WITH_REQUIRED,
+                         STATESERVER_OBJECT_ENTER_OWNER_WITH_REQUIRED_OTHER):
+            body = reader.remainder()
+            self.owned.add(reader.uint32())
+            self.send_client(client_datagram(CLIENT_ENTER_OBJECT_REQUIRED_OTHER_OWNER
+                                             if msgtype == STATESERVER_OBJECT_ENTER_OWNER_WITH_REQUIRED_OTHER
+                                             else CLIENT_ENTER_OBJECT_REQUIRED_OWNER).raw(body))
+        elif msgtype == STATESERVER_OBJECT_CHANGING_OWNER:
+            do_id, _, old_owner = reader.uint32(), reader.uint64(), reader.uint64()
+            if old_owner == self.channel and do_id in self.owned:
+                self.owned.discard(do_id)
+                self.send_client(client_datagram(CLIENT_OBJECT_LEAVING_OWNER).uint32(do_id))
+        elif msgtype == STATESERVER_OBJECT_CHANGING_LOCATION:
+            do_id, parent, zone = reader.uint32(), reader.uint32(), reader.uint32()
+            if do_id not in self.visible:
+                return
+            if location_channel(parent, zone) in self.channels:
+                self.visible[do_id] = location_channel(parent, zone)
+                self.send_client(client_datagram(CLIENT_OBJECT_LOCATION).uint32(do_id).uint32(parent).uint32(zone))
+            else:
+                self.leave(do_id)
+        elif msgtype == STATESERVER_OBJECT_DELETE_RAM:
+            do_id = reader.uint32()
+            if do_id in self.visible:
+                self.leave(do_id)
+            if do_id in self.owned:
+                self.owned.discard(do_id)
+                self.send_client(client_datagram(CLIENT_OBJECT_LEAVING_OWNER).uint32(do_id))
+            self.session_objects.discard(do_id)
+        elif msgtype == CLIENTAGENT_SET_STATE:
+            self.state = reader.uint16()
+        elif msgtype == CLIENTAGENT_EJECT:
+            self.eject(reader.uint16(), reader.string())
+        elif msgtype == CLIENTAGENT_DROP:
+            self.close()
+        elif msgtype == CLIENTAGENT_SEND_DATAGRAM:
+            if not self.closed:
+                self.writer.write(frame(reader.blob()))
+        elif msgtype == CLIENTAGENT_ADD_SESSION_OBJECT:
+            self.session_objects.add(reader.uint32())
+        elif msgtype == CLIENTAGENT_REMOVE_SESSION_OBJECT:
+            self.session_objects.discard(reader.uint32())
+        elif msgtype == CLIENTAGENT_OPEN_CHANNEL:
+            self.subscribe(reader.uint64())
+        elif msgtype == CLIENTAGENT_CLOSE_CHANNEL:
+            self.unsubscribe(reader.uint64())
+        elif msgtype == CLIENTAGENT_ADD_INTEREST:
+            self.add_interest(reader.uint16(), reader.uint32(), [reader.uint32()])
+        elif msgtype == CLIENTAGENT_ADD_INTEREST_MULTIPLE:
+            interest_id, parent = reader.uint16(), reader.uint32()
+            self.add_interest(interest_id, parent, [reader.uint32() for _ in range(reader.uint16())])
+        elif msgtype == CLIENTAGENT_REMOVE_INTEREST:
+            self.remove_interest(reader.uint16())
+
+    def enter(self, reader, other):
+        body = reader.remainder()
+        do_id, parent, zone = reader.uint32(), reader.uint32(), reader.uint32()
+        if do_id in self.visible or location_channel(parent, zone) not in self.channels:
+            return
+        self.visible[do_id] = location_channel(parent, zone)
+        self.send_client(client_datagram(CLIENT_ENTER_OBJECT_REQUIRED_OTHER if other else
+                                         CLIENT_ENTER_OBJECT_REQUIRED).raw(body))
+
+    def leave(self, do_id):
+        del self.visible[do_id]
+        self.send_client(client_datagram(CLIENT_OBJECT_LEAVING).uint32(do_id))
+
+    def interest_channels(self):
+        return set(location_channel(parent, zone) for parent, zones in self.interests.values() for zone in zones)
+
+    def add_interest(self, interest_id, parent, zones):
+        old_channels = self.interest_channels()
+        self.interests[interest_id] = (parent, set(zones))
+        self.update_subscriptions(old_channels)
+        context = self.next_context
+        self.next_context += 1
+        if len(zones) == 1:
+            self.send_client(client_datagram(CLIENT_ADD_INTEREST).uint32(context).uint16(interest_id)
+                             .uint32(parent).uint32(zones[0]))
+        else:
+            writer = client_datagram(CLIENT_ADD_INTEREST_MULTIPLE).uint32(context).uint16(interest_id)
+            writer.uint32(parent).uint16(len(zones))
+            for zone in zones:
+                writer.uint32(zone)
+            self.send_client(writer)
+        # The State Server answers synchronously, so the objects have entered once this returns.
+        writer = DatagramWriter().uint32(context).uint32(parent).uint16(len(zones))
+        for zone in zones:
+            writer.uint32(zone)
+        self.send([parent], STATESERVER_OBJECT_GET_ZONES_OBJECTS, writer.data())
+        self.send_client(client_datagram(CLIENT_DONE_INTEREST_RESP).uint32(context).uint16(interest_id))
+
+    def remove_interest(self, interest_id):
+        old_channels = self.interest_channels()
+        self.interests.pop(interest_id, None)
+        self.update_subscriptions(old_channels)
+
+    def update_subscriptions(self, old_channels):
+        new_channels = self.interest_channels()
+        for channel in old_channels - new_channels:
+            self.unsubscribe(channel)
+        for channel in new_channels - old_channels:
+            self.subscribe(channel)
+        for do_id in [do_id for do_id, channel in self.visible.items() if channel not in new_channels]:
+            self.leave(do_id)
+
+
+class ClientAgent:
+    def __init__(self, md):
+        self.md = md
+        self.dc = get_index()
+        self.next_channel = CLIENT_CHANNEL_MIN
+        self.connections = {}
+
+    def allocate_channel(self):
+        for _ in range(CLIENT_CHANNEL_MAX - CLIENT_CHANNEL_MIN + 1):
+            channel = self.next_channel
+            self.next_channel = channel + 1 if channel < CLIENT_CHANNEL_MAX else CLIENT_CHANNEL_MIN
+            if channel not in self.connections:
+                return channel
+        raise RuntimeError("Client channel range is exhausted")
+
+
+class LocalCluster:
+    def __init__(self, md_host=MD_HOST, md_port=MD_PORT, ca_host=CA_HOST, ca_port=CA_PORT):
+        self.md_address = (md_host, md_port)
+        self.ca_address = (ca_host, ca_port)
+        self.md = MessageDirector()
+        self.state_server = StateServer(self.md)
+        self.client_agent = ClientAgent(self.md)
+        self.loop = None
+        self.thread = None
+        self.servers = []
+        self.ready = threading.Event()
+
+    def start(self):
+        # Serves from a background thread, so repositories can run in this one
+        self.thread = threading.Thread(target=self.run, name="LocalCluster", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.servers = [
+            self.loop.run_until_complete(asyncio.start_server(self.serve_md, *self.md_address)),
+            self.loop.run_until_complete(asyncio.start_server(self.serve_ca, *self.ca_address)),
+        ]
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            for server in self.servers:
+                server.close()
+            # Close the connections still open, rather than leave their tasks pending
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    @staticmethod
+    async def read_datagrams(reader, handle):
+        buffer = b''
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            datagrams, buffer = split_frames(buffer + data)
+            for datagram in datagrams:
+                handle(datagram)
+
+    async def serve_md(self, reader, writer):
+        participant = RemoteParticipant(self.md, writer)
+        try:
+            await self.read_datagrams(reader, participant.handle)
+        except ConnectionError:
+            pass
+        finally:
+            participant.disconnected()
+            writer.close()
+
+    async def serve_ca(self, reader, writer):
+        channel = self.client_agent.allocate_channel()
+        client = ClientConnection(self.client_agent, channel, writer)
+        self.client_agent.connections[channel] = client
+        try:
+            await self.read_datagrams(reader, lambda datagram: None if client.closed else client.handle(datagram))
+        except ConnectionError:
+            pass
+        finally:
+            client.close()
+            del self.client_agent.connections[channel]
+
+
+if __name__ == "__main__":
+    cluster = LocalCluster()
+    print("Local cluster up; MD on %s:%d, CA on %s:%d" % (cluster.md_address + cluster.ca_address))
+    cluster.run()
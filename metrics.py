@@ -0,0 +1,192 @@
+from bisect import bisect_left
+from collections import Counter
+from dcfields import get_index
+from globals import *
+from time import perf_counter
+from wire import *
+import asyncio
+import os
+import struct
+
+"""
+Instrumentation of the Services frame.
+
+Once installed on a repository and the AI_TASKS scheduler, this records:
+* the time of every frame, split into receive (`poll_till_empty()`), task and send
+  (the update pipeline's flush) phases, as histograms
+* a histogram per type of task, e.g. every `AvatarEngine.tick`
+* datagrams and bytes in and out of the repository's socket, by dclass and field
+  for field updates and by message type for everything else
+* frames that took longer than a frame, and frames the scheduler had to skip
+
+Every METRICS_SNAPSHOT_INTERVAL seconds the metrics are written to the shard's
+METRICS_SNAPSHOT_FILE in a Prometheus-style text format, and if METRICS_PORT is set,
+the same text is served over HTTP on METRICS_PORT plus the shard id for scraping.
+Every shard has a file and port of its own.
+"""
+
+
+class Histogram:
+    # Upper bounds of the buckets in seconds: 1us, 2us, 4us, ... ~1s, and +Inf
+    BOUNDS = [1e-6 * 2 ** i for i in range(21)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def lines(self, name, labels):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.BOUNDS + ['+Inf'], self.counts):
+            cumulative += count
+            le = bound if bound == '+Inf' else '%g' % bound
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels + ',' if labels else '', le, cumulative))
+        braces = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %.9f' % (name, braces, self.sum))
+        lines.append('%s_count%s %d' % (name, braces, self.count))
+        lines.append('%s_max%s %.9f' % (name, braces, self.max))
+        return lines
+
+
+class MeteredSocket(StandInSocket):
+    """
+    Stands in for a repository's socket, and counts the datagrams passing through it.
+    """
+    def __init__(self, sock, metrics):
+        StandInSocket.__init__(self, sock)
+        self.metrics = metrics
+        self.inbound, self.outbound = DatagramStream(), DatagramStream()
+
+    def received(self, data):
+        self.metrics.count(self.metrics.datagrams_in, self.inbound.feed(data), len(data), inbound=True)
+
+    def sent(self, data):
+        self.metrics.count(self.metrics.datagrams_out, self.outbound.feed(bytes(data)), len(data), inbound=False)
+
+
+class Metrics:
+    def __init__(self):
+        self.period = 1.0 / float(AI_FRAME_RATE)
+        self.scheduler = None
+        self.path = None
+        self.port = 0  # To serve the metrics on, if any
+        self.dc = None  # The DC index; only loaded by `meter()`, not on import
+        self.phases = {phase: Histogram() for phase in ('frame', 'receive', 'tasks', 'send')}
+        self.tasks = {}  # task name -> Histogram
+        self.datagrams_in, self.datagrams_out = Counter(), Counter()  # (dclass, field) or message type -> count
+        self.bytes_in, self.bytes_out = 0, 0
+        self.frames, self.overruns = 0, 0
+        self.receive_time = 0.0  # Since the last frame
+        self.frame_time = {'tasks': 0.0, 'send': 0.0}  # Of the current frame
+
+    def install(self, repo, scheduler, shard_id=0):
+        self.scheduler = scheduler
+        self.path = METRICS_SNAPSHOT_FILE % (shard_id, )
+        self.port = METRICS_PORT + shard_id if METRICS_PORT else 0
+        scheduler.profiler = self
+        if getattr(repo, 'socket', None) is not None:
+            repo.socket = self.meter(repo.socket)
+        scheduler.add_task(self.snapshot, priority=1000,
+                           divisor=max(int(METRICS_SNAPSHOT_INTERVAL * AI_FRAME_RATE), 1))
+
+    def meter(self, sock):
+        # Counting field updates by field takes the DC index
+        self.dc = get_index()
+        return MeteredSocket(sock, self)
+
+    def timed_receive(self, poll):
+        def timed():
+            started = perf_counter()
+            poll()
+            self.receive_time += perf_counter() - started
+        return timed
+
+    def task_done(self, task, seconds):
+        histogram = self.tasks.get(task.name)
+        if histogram is None:
+            histogram = self.tasks[task.name] = Histogram()
+        histogram.record(seconds)
+        self.frame_time[task.stage] = self.frame_time.get(task.stage, 0.0) + seconds
+
+    def tick_done(self, scheduler):
+        receive, tasks, send = self.receive_time, self.frame_time['tasks'], self.frame_time['send']
+        self.phases['receive'].record(receive)
+        self.phases['tasks'].record(tasks)
+        self.phases['send'].record(send)
+        self.phases['frame'].record(receive + tasks + send)
+        if receive + tasks + send > self.period:
+            self.overruns += 1
+        self.frames += 1
+        self.receive_time = 0.0
+        self.frame_time = {'tasks': 0.0, 'send': 0.0}
+
+    def count(self, counter, datagrams, size, inbound):
+        if inbound:
+            self.bytes_in += size
+        else:
+            self.bytes_out += size
+        for datagram in datagrams:
+            try:
+                _, sender, msgtype, reader = read_internal_header(datagram)
+                if msgtype in FIELD_UPDATES:
+                    reader.uint32()
+                    field = self.dc.fields[reader.uint16()]
+                    counter[(field.dclass, field.name)] += 1
+                else:
+                    counter[msgtype] += 1
+            except (struct.error, IndexError):
+                counter['malformed'] += 1
+
+    def text(self):
+        lines = [
+            'services_frames_total %d' % self.frames,
+            'services_frame_overruns_total %d' % self.overruns,
+            'services_skipped_frames_total %d' % (self.scheduler.overruns if self.scheduler else 0),
+            'services_bytes_in_total %d' % self.bytes_in,
+            'services_bytes_out_total %d' % self.bytes_out,
+        ]
+        for phase, histogram in self.phases.items():
+            lines += histogram.lines('services_phase_seconds', 'phase="%s"' % phase)
+        for name, histogram in sorted(self.tasks.items()):
+            lines += histogram.lines('services_task_seconds', 'task="%s"' % name)
+        for direction, counter in (('in', self.datagrams_in), ('out', self.datagrams_out)):
+            for key, count in sorted(counter.items(), key=str):
+                if isinstance(key, tuple):
+                    labels = 'dclass="%s",field="%s"' % key
+                else:
+                    labels = 'msgtype="%s"' % key
+                lines.append('services_datagrams_%s_total{%s} %d' % (direction, labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self, dt=None):
+        # Written aside and renamed, so readers never see a half written file
+        partial = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(partial, 'w') as f:
+            f.write(self.text())
+        os.replace(partial, self.path)
+
+    async def serve(self, host=METRICS_HOST):
+        return await asyncio.start_server(self.serve_request, host, self.port)
+
+    async def serve_request(self, reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.text().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
@@ -0,0 +1,58 @@
+import inspect
+
+"""
+Stand-ins for an AI repository and its views, for running AI code without Astron:
+nothing is sent, every update and message is kept for looking at instead. Used by
+bench.py and the tests.
+"""
+
+
+class MockRepository:
+    """
+    Stands in for an AI repository; keeps what its views send instead of sending it.
+    """
+    def __init__(self, views=None):
+        self.views = views  # The views module, to create the AI views of; see `create_distobj()`
+        self.updates = []  # (view, field, args) of every send_update()
+        self.messages = []  # (name, args) of every other send_*()
+        self.objects = {}  # do_id -> MockView
+
+    def __getattr__(self, name):
+        if not name.startswith('send_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.messages.append((name, args))
+
+    def create_distobj(self, dclass, do_id, parent, zone, set_ai=False):
+        view = MockView(self, dclass, do_id, parent, zone, getattr(self.views, dclass + 'AI', None))
+        self.objects[do_id] = view
+        if view.ai_class is not None:
+            view.init()
+        return view
+
+    def clear(self):
+        self.updates, self.messages = [], []
+
+
+class MockView:
+    """
+    Stands in for a view of `dclass`, with the methods and properties of `ai_class`,
+    if given, but none of a DistributedObject's.
+    """
+    def __init__(self, repo, dclass, do_id, parent, zone, ai_class=None):
+        self.repo = repo
+        self.dclass = dclass
+        self.do_id = do_id
+        self.parent = parent
+        self.zone = zone
+        self.ai_class = ai_class
+
+    def __getattr__(self, name):
+        if name.startswith('send_'):
+            return getattr(self.repo, name)
+        ai_class = self.__dict__.get('ai_class')
+        if ai_class is None:
+            raise AttributeError(name)
+        return inspect.getattr_static(ai_class, name).__get__(self, MockView)
+
+    def send_update(self, field, *args):
+        self.repo.updates.append((self, field, args))
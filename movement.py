@@ -0,0 +1,130 @@
+from globals import *
+import math
+import struct
+
+"""
+Compact encoding of avatar movement.
+
+Positions are quantized to MOVE_XY_BITS per axis across the map (z is always 0 and
+not sent), and headings to MOVE_H_BITS over the full circle, and packed into one
+uint32 for `set_move`. Between keyframes, an avatar that moved little is sent as
+`set_move_delta`, the signed int8 differences to its previous move, in quantized
+steps. Updates over the Astron connections are reliable and ordered, so the
+previous move sent is also the one every client in the zone has applied last.
+Clients that just got the avatar into interest wait for the next keyframe, which
+is sent every MOVE_KEYFRAME_INTERVAL moves, when an avatar changes zones or stops,
+whenever a difference doesn't fit into an int8, and shortly after an owner's
+interest gains the avatar's zone. Avatars standing still are sent again as
+keyframes every MOVE_IDLE_KEYFRAME_INTERVAL seconds, for clients that gained
+interest in them through an avatar of another shard.
+
+With MOVE_BATCHING, the moves of all avatars of a shard in a zone are sent as one
+`set_moves` update of that shard's DistributedMoveBatch in the zone, instead of an
+update (and datagram) per avatar. Its blob holds a uint16 count of keyframes, that
+many (uint32 doId, uint32 move) keyframes, and (uint32 doId, int8 dx, dy, dh)
+deltas for the rest of the blob.
+"""
+
+XY_STEPS = (1 << MOVE_XY_BITS) - 1
+XY_SCALE = XY_STEPS / (WORLD_MAX - WORLD_MIN)  # Quantized steps per unit
+H_STEPS = 1 << MOVE_H_BITS
+H_SCALE = H_STEPS / 360.0  # Quantized steps per degree
+
+KEYFRAME = struct.Struct('<II')
+DELTA = struct.Struct('<Ibbb')
+
+
+def step_move(x, y, h, turn, forward, dt):
+    """
+    Moves one avatar for `dt` seconds, exactly like `AvatarEngine.step()` moves many
+    on the AI, so clients can predict their own avatar.
+    """
+    h = h + math.fmod(turn * avatar_rotation_speed * dt, 360.0)
+    if h >= 360.0:
+        h -= 360.0
+    elif h < 0.0:
+        h += 360.0
+    h_rads = math.radians(h)
+    local_y = -1.0 * avatar_speed * forward * dt
+    x = x + round(-1.0 * math.sin(h_rads) * local_y, pos_float_accuracy)
+    y = y + round(math.cos(h_rads) * local_y, pos_float_accuracy)
+    return min(max(x, WORLD_MIN), WORLD_MAX), min(max(y, WORLD_MIN), WORLD_MAX), h
+
+
+def quantize(x, y, h):
+    qx = min(max(int(round((x - WORLD_MIN) * XY_SCALE)), 0), XY_STEPS)
+    qy = min(max(int(round((y - WORLD_MIN) * XY_SCALE)), 0), XY_STEPS)
+    return qx, qy, int(round(h * H_SCALE)) % H_STEPS
+
+
+def dequantize(qx, qy, qh):
+    return qx / XY_SCALE + WORLD_MIN, qy / XY_SCALE + WORLD_MIN, qh / H_SCALE
+
+
+def pack_move(qx, qy, qh):
+    return qx | (qy << MOVE_XY_BITS) | (qh << (2 * MOVE_XY_BITS))
+
+
+def unpack_move(packed):
+    return packed & XY_STEPS, (packed >> MOVE_XY_BITS) & XY_STEPS, (packed >> (2 * MOVE_XY_BITS)) % H_STEPS
+
+
+def move_delta(previous, move):
+    """
+    Returns the (dx, dy, dh) from the quantized `previous` to `move`, or None if it
+    doesn't fit into a delta.
+    """
+    dx, dy = move[0] - previous[0], move[1] - previous[1]
+    dh = (move[2] - previous[2] + H_STEPS // 2) % H_STEPS - H_STEPS // 2  # The shorter way around
+    if -128 <= dx <= 127 and -128 <= dy <= 127 and -128 <= dh <= 127:
+        return dx, dy, dh
+    return None
+
+
+def apply_delta(previous, dx, dy, dh):
+    return previous[0] + dx, previous[1] + dy, (previous[2] + dh) % H_STEPS
+
+
+def encode_batch(keyframes, deltas):
+    """
+    `keyframes` holds (doId, packed move), `deltas` (doId, dx, dy, dh) tuples.
+    """
+    parts = [struct.pack('<H', len(keyframes))]
+    parts += [KEYFRAME.pack(*keyframe) for keyframe in keyframes]
+    parts += [DELTA.pack(*delta) for delta in deltas]
+    return b''.join(parts)
+
+
+def decode_batch(blob):
+    """
+    Returns the (doId, packed move) keyframes and (doId, dx, dy, dh) deltas of a batch.
+    """
+    count, = struct.unpack_from('<H', blob)
+    end = 2 + count * KEYFRAME.size
+    return list(KEYFRAME.iter_unpack(blob[2:end])), list(DELTA.iter_unpack(blob[end:]))
+
+
+def merge_batches(older, newer):
+    """
+    Returns one batch that moves every avatar as far as applying `older` and then
+    `newer` would, or None if one of them had a delta in both that don't add up to
+    one that fits.
+    """
+    keyframes, deltas = decode_batch(older)
+    keyframes, deltas = dict(keyframes), {do_id: (dx, dy, dh) for do_id, dx, dy, dh in deltas}
+    newer_keyframes, newer_deltas = decode_batch(newer)
+    for do_id, packed in newer_keyframes:
+        deltas.pop(do_id, None)
+        keyframes[do_id] = packed
+    for do_id, dx, dy, dh in newer_deltas:
+        if do_id in keyframes:
+            keyframes[do_id] = pack_move(*apply_delta(unpack_move(keyframes[do_id]), dx, dy, dh))
+        elif do_id in deltas:
+            previous = deltas[do_id]
+            delta = (previous[0] + dx, previous[1] + dy, (previous[2] + dh + H_STEPS // 2) % H_STEPS - H_STEPS // 2)
+            if max(delta) > 127 or min(delta) < -128:
+                return None
+            deltas[do_id] = delta
+        else:
+            deltas[do_id] = (dx, dy, dh)
+    return encode_batch(list(keyframes.items()), [(do_id, ) + delta for do_id, delta in deltas.items()])
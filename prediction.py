@@ -0,0 +1,71 @@
+from collections import deque
+from globals import *
+from movement import step_move
+
+"""
+Client-side prediction of the owner's own avatar.
+
+Rather than waiting a round trip for the AI to move its avatar, the client samples
+its movement intent once per frame under a sequence number, and moves the avatar
+right away with the same math as the AI (`movement.step_move()`). Only changes of
+the intent are sent, along with the sequence number of the frame they were sampled
+in. An intent that's held is sent again every CLIENT_INTENT_REFRESH seconds, so
+the time the AI has simulated it for still fits into an ack.
+
+The AI stays authoritative: for every intent it gets, and every AI_ACK_INTERVAL
+seconds while the avatar moves, it sends `ack_move`: the last intent it got, how
+long it has simulated it, and where that got the avatar. On every ack, the
+prediction restarts from there, and the sampled frames the AI hasn't simulated
+yet (the rest of the acknowledged one's time, and everything after it) are
+replayed on top of it.
+"""
+
+SEQ_MODULO = 1 << 16  # Sequence numbers are sent as uint16
+
+
+class Predictor:
+    def __init__(self, history=CLIENT_PREDICTION_HISTORY):
+        self.seq = 0
+        self.inputs = deque(maxlen=history)  # (seq, turn, forward, dt) of the frames sampled, oldest first
+        self.intent = (0.0, 0.0)  # Last sent
+        self.held = 0.0  # Seconds since it was sent
+        self.state = None  # Predicted (x, y, h); None until the first ack
+        self.acked = None  # Sequence number of the last acknowledged intent
+        self.consumed = 0.0  # Seconds of its frames dropped, as the AI has simulated them
+        self.error = 0.0  # Distance between prediction and AI on the last ack
+
+    def sample(self, turn, forward, dt):
+        """
+        Samples the intent of a client frame, and moves the prediction on by `dt`.
+        Returns the sequence number of the frame if the intent changed (or is due to
+        be sent again), and needs to be sent, or None.
+        """
+        self.seq = (self.seq + 1) % SEQ_MODULO
+        self.inputs.append((self.seq, turn, forward, dt))
+        if self.state is not None:
+            self.state = step_move(self.state[0], self.state[1], self.state[2], turn, forward, dt)
+        self.held += dt
+        if (turn, forward) == self.intent and (self.intent == (0.0, 0.0) or self.held < CLIENT_INTENT_REFRESH):
+            return None
+        self.intent, self.held = (turn, forward), 0.0
+        return self.seq
+
+    def reconcile(self, seq, elapsed, x, y, h):
+        inputs = self.inputs
+        if seq != self.acked:
+            # Frames before the newly acknowledged one are done with
+            while inputs and inputs[0][0] != seq:
+                inputs.popleft()
+            self.acked, self.consumed = seq, 0.0
+        elapsed -= self.consumed
+        # So are the ones the AI has simulated all of by now
+        while inputs and inputs[0][3] <= elapsed:
+            elapsed -= inputs[0][3]
+            self.consumed += inputs.popleft()[3]
+        state = (x, y, h)
+        for _, turn, forward, dt in inputs:
+            state = step_move(state[0], state[1], state[2], turn, forward, dt - elapsed)
+            elapsed = 0.0
+        if self.state is not None:
+            self.error = ((self.state[0] - state[0]) ** 2 + (self.state[1] - state[1]) ** 2) ** 0.5
+        self.state = state
@@ -0,0 +1,113 @@
+from collections import deque
+from dcfields import get_index
+from globals import *
+from movement import merge_batches
+from time import perf_counter
+from wire import *
+import select
+
+"""
+Time-budgeted receiving of datagrams on the client.
+
+The receiver takes over reading the ClientRepository's socket. Every frame it reads
+everything that has arrived into a queue, where the moves of an avatar that has a
+newer keyframe queued behind them are dropped, as only the latest one would have
+been visible anyway. (Deltas build on each other, so those are never dropped on
+their own.) Batches of moves queued for the same batch object are merged into the
+newest one (see `movement.merge_batches()`). Then it lets the repository handle
+queued datagrams until CLIENT_RECEIVE_BUDGET seconds of the frame are used up; the
+rest waits for the next frame instead of stalling this one.
+
+The repository is fed through a stand-in socket, and is expected to read it like
+the non-blocking socket it replaces, until `recv()` raises BlockingIOError.
+"""
+
+# An update in a keyframe field makes the object's earlier queued updates in either list obsolete
+KEYFRAME_FIELDS = [('DistributedAvatar', 'set_move')]
+CHAINED_FIELDS = [('DistributedAvatar', 'set_move_delta')]
+# An update in a batch field can be merged with the object's earlier queued one
+BATCH_FIELDS = [('DistributedMoveBatch', 'set_moves')]
+
+
+class ReleasedSocket(StandInSocket):
+    """
+    What the repository reads from: only the datagrams the receiver released to it.
+    """
+    fed = True
+
+
+class BudgetedReceiver:
+    def __init__(self, repo, budget=CLIENT_RECEIVE_BUDGET, batch=CLIENT_RECEIVE_BATCH):
+        self.repo = repo
+        self.sock = repo.socket
+        repo.socket = self.released = ReleasedSocket(self.sock)
+        self.budget = budget
+        self.batch = batch
+        self.stream = DatagramStream()
+        self.queue = deque()  # Entries are one-item lists, so a superseded datagram can be blanked in place
+        self.latest = {}  # doId -> queue entries of its updates since its last keyframe
+        self.batches = {}  # doId -> queue entry of its latest batch
+        dc = get_index()
+        self.keyframes = set(dc.field_number(dclass, field) for dclass, field in KEYFRAME_FIELDS)
+        self.chained = self.keyframes | set(dc.field_number(dclass, field) for dclass, field in CHAINED_FIELDS)
+        self.batched = set(dc.field_number(dclass, field) for dclass, field in BATCH_FIELDS)
+        self.received, self.coalesced_count = 0, 0
+
+    def read(self):
+        while select.select([self.sock], [], [], 0)[0]:
+            data = self.sock.recv(65536)
+            if not data:
+                # Closed; let the repository find out by itself
+                self.released.pending += self.stream.buffer
+                return
+            for datagram in self.stream.feed(data):
+                self.enqueue(datagram)
+
+    def enqueue(self, datagram):
+        entry = [datagram]
+        self.received += 1
+        if len(datagram) >= 8:
+            msgtype, do_id, field = DatagramReader(datagram).read('<H'), None, None
+            if msgtype == CLIENT_OBJECT_SET_FIELD:
+                reader = DatagramReader(datagram, 2)
+                do_id, field = reader.uint32(), reader.uint16()
+            if field in self.chained:
+                pending = self.latest.setdefault(do_id, [])
+                if field in self.keyframes:
+                    for superseded in pending:
+                        if superseded[0] is not None:
+                            superseded[0] = None
+                            self.coalesced_count += 1
+                    del pending[:]
+                pending.append(entry)
+            elif field in self.batched:
+                self.merge(entry, do_id, field)
+        self.queue.append(entry)
+
+    def merge(self, entry, do_id, field):
+        previous = self.batches.get(do_id)
+        self.batches[do_id] = entry
+        if previous is None or previous[0] is None:
+            return  # Released (or dropped) already
+        merged = merge_batches(DatagramReader(previous[0], 8).blob(), DatagramReader(entry[0], 8).blob())
+        if merged is None or len(merged) > 0xFFFF:
+            return  # Or it wouldn't fit into a blob anymore
+        entry[0] = client_datagram(CLIENT_OBJECT_SET_FIELD).uint32(do_id).uint16(field).blob(merged).data()
+        previous[0] = None
+        self.coalesced_count += 1
+
+    def poll(self):
+        self.read()
+        deadline = perf_counter() + self.budget
+        queue, released = self.queue, self.released.pending
+        while queue and perf_counter() < deadline:
+            for _ in range(min(self.batch, len(queue))):
+                # Blanked once released as well, so it's no longer merged into
+                entry = queue.popleft()
+                datagram, entry[0] = entry[0], None
+                if datagram is not None:
+                    released += frame(datagram)
+            self.repo.poll_till_empty()
+        if not queue:
+            self.latest.clear()
+            self.batches.clear()
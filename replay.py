@@ -0,0 +1,144 @@
+from capture import read_capture, read_start
+from globals import *
+from metrics import Metrics
+from runtime import runtime
+from services import Services
+from stats import percentile
+from time import perf_counter
+from wire import *
+import argparse
+import asyncio
+import json
+import os
+import shards
+import sys
+
+"""
+Replay of a capture log (see capture.py) against the Services, for comparing the
+performance of revisions on the same real traffic.
+
+The Services are set up as usual, as the shard that wrote the capture and from the
+doId allocator state it started with, but never connect: their repository reads
+the captured datagrams from a stand-in socket instead, through its regular
+dispatch, and everything it sends is counted and dropped. Every captured tick is
+replayed with the dt it had, one right after the other, so the replay runs as fast
+as the AI can go. Tasks spawned by the views (e.g. logins) are run to completion
+within the tick they were spawned in, so results don't depend on thread timing.
+
+The replay runs unsharded: avatars that other shards placed on this one came
+through its placement queue rather than its socket and aren't in the log, and the
+logins of a primary shard place all their avatars on it.
+
+The report has the cost of the ticks (receiving, tasks and spawned work) and the
+datagrams sent, in total and by dclass and field or message type. Save it with
+--json, and compare a later run to it with --baseline.
+
+Usage: replay.py LOG [--json FILE] [--baseline FILE] [-v]
+"""
+
+
+class ReplaySocket(StandInSocket):
+    """
+    The repository's socket during a replay: reads the datagrams fed to it, and
+    swallows everything sent.
+    """
+    fed = True
+
+    def feed(self, datagrams):
+        for datagram in datagrams:
+            self.pending += frame(datagram)
+
+
+async def replay(path):
+    runtime.loop = asyncio.get_running_loop()
+    shard_id, min_id, max_id, next_fresh, used_ids, free_ids = read_start(path)
+    shards.context = shards.ShardContext(shard_id, doid_range=(min_id, max_id))
+    shards.context.doids.restore(next_fresh, used_ids, free_ids)
+    services = Services(connect=False)
+    stats = Metrics()
+    sock = ReplaySocket()
+    services.ir.socket = stats.meter(sock)
+    services.setup(checkpoint=False, instrument=False, capture=False)
+
+    costs, outbound, simulated, sent = [], [], 0.0, 0
+    started = perf_counter()
+    for tick, dt, datagrams in read_capture(path):
+        tick_started = perf_counter()
+        sock.feed(datagrams)
+        services.ir.poll_till_empty()
+        AI_TASKS.tick(dt)
+        await runtime.settle()
+        costs.append(perf_counter() - tick_started)
+        total = sum(stats.datagrams_out.values())
+        outbound.append(total - sent)
+        sent, simulated = total, simulated + dt
+    wall = perf_counter() - started
+
+    return {
+        'ticks': len(costs),
+        'simulated_seconds': simulated,
+        'wall_seconds': wall,
+        'speedup': simulated / wall if wall else 0.0,
+        'inbound_datagrams': sum(stats.datagrams_in.values()),
+        'tick_ms': {
+            'mean': sum(costs) / len(costs) * 1000.0 if costs else 0.0,
+            'p50': percentile(costs, 0.5) * 1000.0,
+            'p90': percentile(costs, 0.9) * 1000.0,
+            'p99': percentile(costs, 0.99) * 1000.0,
+            'max': percentile(costs, 1.0) * 1000.0,
+        },
+        'outbound_datagrams': sent,
+        'outbound_bytes': stats.bytes_out,
+        'outbound_per_tick': {
+            'mean': float(sent) / len(outbound) if outbound else 0.0,
+            'max': max(outbound) if outbound else 0,
+        },
+        'outbound_by_type': {'.'.join(key) if isinstance(key, tuple) else str(key): count
+                             for key, count in stats.datagrams_out.items()},
+    }
+
+
+def compare(value, baseline):
+    if not baseline:
+        return "%.3f" % (value, )
+    return "%.3f (baseline %.3f, %+.1f%%)" % (value, baseline, (value - baseline) / baseline * 100.0)
+
+
+def report(result, baseline=None):
+    baseline = baseline or {}
+    print("Replayed %d ticks (%.1f s) in %.2f s, %.1fx real time; %d datagrams in" %
+          (result['ticks'], result['simulated_seconds'], result['wall_seconds'], result['speedup'],
+           result['inbound_datagrams']))
+    for key in ('mean', 'p50', 'p90', 'p99', 'max'):
+        print("Tick cost %s (ms): %s" % (key, compare(result['tick_ms'][key], baseline.get('tick_ms', {}).get(key))))
+    print("Datagrams out: %s" % (compare(result['outbound_datagrams'], baseline.get('outbound_datagrams')), ))
+    print("Bytes out: %s" % (compare(result['outbound_bytes'], baseline.get('outbound_bytes')), ))
+    print("Datagrams out per tick: mean %s, max %d" %
+          (compare(result['outbound_per_tick']['mean'], baseline.get('outbound_per_tick', {}).get('mean')),
+           result['outbound_per_tick']['max']))
+    by_type = baseline.get('outbound_by_type', {})
+    for key, count in sorted(result['outbound_by_type'].items(), key=lambda item: -item[1]):
+        print("  %s: %s" % (key, compare(count, by_type.get(key))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a capture log against the Services.")
+    parser.add_argument('log', help="capture log, see CAPTURE_ENABLED")
+    parser.add_argument('--json', help="file to save the results to")
+    parser.add_argument('--baseline', help="results saved with --json to compare to")
+    parser.add_argument('-v', '--verbose', action='store_true', help="keep the views' output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # Every view prints on creation; that's a lot of output for a busy capture.
+        sys.stdout = open(os.devnull, 'w')
+    result = asyncio.run(replay(args.log))
+    sys.stdout = sys.__stdout__
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
@@ -0,0 +1,77 @@
+from globals import *
+import asyncio
+import traceback
+
+"""
+asyncio runtime of the Services process.
+
+Datagrams are read as soon as the repository's socket becomes readable instead of
+once per frame, the AI_TASKS frame is a coroutine paced by the scheduler's
+deadlines, and views can hand slow work to `spawn()` / `run_blocking()` and await
+it without stalling the simulation.
+"""
+
+
+class ServicesRuntime:
+    def __init__(self, scheduler=AI_TASKS):
+        self.scheduler = scheduler
+        self.repo = None
+        self.loop = None
+        self.tasks = set()  # Strong references, so spawned tasks aren't garbage collected
+
+    def run(self, repo):
+        self.repo = repo
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        poll = self.repo.poll_till_empty
+        if self.scheduler.profiler is not None:
+            poll = self.scheduler.profiler.timed_receive(poll)
+            if self.scheduler.profiler.port:
+                await self.scheduler.profiler.serve()
+        sock = getattr(self.repo, 'socket', None)
+        if sock is not None:
+            self.loop.add_reader(sock, poll)
+            poll = None
+        # Otherwise, there's no socket to watch; fall back to polling once per frame.
+        try:
+            await self.tick_loop(poll)
+        finally:
+            if sock is not None:
+                self.loop.remove_reader(sock)
+
+    async def tick_loop(self, poll=None):
+        scheduler = self.scheduler
+        while True:
+            if poll is not None:
+                poll()
+            scheduler.tick(scheduler.measure())
+            # Sleep even when behind schedule, so socket readers and spawned tasks get to run.
+            await asyncio.sleep(scheduler.delay())
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(self.report)
+        return task
+
+    @staticmethod
+    def report(task):
+        # Nobody awaits a spawned task, so its exception would otherwise go unnoticed
+        if not task.cancelled() and task.exception() is not None:
+            print("ServicesRuntime: spawned task %s failed:" % (task.get_coro().__qualname__, ))
+            traceback.print_exception(task.exception())
+
+    async def settle(self):
+        # Waits until every spawned task is done, including ones spawned meanwhile.
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+    async def run_blocking(self, func, *args):
+        # Runs `func` on the default thread pool; the frame keeps ticking meanwhile.
+        return await self.loop.run_in_executor(None, func, *args)
+
+
+runtime = ServicesRuntime()
@@ -0,0 +1,103 @@
+from time import perf_counter, sleep
+
+"""
+Fixed-timestep scheduler for the tasks ran every 'server frame'.
+
+Frames are paced against absolute deadlines, so time spent working is not added on
+top of the sleep. Every task receives the real time elapsed since it last ran, up
+to `max_catchup` frames' worth. A frame that overruns is followed right away by
+the next one, whose tasks make up for the lost time through that longer dt, and
+the schedule starts over from then; the frames missed are counted as overruns
+rather than run back to back, as with near-zero dts they'd simulate nothing.
+"""
+
+
+class ScheduledTask:
+    __slots__ = ('func', 'priority', 'divisor', 'phase', 'stage', 'name', 'elapsed')
+
+    def __init__(self, func, priority, divisor, phase, stage):
+        self.func = func
+        self.priority = priority
+        self.divisor = divisor
+        self.phase = phase
+        self.stage = stage  # Which part of the frame the task is profiled as ('tasks' or 'send')
+        self.name = getattr(func, '__qualname__', repr(func))
+        self.elapsed = 0.0
+
+
+class TickScheduler:
+    def __init__(self, frame_rate, max_catchup=5):
+        self.period = 1.0 / float(frame_rate)
+        self.max_catchup = max_catchup
+        self.tasks = []  # Sorted by priority; replaced (not mutated) on add/remove
+        self.frame = 0
+        self.overruns = 0
+        self.last_time = None
+        self.deadline = None
+        self.profiler = None  # Told the duration of every task and frame, if set (see metrics.py)
+
+    def add_task(self, func, priority=0, divisor=1, stage='tasks'):
+        """
+        Lower priorities run first within a frame; tasks of equal priority run in the
+        order they were added. A task with a divisor of N runs every Nth frame.
+        """
+        task = ScheduledTask(func, priority, divisor, self.frame % divisor, stage)
+        tasks = self.tasks + [task]
+        tasks.sort(key=lambda t: t.priority)
+        self.tasks = tasks
+        return task
+
+    def remove_task(self, func):
+        self.tasks = [task for task in self.tasks if task.func != func]
+
+    def tick(self, dt):
+        frame, profiler = self.frame, self.profiler
+        for task in self.tasks:
+            task.elapsed += dt
+            if (frame - task.phase) % task.divisor == 0:
+                if profiler is None:
+                    task.func(task.elapsed)
+                else:
+                    started = perf_counter()
+                    task.func(task.elapsed)
+                    profiler.task_done(task, perf_counter() - started)
+                task.elapsed = 0.0
+        self.frame = frame + 1
+        if profiler is not None:
+            profiler.tick_done(self)
+
+    def measure(self):
+        # Real time since the previous frame, bounded so a long stall doesn't teleport avatars
+        now = perf_counter()
+        if self.last_time is None:
+            self.last_time = now
+            return self.period
+        dt = now - self.last_time
+        self.last_time = now
+        return min(dt, self.period * self.max_catchup)
+
+    def delay(self):
+        """
+        Advances the deadline by one frame and returns how long to sleep until it.
+        """
+        now = perf_counter()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.period
+        if self.deadline > now:
+            return self.deadline - now
+        # Behind; the next frame's dt covers the missed frames, so start over from now.
+        self.overruns += int((now - self.deadline) / self.period)
+        self.deadline = now
+        return 0.0
+
+    def wait(self):
+        delay = self.delay()
+        if delay > 0.0:
+            sleep(delay)
+
+    def run(self, poll):
+        while True:
+            poll()
+            self.tick(self.measure())
+            self.wait()
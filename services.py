@@ -1,31 +1,69 @@
 from astron.object_repository import InterestInternalRepository
-from time import sleep
+from broadcast import moves
+from capture import recorder
+from checkpoint import checkpoints
 from globals import *
+from metrics import metrics
+from runtime import runtime
+from views import DistributedWorldAI
+# The modules of the AI's per-frame tasks register them on import. views only imports
+# them lazily, which would put that off to their first use, maybe in the middle of a
+# frame; importing them here loads them right away, so every task is in place before
+# the first frame.
+import avatar_engine, broadcast
+import shards
+import sys
 
 
 class Services:
-    def __init__(self):
-        self.ir = InterestInternalRepository(DC_FILE, SSChannel, 0, ServicesChannel)
-        self.ir.connect(self.connection_success, self.connection_failure,
-                        host=MD_HOST, port=MD_PORT)
+    def __init__(self, connect=True):
+        self.shard = shards.context
+        self.ir = InterestInternalRepository(DC_FILE, SSChannel, 0, self.shard.channel)
+        # replay.py sets up the Services without ever connecting
+        if connect:
+            self.ir.connect(self.connection_success, self.connection_failure,
+                            host=MD_HOST, port=MD_PORT)
 
     def connection_success(self):
-        print("Connection success!")
+        print("Connection success! (shard %d)" % (self.shard.shard_id, ))
+        self.setup()
+        # Read datagrams as they arrive and execute tasks per server frame, until the end of time
+        runtime.run(self.ir)
 
-        self.ir.create_distobjglobal_view("AnonymousContactUD", AnonymousContactID, set_ai=True)
-        self.ir.create_distobj("RootAI", RootID, 0, 0, set_ai=True)
-        self.ir.create_distobj("LoginManagerAI", LoginManagerId, RootID, LOGIN_ZONE, set_ai=True)
-        self.ir.create_distobj("DistributedWorldAI", DistributedWorldId, RootID, WORLD_ZONE, set_ai=True)
+    def setup(self, checkpoint=CHECKPOINT_ENABLED, instrument=METRICS_ENABLED, capture=CAPTURE_ENABLED):
+        # Avatars are placed on this shard through its placement queue
+        self.shard.attach(self.ir, DistributedWorldAI.spawn_avatar)
+        if self.shard.is_primary:
+            self.ir.create_distobjglobal_view("AnonymousContactUD", AnonymousContactID, set_ai=True)
+            self.ir.create_distobj("RootAI", RootID, 0, 0, set_ai=True)
+            self.ir.create_distobj("LoginManagerAI", LoginManagerId, RootID, LOGIN_ZONE, set_ai=True)
+            self.ir.create_distobj("DistributedWorldAI", DistributedWorldId, RootID, WORLD_ZONE, set_ai=True)
+        # Take the avatars of this shard's previous run back, and checkpoint them from now on
+        if checkpoint:
+            checkpoints.start(self.ir, self.shard)
+        # Log everything received from here on, for replay.py; with the shard id and the
+        # doIds handed out so far, so the replay runs as this shard and allocates the
+        # same ones from here on
+        if capture:
+            recorder.install(self.ir, AI_TASKS, CAPTURE_FILE % (self.shard.shard_id, ), self.shard.shard_id,
+                             self.shard.doids)
+        # Every shard sends its avatars' moves through batch objects of its own in every
+        # zone; the ones of its previous run that are being taken back are reused
+        zones = set(range(WORLD_GRID_CELLS * WORLD_GRID_CELLS)) - checkpoints.batch_zones()
+        moves.create_batches(self.ir, self.shard.doids, sorted(zones))
 
-        while True:
-            self.ir.poll_till_empty()
-            for i in range(len(AI_TASKS)):
-                AI_TASKS[i]()  # execute tasks per server frame
-            sleep(1.0 / float(AI_FRAME_RATE))
+        if instrument:
+            metrics.install(self.ir, AI_TASKS, self.shard.shard_id)
 
     def connection_failure(self):
         print("Connection failure! Is the Message Director up?")
         return  # TODO: Handle event (libastron.python does not handle failure either!)
 
 
-server = Services()
+if __name__ == "__main__":
+    # Usage: services.py [number of shards]
+    shard_count = int(sys.argv[1]) if len(sys.argv) > 1 else SERVICES_SHARDS
+    if shard_count > 1:
+        shards.ShardSupervisor(shard_count).run()
+    else:
+        server = Services()
@@ -0,0 +1,121 @@
+from avatar_engine import engine
+from doid_allocator import DoIdAllocator
+from globals import *
+import multiprocessing
+import queue
+
+"""
+Sharding of the AI simulation across processes.
+
+A ShardSupervisor launches one Services process per shard, each with its own AI
+channel (ServicesChannel + shard id), repository and tick loop. Shard 0 also hosts
+the top-level objects (Root, LoginManager, World); the world places every new
+avatar on the shard with the fewest avatars, handing it over through that shard's
+placement queue when it's not the local one. Every shard publishes its avatar count
+in a shared array, and the placements handed to a shard but not spawned yet in
+another one; "least loaded" is measured by their sum. Each shard allocates the
+doIds of its avatars from a block of the avatar doId range leased to it at startup.
+"""
+
+
+class ShardContext:
+    def __init__(self, shard_id=0, loads=None, placements=None, doid_range=(AVATAR_DOID_MIN, AVATAR_DOID_MAX),
+                 pending=None):
+        self.shard_id = shard_id
+        self.loads = loads  # multiprocessing.Array of avatar counts, or None when not sharded
+        self.pending = pending  # multiprocessing.Array of placements not spawned yet; shares the lock of `loads`
+        self.placements = placements  # One multiprocessing.Queue of client channels per shard
+        self.spawn_avatar = None  # Set by `attach()`; creates an avatar on this shard
+        self.doids = DoIdAllocator(*doid_range)
+
+    @property
+    def channel(self):
+        return ServicesChannel + self.shard_id
+
+    @property
+    def is_primary(self):
+        return self.shard_id == 0
+
+    def attach(self, repo, spawn_avatar):
+        self.spawn_avatar = lambda client_id: spawn_avatar(repo, client_id)
+        if self.loads is not None:
+            AI_TASKS.add_task(self.poll, priority=-10)
+
+    def least_loaded(self):
+        if self.loads is None:
+            return self.shard_id
+        with self.loads.get_lock():
+            return min(range(len(self.loads)), key=lambda shard_id: self.loads[shard_id] + self.pending[shard_id])
+
+    def place_avatar(self, client_id):
+        if self.loads is None:
+            self.spawn_avatar(client_id)
+            return
+        with self.loads.get_lock():  # An RLock, which `least_loaded()` takes again
+            target = self.least_loaded()
+            # Count it right away, so a login burst doesn't all go to the same shard.
+            self.pending[target] += 1
+        if target == self.shard_id:
+            self.spawned([client_id])
+        else:
+            self.placements[target].put(client_id)
+
+    def spawned(self, client_ids):
+        """
+        Spawns the avatars of placements on this shard, and publishes the count of
+        avatars along with taking them off the pending ones, so they aren't missing
+        from either in between.
+        """
+        for client_id in client_ids:
+            self.spawn_avatar(client_id)
+        with self.loads.get_lock():
+            self.pending[self.shard_id] -= len(client_ids)
+            self.loads[self.shard_id] = len(engine)
+
+    def poll(self, dt):
+        placements = self.placements[self.shard_id]
+        client_ids = []
+        while True:
+            try:
+                client_ids.append(placements.get_nowait())
+            except queue.Empty:
+                break
+        self.spawned(client_ids)
+
+
+class ShardSupervisor:
+    def __init__(self, count):
+        self.count = count
+        self.loads = multiprocessing.Array('i', count)
+        self.pending = multiprocessing.Array('i', count, lock=self.loads.get_lock())
+        self.placements = [multiprocessing.Queue() for _ in range(count)]
+        doids = DoIdAllocator(AVATAR_DOID_MIN, AVATAR_DOID_MAX)
+        block_size = (AVATAR_DOID_MAX - AVATAR_DOID_MIN + 1) // count
+        self.doid_ranges = []
+        for _ in range(count):
+            block = doids.lease(block_size)
+            self.doid_ranges.append((block.min_id, block.max_id))
+        self.processes = []
+
+    def run(self):
+        for shard_id in range(self.count):
+            process = multiprocessing.Process(target=run_shard, name="Services shard %d" % shard_id,
+                                              args=(shard_id, self.loads, self.placements,
+                                                    self.doid_ranges[shard_id], self.pending))
+            process.start()
+            self.processes.append(process)
+            print("Started Services shard %d (pid %d, channel %d)" % (shard_id, process.pid,
+                                                                        ServicesChannel + shard_id))
+        for process in self.processes:
+            process.join()
+            print("%s exited with code %s" % (process.name, process.exitcode))
+
+
+def run_shard(shard_id, loads, placements, doid_range, pending):
+    global context
+    context = ShardContext(shard_id, loads, placements, doid_range, pending)
+    from services import Services
+    Services()
+
+
+context = ShardContext()
@@ -0,0 +1,89 @@
+from collections import deque
+from globals import *
+from time import monotonic
+
+"""
+Client-side smoothing of avatar movement.
+
+Instead of snapping an avatar's model to every move received, each position is
+buffered with its arrival time, and models are drawn CLIENT_RENDER_DELAY seconds in
+the past, interpolated between the two samples around that time. When no newer
+sample has arrived yet (a late or dropped update), the model keeps moving along its
+last velocity for up to CLIENT_MAX_EXTRAPOLATION seconds, and then eases back to the
+newest sample, where it holds still.
+A single task moves the models of all avatars every frame.
+"""
+
+
+class Track:
+    __slots__ = ('model', 'samples')
+
+    def __init__(self, model):
+        self.model = model
+        self.samples = deque(maxlen=CLIENT_SAMPLE_BUFFER)  # (time, x, y, z, h), oldest first
+
+
+def lerp_heading(h0, h1, t):
+    # Along the shorter way around the circle
+    delta = (h1 - h0 + 180.0) % 360.0 - 180.0
+    return h0 + delta * t
+
+
+class PositionSmoother:
+    def __init__(self, render_delay=CLIENT_RENDER_DELAY, max_extrapolation=CLIENT_MAX_EXTRAPOLATION):
+        self.render_delay = render_delay
+        self.max_extrapolation = max_extrapolation
+        self.tracks = {}  # do_id -> Track
+        self.task = None
+
+    def start(self, task_mgr):
+        if self.task is None:
+            self.task = task_mgr.add(self.update, 'smooth avatars')
+
+    def track(self, do_id, model):
+        self.tracks[do_id] = Track(model)
+
+    def forget(self, do_id):
+        self.tracks.pop(do_id, None)
+
+    def add_sample(self, do_id, x, y, z, h, now=None):
+        track = self.tracks.get(do_id)
+        if track is None:
+            return
+        now = monotonic() if now is None else now
+        samples = track.samples
+        if not samples:
+            # Nothing to interpolate from yet; show it where it is right away
+            track.model.set_pos_hpr(x, y, z, h, 0, 0)
+        elif samples[-1][0] < now - self.render_delay:
+            # It stood still since its last update; start moving from there now, not back then
+            samples.append((now - self.render_delay, ) + samples[-1][1:])
+        samples.append((now, x, y, z, h))
+
+    def update(self, task, now=None):
+        render_time = (monotonic() if now is None else now) - self.render_delay
+        for track in self.tracks.values():
+            samples = track.samples
+            if len(samples) < 2:
+                continue
+            # Drop samples that are no longer needed to interpolate at render_time
+            while len(samples) > 2 and samples[1][0] <= render_time:
+                samples.popleft()
+            (t0, x0, y0, z0, h0), (t1, x1, y1, z1, h1) = samples[0], samples[1]
+            if render_time <= t0:
+                x, y, z, h = x0, y0, z0, h0
+            elif render_time <= t1:
+                f = (render_time - t0) / (t1 - t0) if t1 > t0 else 1.0
+                x, y, z, h = x0 + (x1 - x0) * f, y0 + (y1 - y0) * f, z0 + (z1 - z0) * f, lerp_heading(h0, h1, f)
+            else:
+                # Past the newest sample; extrapolate along the last velocity for a while,
+                # then ease back to the newest sample, as the avatar has likely stopped.
+                late = render_time - t1
+                ahead = late if late <= self.max_extrapolation else max(2.0 * self.max_extrapolation - late, 0.0)
+                f = ahead / (t1 - t0) if t1 > t0 else 0.0
+                x, y, z, h = x1 + (x1 - x0) * f, y1 + (y1 - y0) * f, z1 + (z1 - z0) * f, lerp_heading(h0, h1, 1.0 + f)
+            track.model.set_pos_hpr(x, y, z, h, 0, 0)
+        return task.cont
+
+
+smoother = PositionSmoother()
@@ -0,0 +1,11 @@
+"""
+Summary statistics of measurements, shared by the load and benchmark tools.
+"""
+
+
+def percentile(values, fraction):
+    # Nearest-rank: the value `fraction` of the way up the sorted values
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
@@ -0,0 +1,61 @@
+from auth import Authenticator, CredentialStore
+import asyncio
+import auth
+
+
+class RecordingStore(CredentialStore):
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def verify_many(self, credentials):
+        self.calls.append(credentials)
+        if self.fail:
+            raise IOError("store is down")
+        return [password == "right" for _, password in credentials]
+
+
+def verify_all(authenticator, credentials):
+    async def verify():
+        return await asyncio.gather(*[authenticator.verify(username, password) for username, password in credentials])
+    return asyncio.run(verify())
+
+
+def test_logins_of_one_iteration_are_batched():
+    store = RecordingStore()
+    authenticator = Authenticator(store, batch_size=2)
+    credentials = [("a", "right"), ("b", "wrong"), ("c", "right")]
+    assert verify_all(authenticator, credentials) == [True, False, True]
+    assert store.calls == [credentials[:2], credentials[2:]]
+
+
+def test_valid_credentials_are_cached_until_they_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(auth.time, 'monotonic', lambda: now[0])
+    store = RecordingStore()
+    authenticator = Authenticator(store, cache_ttl=10.0)
+    assert verify_all(authenticator, [("a", "right"), ("b", "wrong")]) == [True, False]
+    assert verify_all(authenticator, [("a", "right"), ("b", "wrong")]) == [True, False]
+    assert store.calls[1] == [("b", "wrong")]  # Invalid ones aren't cached
+
+    now[0] += 11.0
+    verify_all(authenticator, [("a", "right")])
+    assert store.calls[2] == [("a", "right")]
+
+
+def test_least_recently_used_credentials_are_evicted():
+    store = RecordingStore()
+    authenticator = Authenticator(store, cache_size=2)
+    verify_all(authenticator, [("a", "right"), ("b", "right")])
+    verify_all(authenticator, [("a", "right")])  # Now b is the least recently used
+    verify_all(authenticator, [("c", "right")])
+    store.calls = []
+    verify_all(authenticator, [("a", "right"), ("b", "right")])
+    assert store.calls == [[("b", "right")]]
+
+
+def test_logins_are_rejected_when_the_store_fails():
+    store = RecordingStore(fail=True)
+    authenticator = Authenticator(store)
+    assert verify_all(authenticator, [("a", "right"), ("b", "right")]) == [False, False]
+    assert not authenticator.cache
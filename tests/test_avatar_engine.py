@@ -0,0 +1,55 @@
+from avatar_engine import AvatarEngine
+from broadcast import MoveBroadcaster
+from globals import *
+from mocks import MockRepository, MockView
+from movement import step_move
+import avatar_engine
+import pytest
+
+FRAME = 1.0 / AI_FRAME_RATE
+
+
+@pytest.fixture
+def repo(monkeypatch):
+    # Moves go straight to the views, instead of this process' batches
+    monkeypatch.setattr(avatar_engine, 'moves', MoveBroadcaster(batching=False))
+    return MockRepository()
+
+
+def spawn(engine, repo, do_id):
+    view = MockView(repo, 'DistributedAvatar', do_id, DistributedWorldId, 0)
+    view.slot = engine.add(view)
+    return view
+
+
+def test_step_move_matches_the_engine():
+    engine = AvatarEngine(capacity=1)
+    slot = engine.add(MockView(None, 'DistributedAvatar', 1, DistributedWorldId, 0))
+    engine.set_intent(slot, 0.7, -1.0)
+    x, y, h = 0.0, 0.0, 0.0
+    for _ in range(100):
+        engine.step(FRAME)
+        x, y, h = step_move(x, y, h, 0.7, -1.0, FRAME)
+    assert (engine.x[slot], engine.y[slot], engine.h[slot]) == (x, y, h)
+
+
+def test_only_avatars_with_an_intent_move(repo):
+    engine = AvatarEngine(capacity=2)
+    moving, still = spawn(engine, repo, 1), spawn(engine, repo, 2)
+    engine.set_intent(moving.slot, 0.0, 1.0)
+    assert engine.step(FRAME).tolist() == [moving.slot]
+    assert engine.y[moving.slot] != 0.0 and engine.y[still.slot] == 0.0
+    engine.set_intent(moving.slot, 0.0, 0.0)
+    assert engine.step(FRAME).size == 0
+
+
+def test_slots_are_reused_and_grown(repo):
+    engine = AvatarEngine(capacity=1)
+    first = spawn(engine, repo, 1)
+    engine.x[first.slot] = 3.0
+    second = spawn(engine, repo, 2)
+    assert engine.capacity == 2 and engine.x[first.slot] == 3.0
+    engine.remove(first.slot)
+    assert len(engine) == 1
+    assert spawn(engine, repo, 3).slot == first.slot
+    assert engine.slots == {3: first.slot, 2: second.slot}
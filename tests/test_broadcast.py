@@ -0,0 +1,68 @@
+from avatar_engine import AvatarEngine
+from broadcast import MoveBroadcaster, UpdatePipeline
+from globals import *
+from mocks import MockRepository, MockView
+import avatar_engine
+import numpy as np
+
+FRAME = 1.0 / AI_FRAME_RATE
+
+
+def test_pipeline_sends_the_latest_update_once_per_frame():
+    repo = MockRepository()
+    view = MockView(repo, 'DistributedAvatar', 1, DistributedWorldId, 0)
+    pipeline = UpdatePipeline(max_rate=0)
+    pipeline.queue(view, 'set_move', 1)
+    pipeline.queue(view, 'set_move', 2)
+    pipeline.flush(FRAME)
+    assert [(field, args) for _, field, args in repo.updates] == [('set_move', (2, ))]
+
+
+def test_pipeline_drops_unchanged_updates():
+    repo = MockRepository()
+    view = MockView(repo, 'DistributedAvatar', 1, DistributedWorldId, 0)
+    pipeline = UpdatePipeline(max_rate=0)
+    pipeline.queue(view, 'set_move', 1)
+    pipeline.flush(FRAME)
+    pipeline.queue(view, 'set_move', 1)
+    pipeline.flush(FRAME)
+    assert len(repo.updates) == 1
+    assert pipeline.dropped == 1
+    # Until it's forgotten
+    pipeline.forget(1)
+    pipeline.queue(view, 'set_move', 1)
+    pipeline.flush(FRAME)
+    assert len(repo.updates) == 2
+
+
+def test_pipeline_rate_limits_per_object():
+    repo = MockRepository()
+    view = MockView(repo, 'DistributedAvatar', 1, DistributedWorldId, 0)
+    pipeline = UpdatePipeline(max_rate=AI_FRAME_RATE / 3.0)
+    sent = []
+    for frame in range(9):
+        pipeline.queue(view, 'set_move', frame)
+        pipeline.flush(FRAME)
+        sent += [args[0] for _, _, args in repo.updates]
+        repo.clear()
+    assert sent == [0, 3, 6]
+
+
+def test_engine_drops_unchanged_moves_and_holds_back_rate_limited_ones(monkeypatch):
+    monkeypatch.setattr(avatar_engine, 'moves', MoveBroadcaster(batching=False))
+    repo = MockRepository()
+    engine = AvatarEngine(capacity=1, max_rate=AI_FRAME_RATE / 2.0)
+    view = MockView(repo, 'DistributedAvatar', 1, DistributedWorldId, 0)
+    view.slot = engine.add(view)
+    idx = np.array([view.slot])
+    assert engine.broadcast(idx).size == 0
+    assert [field for _, field, _ in repo.updates] == ['set_move']
+    repo.clear()
+
+    engine.clock += FRAME
+    assert engine.broadcast(idx).size == 0  # Unchanged
+    engine.x[view.slot] += 0.1
+    assert engine.broadcast(idx).tolist() == [view.slot]  # Too soon
+    engine.clock += FRAME
+    assert engine.broadcast(idx).size == 0
+    assert [field for _, field, _ in repo.updates] == ['set_move_delta']
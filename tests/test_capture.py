@@ -0,0 +1,60 @@
+from capture import DATAGRAM_RECORD, TICK_RECORD, Recorder, read_capture, read_start
+from doid_allocator import DoIdAllocator
+from scheduler import TickScheduler
+from wire import *
+import pytest
+
+
+class Feed(StandInSocket):
+    fed = True
+
+
+class Repository:
+    def __init__(self):
+        self.socket = self.feed = Feed()
+
+    def receive(self, *datagrams):
+        for datagram in datagrams:
+            self.feed.pending += frame(datagram)
+        while True:
+            try:
+                self.socket.recv(7)  # Datagrams split across reads are logged whole
+            except BlockingIOError:
+                return
+
+
+@pytest.fixture
+def capture(tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    repo, scheduler, doids = Repository(), TickScheduler(10.0), DoIdAllocator(10, 20)
+    ids = [doids.allocate() for _ in range(3)]
+    doids.free(ids[1])
+    recorder = Recorder()
+    recorder.install(repo, scheduler, path, 2, doids)
+    repo.receive(b'first datagram', b'second')
+    scheduler.tick(0.1)
+    scheduler.tick(0.12)
+    repo.receive(b'third')
+    scheduler.tick(0.09)
+    recorder.file.close()
+    return path, ids
+
+
+def test_capture_round_trips(capture):
+    path, ids = capture
+    assert read_start(path) == (2, 10, 20, 13, [ids[0], ids[2]], [ids[1]])
+    assert list(read_capture(path)) == [(0, 0.1, [b'first datagram', b'second']), (1, 0.12, []),
+                                         (2, 0.09, [b'third'])]
+
+
+def test_truncated_capture_ends_with_its_last_complete_tick(capture):
+    path, _ = capture
+    with open(path, 'rb') as f:
+        data = f.read()
+    ticks = list(read_capture(path))
+    # The log ends with the third datagram's record and the last tick's
+    last = DATAGRAM_RECORD.size + len(b'third') + TICK_RECORD.size
+    for cut in range(1, last + TICK_RECORD.size + 1):
+        with open(path, 'wb') as f:
+            f.write(data[:-cut])
+        assert list(read_capture(path)) == ticks[:2 if cut <= last else 1]
@@ -0,0 +1,102 @@
+from avatar_engine import AvatarEngine
+from broadcast import MoveBroadcaster
+from doid_allocator import DoIdAllocator
+from globals import *
+from interest import InterestGrid
+from mocks import MockRepository, MockView
+import checkpoint
+import os
+import pytest
+
+
+@pytest.fixture
+def checkpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint, 'engine', AvatarEngine(capacity=4))
+    monkeypatch.setattr(checkpoint, 'grid', InterestGrid())
+    monkeypatch.setattr(checkpoint, 'moves', MoveBroadcaster())
+    checkpoints = checkpoint.Checkpointer()
+    checkpoints.path = str(tmp_path / 'checkpoint.bin')
+    checkpoints.doids = DoIdAllocator(AVATAR_DOID_MIN, AVATAR_DOID_MAX)
+    return checkpoints
+
+
+def spawn(repo, checkpoints, x):
+    view = MockView(repo, 'DistributedAvatar', checkpoints.doids.allocate(), DistributedWorldId, 5)
+    view.slot = checkpoint.engine.add(view)
+    checkpoint.engine.x[view.slot] = x
+    checkpoint.engine.set_intent(view.slot, 1.0, 0.5, 7)
+    return view
+
+
+def test_reads_back_the_last_checkpoint(checkpoints):
+    repo = MockRepository()
+    views = [spawn(repo, checkpoints, float(x)) for x in range(3)]
+    checkpoints.write()
+    checkpoint.engine.x[views[0].slot] = 42.0
+    checkpoints.write()
+    records, next_fresh, _ = checkpoints.read()
+    assert records['do_id'].tolist() == [view.do_id for view in views]
+    assert records['x'].tolist() == [42.0, 1.0, 2.0]
+    assert records['intent_seq'].tolist() == [7, 7, 7]
+    assert next_fresh == checkpoints.doids.next_fresh
+
+
+def test_replaces_the_file_once_the_new_one_is_complete(checkpoints):
+    repo = MockRepository()
+    spawn(repo, checkpoints, 1.0)
+    checkpoints.write()
+    for x in range(8):  # More than the file has room for
+        spawn(repo, checkpoints, float(x))
+    checkpoints.open(16)
+    assert checkpoints.replacing
+    assert len(checkpoints.read()[0]) == 1  # Still the previous one
+    checkpoints.write()
+    assert not os.path.exists(checkpoints.path + '.new')
+    assert len(checkpoints.read()[0]) == 9
+
+
+def test_restores_the_avatars_that_come_back(checkpoints, monkeypatch):
+    repo = MockRepository()
+    views = [spawn(repo, checkpoints, float(x)) for x in range(2)]
+    checkpoint.engine.owner[views[0].slot] = 100100
+    checkpoints.write()
+
+    # The next run of the shard
+    monkeypatch.setattr(checkpoint, 'engine', AvatarEngine(capacity=4))
+    checkpoints.doids = DoIdAllocator(AVATAR_DOID_MIN, AVATAR_DOID_MAX)
+    repo.clear()
+    checkpoints.restore(repo, ServicesChannel)
+    assert repo.messages[:2] == [('send_STATESERVER_OBJECT_SET_AI', (views[0].do_id, 0)),
+                                 ('send_STATESERVER_OBJECT_SET_AI', (views[0].do_id, ServicesChannel))]
+    assert checkpoints.doids.allocate() == views[1].do_id + 1
+
+    view = MockView(repo, 'DistributedAvatar', views[0].do_id, DistributedWorldId, 5)
+    view.slot = checkpoint.engine.add(view)
+    assert checkpoints.adopt(view)
+    assert checkpoint.engine.owner[view.slot] == 100100
+    assert checkpoint.engine.turn[view.slot] == 1.0
+
+    # The other one never comes back
+    checkpoints.expire()
+    assert checkpoints.doids.allocate() == views[1].do_id
+
+
+def test_takes_the_move_batches_back(checkpoints, monkeypatch):
+    repo = MockRepository()
+    batches = {zone: MockView(repo, 'DistributedMoveBatch', checkpoints.doids.allocate(), DistributedWorldId, zone)
+               for zone in (0, 1)}
+    checkpoint.moves.batches.update(batches)
+    checkpoints.write()
+
+    monkeypatch.setattr(checkpoint, 'moves', MoveBroadcaster())
+    checkpoints.doids = DoIdAllocator(AVATAR_DOID_MIN, AVATAR_DOID_MAX)
+    checkpoints.restore(repo, ServicesChannel)
+    assert checkpoints.batch_zones() == {0, 1}
+    assert checkpoints.doids.is_used(batches[0].do_id) and checkpoints.doids.is_used(batches[1].do_id)
+    assert checkpoints.adopt_batch(batches[0])
+
+    # Only the zone whose batch never comes back gets a new one, under the freed doId
+    repo.clear()
+    checkpoints.expire()
+    assert repo.objects[batches[1].do_id].zone == 1
+    assert len(repo.objects) == 1
@@ -0,0 +1,58 @@
+from doid_allocator import DoIdAllocator
+import pytest
+
+
+def test_allocates_fresh_ids_in_order():
+    doids = DoIdAllocator(10, 20)
+    assert [doids.allocate() for _ in range(3)] == [10, 11, 12]
+    assert len(doids) == 3
+
+
+def test_reuses_freed_ids_first():
+    doids = DoIdAllocator(10, 20)
+    ids = [doids.allocate() for _ in range(3)]
+    doids.free(ids[0])
+    doids.free(ids[2])
+    assert doids.allocate() == ids[2]
+    assert doids.allocate() == ids[0]
+    assert doids.allocate() == 13
+
+
+def test_ignores_double_and_foreign_frees():
+    doids = DoIdAllocator(10, 20)
+    do_id = doids.allocate()
+    doids.free(do_id)
+    doids.free(do_id)
+    doids.free(99)
+    assert doids.free_ids == [do_id]
+
+
+def test_raises_once_exhausted():
+    doids = DoIdAllocator(10, 11)
+    doids.allocate()
+    doids.allocate()
+    with pytest.raises(RuntimeError):
+        doids.allocate()
+
+
+def test_lease_hands_over_a_block_of_fresh_ids():
+    doids = DoIdAllocator(10, 29)
+    doids.allocate()
+    block = doids.lease(5)
+    assert (block.min_id, block.max_id) == (11, 15)
+    assert doids.allocate() == 16
+    with pytest.raises(RuntimeError):
+        doids.lease(100)
+
+
+def test_restore_resumes_another_allocator():
+    previous = DoIdAllocator(10, 20)
+    ids = [previous.allocate() for _ in range(5)]
+    previous.free(ids[1])
+    previous.free(ids[3])
+    assert previous.used_ids() == [ids[0], ids[2], ids[4]]
+
+    doids = DoIdAllocator(10, 20)
+    doids.restore(previous.next_fresh, previous.used_ids(), previous.free_ids)
+    assert [doids.allocate() for _ in range(3)] == [previous.allocate() for _ in range(3)]
+    assert doids.is_used(ids[0]) and doids.is_used(ids[2])
@@ -0,0 +1,44 @@
+from globals import *
+from interest import InterestGrid
+from mocks import MockRepository
+import numpy as np
+
+
+def avatars(grid, positions):
+    x = np.array([p[0] for p in positions], dtype=float)
+    y = np.array([p[1] for p in positions], dtype=float)
+    cell = grid.cells_at(x, y)
+    return x, y, cell, np.arange(len(positions))
+
+
+def test_crossed_only_past_the_hysteresis():
+    grid = InterestGrid(cells=4, hysteresis=1.0)
+    x, y, cell, idx = avatars(grid, [(WORLD_MIN + 1.0, WORLD_MIN + 1.0), (0.5, 0.5)])
+    assert grid.crossed(x, y, cell, idx)[0].size == 0
+
+    border = WORLD_MIN + grid.cell_size
+    x[0] = border + 0.5  # Across the border, but within the hysteresis
+    assert grid.crossed(x, y, cell, idx)[0].size == 0
+    x[0] = border + 1.5
+    crossed, cells = grid.crossed(x, y, cell, idx)
+    assert crossed.tolist() == [0]
+    assert cells.tolist() == [cell[0] + 1]
+
+
+def test_neighbour_zones_stay_on_the_map():
+    grid = InterestGrid(cells=4)
+    assert sorted(grid.neighbour_zones(0)) == [0, 1, 4, 5]
+    assert len(grid.neighbour_zones(5)) == 9
+
+
+def test_set_interest_keeps_the_zones_gained():
+    grid = InterestGrid(cells=4)
+    repo = MockRepository()
+    grid.enter(repo, 1000000, 100100, 0)
+    assert grid.gained == {0, 1, 4, 5}
+    assert repo.messages == [('send_CLIENTAGENT_ADD_INTEREST_MULTIPLE', (100100, 0, DistributedWorldId, [0, 1, 4, 5]))]
+    grid.gained.clear()
+    grid.set_interest(repo, 100100, 1)
+    assert grid.gained == {2, 6}
+    grid.leave(1000000)
+    assert 100100 not in grid.interests
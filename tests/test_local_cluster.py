@@ -0,0 +1,278 @@
+from dcfields import get_index
+from globals import *
+from local_cluster import LocalCluster, CLIENT_STATE_ESTABLISHED
+from runtime import runtime
+from wire import *
+import asyncio
+import numpy as np
+import pytest
+import socket
+
+AI_CHANNEL = ServicesChannel
+AVATAR_ID = 1000000
+AVATAR_ZONE = 5
+REQUIRED = b'required fields, stored as sent'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((MD_HOST, 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def cluster():
+    cluster = LocalCluster(MD_HOST, free_port(), CA_HOST, free_port())
+    cluster.start()
+    yield cluster
+    cluster.stop()
+
+
+class Connection:
+    """
+    A raw socket to the cluster, that reads the datagrams it's sent in order.
+    """
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, timeout=5.0)
+        self.stream = DatagramStream()
+        self.received = []
+
+    def send(self, writer):
+        self.sock.sendall(frame(writer.data()))
+
+    def next(self):
+        while not self.received:
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.received += self.stream.feed(data)
+        return self.received.pop(0)
+
+    def expect(self, msgtype):
+        # Skips datagrams until one of `msgtype`, and returns a reader at its body
+        while True:
+            datagram = self.next()
+            assert datagram is not None, "closed while expecting message type %d" % (msgtype, )
+            found, reader = self.read(datagram)
+            if found == msgtype:
+                return reader
+
+    def closed(self):
+        while True:
+            if self.next() is None:
+                return True
+
+    def close(self):
+        self.sock.close()
+
+
+class AI(Connection):
+    def __init__(self, cluster, channel=AI_CHANNEL):
+        Connection.__init__(self, cluster.md_address)
+        self.channel = channel
+        self.created = set()
+        # Control messages have no sender
+        self.send(DatagramWriter().uint8(1).uint64(CONTROL_CHANNEL).uint16(CONTROL_ADD_CHANNEL).uint64(channel))
+
+    def read(self, datagram):
+        _, _, msgtype, reader = read_internal_header(datagram)
+        return msgtype, reader
+
+    def message(self, recipient, msgtype):
+        return internal_datagram([recipient], self.channel, msgtype)
+
+    def create(self, dclass, do_id, parent, zone):
+        self.send(self.message(SSChannel, STATESERVER_CREATE_OBJECT_WITH_REQUIRED).uint32(do_id)
+                  .uint32(parent).uint32(zone).uint16(get_index().class_numbers[dclass]).raw(REQUIRED))
+        # Taking it on as its AI confirms the State Server has it
+        self.send(self.message(do_id, STATESERVER_OBJECT_SET_AI).uint64(self.channel))
+        reader = self.expect(STATESERVER_OBJECT_ENTER_AI_WITH_REQUIRED)
+        assert reader.uint32() == do_id
+
+    def create_avatar(self, do_id=AVATAR_ID, zone=AVATAR_ZONE):
+        if DistributedWorldId not in self.created:
+            self.create('DistributedWorld', DistributedWorldId, RootID, WORLD_ZONE)
+            self.created.add(DistributedWorldId)
+        self.create('DistributedAvatar', do_id, DistributedWorldId, zone)
+
+    def set_field(self, do_id, field, *args):
+        writer = self.message(do_id, STATESERVER_OBJECT_SET_FIELD).uint32(do_id).uint16(field)
+        for fmt, value in args:
+            writer.add(fmt, value)
+        self.send(writer)
+
+
+class Client(Connection):
+    def __init__(self, cluster, version=VERSION_STRING):
+        Connection.__init__(self, cluster.ca_address)
+        self.version = version
+
+    def read(self, datagram):
+        reader = DatagramReader(datagram)
+        return reader.uint16(), reader
+
+    def hello(self):
+        self.send(client_datagram(CLIENT_HELLO).uint32(0).string(self.version))
+
+
+def connect_client(cluster, ai, zone=AVATAR_ZONE):
+    # A client with interest in `zone` of the world, set up by the AI; the objects
+    # in the zone are queued for it to read next
+    client = Client(cluster)
+    client.hello()
+    client.expect(CLIENT_HELLO_RESP)
+    channel = max(cluster.client_agent.connections)  # The newest one
+    ai.send(ai.message(channel, CLIENTAGENT_ADD_INTEREST).uint16(1).uint32(DistributedWorldId).uint32(zone))
+    client.expect(CLIENT_ADD_INTEREST)
+    return client, channel
+
+
+def test_hello_and_eject(cluster):
+    client = Client(cluster)
+    client.hello()
+    client.expect(CLIENT_HELLO_RESP)
+
+    outdated = Client(cluster, version='something older')
+    outdated.hello()
+    assert outdated.expect(CLIENT_EJECT).uint16() == 124
+    assert outdated.closed()
+
+    rude = Client(cluster)
+    rude.send(client_datagram(CLIENT_HEARTBEAT))
+    assert rude.expect(CLIENT_EJECT).uint16() == 107
+    assert rude.closed()
+
+
+def test_objects_enter_with_interest(cluster):
+    ai = AI(cluster)
+    ai.create_avatar()
+    client, channel = connect_client(cluster, ai)
+    reader = client.expect(CLIENT_ENTER_OBJECT_REQUIRED)
+    assert (reader.uint32(), reader.uint32(), reader.uint32()) == (AVATAR_ID, DistributedWorldId, AVATAR_ZONE)
+    assert reader.uint16() == get_index().class_numbers['DistributedAvatar']
+    assert reader.remainder() == REQUIRED
+
+    # Nothing enters from zones the client has no interest in
+    elsewhere, _ = connect_client(cluster, ai, zone=AVATAR_ZONE + 1)
+    ai.create_avatar(AVATAR_ID + 1, zone=AVATAR_ZONE + 1)
+    assert elsewhere.expect(CLIENT_ENTER_OBJECT_REQUIRED).uint32() == AVATAR_ID + 1
+    assert list(cluster.client_agent.connections[channel].visible) == [AVATAR_ID]
+
+
+def test_set_field_goes_where_its_keywords_say(cluster):
+    dc = get_index()
+    ai = AI(cluster)
+    ai.create_avatar()
+    owner, channel = connect_client(cluster, ai)
+    bystander, _ = connect_client(cluster, ai)
+    ai.send(ai.message(AVATAR_ID, STATESERVER_OBJECT_SET_OWNER).uint64(channel))
+    reader = owner.expect(CLIENT_ENTER_OBJECT_REQUIRED_OWNER)
+    assert reader.uint32() == AVATAR_ID
+    ai.send(ai.message(channel, CLIENTAGENT_SET_STATE).uint16(CLIENT_STATE_ESTABLISHED))
+
+    # broadcast: everyone with interest in the zone
+    set_move = dc.field_number('DistributedAvatar', 'set_move')
+    ai.set_field(AVATAR_ID, set_move, ('<I', 1234))
+    for client in (owner, bystander):
+        reader = client.expect(CLIENT_OBJECT_SET_FIELD)
+        assert (reader.uint32(), reader.uint16(), reader.uint32()) == (AVATAR_ID, set_move, 1234)
+
+    # ownsend airecv: from the owner only, to the AI
+    intent = dc.field_number('DistributedAvatar', 'indicate_intent')
+    owner.send(client_datagram(CLIENT_OBJECT_SET_FIELD).uint32(AVATAR_ID).uint16(intent)
+               .uint16(7).add('<h', 0).add('<h', 10))
+    reader = ai.expect(STATESERVER_OBJECT_SET_FIELD)
+    assert (reader.uint32(), reader.uint16(), reader.uint16()) == (AVATAR_ID, intent, 7)
+
+    # ownrecv: the owner only
+    ack = dc.field_number('DistributedAvatar', 'ack_move')
+    ai.set_field(AVATAR_ID, ack, ('<H', 7), ('<H', 100), ('<i', 0), ('<i', 0), ('<H', 0))
+    ai.set_field(AVATAR_ID, set_move, ('<I', 5678))
+    reader = owner.expect(CLIENT_OBJECT_SET_FIELD)
+    assert (reader.uint32(), reader.uint16()) == (AVATAR_ID, ack)
+    reader = bystander.expect(CLIENT_OBJECT_SET_FIELD)
+    assert (reader.uint32(), reader.uint16(), reader.uint32()) == (AVATAR_ID, set_move, 5678)
+
+    # Not clsend, and not the bystander's to send
+    bystander.send(client_datagram(CLIENT_OBJECT_SET_FIELD).uint32(AVATAR_ID).uint16(intent)
+                   .uint16(8).add('<h', 0).add('<h', 0))
+    assert bystander.expect(CLIENT_EJECT).uint16() == 113
+
+
+def test_session_objects_are_deleted_on_disconnect(cluster):
+    ai = AI(cluster)
+    ai.create_avatar()
+    owner, channel = connect_client(cluster, ai)
+    bystander, _ = connect_client(cluster, ai)
+    bystander.expect(CLIENT_ENTER_OBJECT_REQUIRED)
+    ai.send(ai.message(channel, CLIENTAGENT_ADD_SESSION_OBJECT).uint32(AVATAR_ID))
+    owner.send(client_datagram(CLIENT_DISCONNECT))
+    assert owner.closed()
+
+    assert ai.expect(STATESERVER_OBJECT_DELETE_RAM).uint32() == AVATAR_ID
+    assert bystander.expect(CLIENT_OBJECT_LEAVING).uint32() == AVATAR_ID
+    assert AVATAR_ID not in cluster.state_server.objects
+
+
+@pytest.fixture
+def listeners():
+    pytest.importorskip("astron.object_repository")
+    import views
+    events = {"avatar_ov": [], "set_move": []}
+    previous = dict(views.HEADLESS_LISTENERS)
+    views.HEADLESS_LISTENERS.update({event: [received.append] for event, received in events.items()})
+    yield events
+    views.HEADLESS_LISTENERS.clear()
+    views.HEADLESS_LISTENERS.update(previous)
+
+
+async def login_and_move(cluster, events):
+    from astron.object_repository import ClientRepository
+    from avatar_engine import engine
+    from services import Services
+    runtime.loop = asyncio.get_running_loop()
+
+    services = Services(connect=False)
+    connected = []
+    services.ir.connect(lambda: connected.append(True), lambda: pytest.fail("AI connection failed"),
+                        host=cluster.md_address[0], port=cluster.md_address[1])
+    client = ClientRepository(VERSION_STRING, DC_FILE)
+
+    async def pump(until, seconds=5.0):
+        # What the Services and client main loops would do, until `until()` holds
+        for _ in range(int(seconds * AI_FRAME_RATE)):
+            services.ir.poll_till_empty()
+            client.poll_till_empty()
+            if until():
+                return
+            AI_TASKS.tick(1.0 / AI_FRAME_RATE)
+            await runtime.settle()
+            await asyncio.sleep(0.005)
+        pytest.fail("timed out")
+
+    await pump(lambda: connected)
+    services.setup(checkpoint=False, instrument=False, capture=False)
+
+    def logged_in():
+        client.create_distobjglobal_view("AnonymousContact", AnonymousContactID).login("guest", "guest")
+    client.connect(logged_in, lambda: pytest.fail("client connection failed"),
+                   lambda code, reason: pytest.fail("ejected: %s %s" % (code, reason)),
+                   host=cluster.ca_address[0], port=cluster.ca_address[1])
+    await pump(lambda: events["avatar_ov"])
+    owner_view = events["avatar_ov"][0]
+    slot = engine.slots[owner_view.do_id]
+
+    owner_view.indicate_intent(0.0, 1.0, owner_view.predictor.sample(0.0, 1.0, 0.0))
+    await pump(lambda: engine.forward[slot] == 1.0)
+    await pump(lambda: abs(engine.y[slot]) > 1.0)
+    owner_view.indicate_intent(0.0, 0.0, owner_view.predictor.sample(0.0, 0.0, 0.0))
+    await pump(lambda: engine.forward[slot] == 0.0 and slot not in engine.settling)
+    position = tuple(int(q[0]) for q in engine.quantized(np.array([slot])))
+    await pump(lambda: owner_view.move == position)
+    return owner_view
+
+
+def test_login_and_movement(cluster, listeners):
+    owner_view = asyncio.run(login_and_move(cluster, listeners))
+    assert listeners["set_move"]
+    assert owner_view.predictor.acked is not None
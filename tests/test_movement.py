@@ -0,0 +1,110 @@
+from avatar_engine import AvatarEngine
+from broadcast import KEYFRAME_RECORD, DELTA_RECORD, MoveBroadcaster
+from globals import *
+from mocks import MockRepository, MockView
+from movement import *
+import avatar_engine
+import numpy as np
+import struct
+
+
+def test_pack_round_trips():
+    for move in ((0, 0, 0), (XY_STEPS, XY_STEPS, H_STEPS - 1), (123, 4000, 77)):
+        assert unpack_move(pack_move(*move)) == move
+
+
+def test_quantize_is_within_half_a_step():
+    x, y, h = dequantize(*quantize(WORLD_MIN + 1.234, WORLD_MAX - 5.678, 359.9))
+    assert abs(x - (WORLD_MIN + 1.234)) <= 0.5 / XY_SCALE
+    assert abs(y - (WORLD_MAX - 5.678)) <= 0.5 / XY_SCALE
+    assert quantize(WORLD_MIN - 1.0, WORLD_MAX + 1.0, 0.0)[:2] == (0, XY_STEPS)  # Clamped to the map
+    assert quantize(0.0, 0.0, 359.9)[2] == 0  # Rounds around the circle
+
+
+def test_move_delta():
+    assert move_delta((100, 100, 10), (105, 90, 20)) == (5, -10, 10)
+    # The shorter way around the circle
+    assert move_delta((0, 0, H_STEPS - 2), (0, 0, 3)) == (0, 0, 5)
+    assert move_delta((0, 0, 0), (200, 0, 0)) is None
+
+
+def test_apply_delta_wraps_the_heading():
+    assert apply_delta((10, 10, H_STEPS - 1), 1, -1, 3) == (11, 9, 2)
+
+
+def test_batch_round_trips():
+    keyframes = [(1000000, pack_move(1, 2, 3)), (1000001, pack_move(4, 5, 6))]
+    deltas = [(1000002, -1, 0, 127), (1000003, 5, -128, 0)]
+    assert decode_batch(encode_batch(keyframes, deltas)) == (keyframes, deltas)
+    assert decode_batch(encode_batch([], [])) == ([], [])
+
+
+def test_merged_batches_move_as_far_as_both():
+    older = encode_batch([(1, pack_move(10, 10, 10))], [(2, 1, 1, 1), (3, 100, 0, 0)])
+    newer = encode_batch([(4, pack_move(7, 7, 7))], [(1, 2, -2, 1), (2, 3, 3, 3), (5, 1, 0, 0)])
+    keyframes, deltas = decode_batch(merge_batches(older, newer))
+    assert dict(keyframes) == {1: pack_move(12, 8, 11), 4: pack_move(7, 7, 7)}
+    assert sorted(deltas) == [(2, 4, 4, 4), (3, 100, 0, 0), (5, 1, 0, 0)]
+    # Deltas that don't add up to one that fits
+    assert merge_batches(older, encode_batch([], [(3, 100, 0, 0)])) is None
+
+
+def test_batch_records_have_the_layout_of_encode_batch():
+    keyframes = np.array([(1, 2), (3, 4)], dtype=KEYFRAME_RECORD)
+    deltas = np.array([(5, -1, 2, -3)], dtype=DELTA_RECORD)
+    blob = struct.pack('<H', len(keyframes)) + keyframes.tobytes() + deltas.tobytes()
+    assert blob == encode_batch([(1, 2), (3, 4)], [(5, -1, 2, -3)])
+
+
+def test_moves_are_batched_as_keyframes_then_deltas():
+    repo = MockRepository()
+    moves = MoveBroadcaster(keyframe_interval=3)
+    moves.batches[0] = MockView(repo, 'DistributedMoveBatch', 99, DistributedWorldId, 0)
+    engine = AvatarEngine(capacity=2)
+    idx = np.array([engine.add(MockView(repo, 'DistributedAvatar', do_id, DistributedWorldId, 0))
+                    for do_id in (1, 2)])
+    client = {}
+    for step in range(6):
+        qx, qy, qh = np.array([10 + step, 20]), np.array([30, 40 - step]), np.array([0, 5])
+        moves.send(engine, idx, qx, qy, qh)
+        moves.flush()
+        (_, field, (blob, )), = repo.updates
+        repo.clear()
+        keyframes, deltas = decode_batch(blob)
+        assert len(keyframes) == (2 if step % 4 == 0 else 0)
+        for do_id, packed in keyframes:
+            client[do_id] = unpack_move(packed)
+        for do_id, dx, dy, dh in deltas:
+            client[do_id] = apply_delta(client[do_id], dx, dy, dh)
+        assert client == {1: (10 + step, 30, 0), 2: (20, 40 - step, 5)}
+    assert (moves.keyframes, moves.deltas) == (4, 8)
+
+
+def test_moves_of_zones_without_a_batch_are_sent_alone():
+    repo = MockRepository()
+    moves = MoveBroadcaster()
+    engine = AvatarEngine(capacity=1)
+    idx = np.array([engine.add(MockView(repo, 'DistributedAvatar', 1, DistributedWorldId, 0))])
+    moves.send(engine, idx, np.array([5]), np.array([5]), np.array([5]))
+    moves.send(engine, idx, np.array([6]), np.array([5]), np.array([5]))
+    moves.send(engine, idx, np.array([6]), np.array([5]), np.array([5]), keyframes=True)
+    moves.flush()
+    assert [field for _, field, _ in repo.updates] == ['set_move', 'set_move_delta', 'set_move']
+
+
+def test_stopping_sends_a_keyframe_and_standing_still_one_per_interval(monkeypatch):
+    monkeypatch.setattr(avatar_engine, 'moves', MoveBroadcaster(batching=False))
+    repo = MockRepository()
+    engine = AvatarEngine(capacity=1, max_rate=0)
+    slot = engine.add(MockView(repo, 'DistributedAvatar', 1, DistributedWorldId, 0))
+    engine.set_intent(slot, 0.0, 1.0)
+    for _ in range(3):
+        engine.tick(1.0 / AI_FRAME_RATE)
+    repo.clear()
+    engine.set_intent(slot, 0.0, 0.0)
+    engine.tick(1.0 / AI_FRAME_RATE)
+    assert [field for _, field, _ in repo.updates] == ['set_move']
+    repo.clear()
+    for _ in range(int(2 * MOVE_IDLE_KEYFRAME_INTERVAL * AI_FRAME_RATE)):
+        engine.tick(1.0 / AI_FRAME_RATE)
+    assert [field for _, field, _ in repo.updates] == ['set_move', 'set_move']
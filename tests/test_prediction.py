@@ -0,0 +1,51 @@
+from globals import *
+from movement import step_move
+from prediction import Predictor
+
+
+def test_only_changed_intents_are_sent():
+    predictor = Predictor()
+    assert predictor.sample(0.0, 0.0, 0.1) is None
+    seq = predictor.sample(1.0, 1.0, 0.1)
+    assert seq == predictor.seq
+    assert predictor.sample(1.0, 1.0, 0.1) is None
+    assert predictor.sample(0.0, 1.0, 0.1) == predictor.seq
+
+
+def test_held_intents_are_sent_again():
+    predictor = Predictor()
+    frame = 0.5
+    predictor.sample(0.0, 1.0, frame)
+    sent = [predictor.sample(0.0, 1.0, frame) for _ in range(int(CLIENT_INTENT_REFRESH / frame) + 1)]
+    assert len([seq for seq in sent if seq is not None]) == 1
+    # Not while standing still, though
+    predictor.sample(0.0, 0.0, frame)
+    assert all(predictor.sample(0.0, 0.0, frame) is None for _ in range(int(CLIENT_INTENT_REFRESH / frame) + 1))
+
+
+def test_reconcile_replays_what_the_ai_hasnt_simulated():
+    frame = 1.0 / 60.0
+    predictor = Predictor()
+    predictor.reconcile(0, 0, 0.0, 0.0, 0.0)
+    seq = predictor.sample(1.0, 1.0, frame)
+    for _ in range(9):
+        predictor.sample(1.0, 1.0, frame)
+    predicted = predictor.state
+
+    # The AI got the intent after the first 4 frames, and has simulated it for 3 since
+    x, y, h = 0.0, 0.0, 0.0
+    for _ in range(3):
+        x, y, h = step_move(x, y, h, 1.0, 1.0, frame)
+    predictor.reconcile(seq, 3 * frame, x, y, h)
+    assert predictor.error < 1e-6
+    assert predictor.state == predicted
+    assert len(predictor.inputs) == 7
+
+
+def test_reconcile_corrects_the_prediction():
+    predictor = Predictor()
+    predictor.reconcile(0, 0, 0.0, 0.0, 0.0)
+    seq = predictor.sample(0.0, 1.0, 0.1)
+    predictor.reconcile(seq, 0.0, 5.0, 5.0, 0.0)
+    assert predictor.error > 1.0
+    assert predictor.state == step_move(5.0, 5.0, 0.0, 0.0, 1.0, 0.1)
@@ -0,0 +1,114 @@
+from dcfields import get_index
+from movement import decode_batch, encode_batch, pack_move
+from receiver import BudgetedReceiver
+from wire import *
+import pytest
+import socket
+import struct
+
+AVATAR_ID, OTHER_ID, BATCH_ID = 1000, 1001, 2000
+
+
+class Repository:
+    """
+    Reads its socket like a ClientRepository does, and keeps what it read.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.stream = DatagramStream()
+        self.datagrams = []
+
+    def poll_till_empty(self):
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except BlockingIOError:
+                return
+            self.datagrams += self.stream.feed(data)
+
+    def updates(self):
+        updates = []
+        for datagram in self.datagrams:
+            reader = DatagramReader(datagram, 2)
+            updates.append((reader.uint32(), get_index().fields[reader.uint16()].name, reader.remainder()))
+        return updates
+
+
+@pytest.fixture
+def connection():
+    server, client = socket.socketpair()
+    repo = Repository(client)
+    yield server, repo, BudgetedReceiver(repo, budget=1.0)
+    server.close()
+    client.close()
+
+
+def update(do_id, field, args):
+    number = get_index().field_number('DistributedAvatar' if field != 'set_moves' else 'DistributedMoveBatch', field)
+    return client_datagram(CLIENT_OBJECT_SET_FIELD).uint32(do_id).uint16(number).raw(args)
+
+
+def set_move(do_id, move):
+    return update(do_id, 'set_move', struct.pack('<I', move))
+
+
+def set_move_delta(do_id, dx):
+    return update(do_id, 'set_move_delta', struct.pack('<bbb', dx, 0, 0))
+
+
+def set_moves(keyframes, deltas):
+    return update(BATCH_ID, 'set_moves', DatagramWriter().blob(encode_batch(keyframes, deltas)).data())
+
+
+def send(server, *writers):
+    server.sendall(b''.join(frame(writer.data()) for writer in writers))
+
+
+def test_moves_behind_a_newer_keyframe_are_dropped(connection):
+    server, repo, receiver = connection
+    send(server, set_move(AVATAR_ID, 1), set_move_delta(AVATAR_ID, 1), set_move(OTHER_ID, 5),
+         set_move(AVATAR_ID, 2), set_move_delta(AVATAR_ID, 3))
+    receiver.poll()
+    assert [(do_id, field) for do_id, field, _ in repo.updates()] == [
+        (OTHER_ID, 'set_move'), (AVATAR_ID, 'set_move'), (AVATAR_ID, 'set_move_delta')]
+    assert receiver.coalesced_count == 2
+
+
+def test_deltas_are_never_dropped_on_their_own(connection):
+    server, repo, receiver = connection
+    send(server, set_move_delta(AVATAR_ID, 1), set_move_delta(AVATAR_ID, 2))
+    receiver.poll()
+    assert [args for _, _, args in repo.updates()] == [struct.pack('<bbb', 1, 0, 0), struct.pack('<bbb', 2, 0, 0)]
+
+
+def test_queued_batches_are_merged_into_the_newest(connection):
+    server, repo, receiver = connection
+    send(server, set_moves([(AVATAR_ID, pack_move(1, 1, 1))], [(OTHER_ID, 1, 0, 0)]),
+         set_moves([], [(AVATAR_ID, 2, 0, 0), (OTHER_ID, 3, 0, 0)]))
+    receiver.poll()
+    (do_id, field, args), = repo.updates()
+    assert (do_id, field) == (BATCH_ID, 'set_moves')
+    keyframes, deltas = decode_batch(DatagramReader(args).blob())
+    assert keyframes == [(AVATAR_ID, pack_move(3, 1, 1))]
+    assert deltas == [(OTHER_ID, 4, 0, 0)]
+
+
+def test_released_batches_are_not_merged_into(connection):
+    server, repo, receiver = connection
+    send(server, set_moves([], [(OTHER_ID, 1, 0, 0)]))
+    receiver.poll()
+    send(server, set_moves([], [(OTHER_ID, 2, 0, 0)]))
+    receiver.poll()
+    assert len(repo.updates()) == 2
+    assert receiver.coalesced_count == 0
+
+
+def test_what_doesnt_fit_the_budget_waits_for_the_next_frame(connection):
+    server, repo, receiver = connection
+    receiver.budget, receiver.batch = 0.0, 1
+    send(server, set_move(AVATAR_ID, 1), set_move(OTHER_ID, 2))
+    receiver.poll()
+    assert repo.updates() == []
+    receiver.budget = 1.0
+    receiver.poll()
+    assert len(repo.updates()) == 2
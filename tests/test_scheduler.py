@@ -0,0 +1,68 @@
+from scheduler import TickScheduler
+import scheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_delay_paces_frames_against_deadlines(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler, 'perf_counter', clock)
+    tasks = TickScheduler(10.0, max_catchup=5)
+    assert abs(tasks.delay() - 0.1) < 1e-9
+    # Time spent working comes off the sleep
+    clock.now += 0.13
+    assert abs(tasks.delay() - 0.07) < 1e-9
+
+
+def test_delay_starts_over_after_an_overrun(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler, 'perf_counter', clock)
+    tasks = TickScheduler(10.0, max_catchup=5)
+    tasks.delay()
+    clock.now += 0.35
+    # No frames back to back; the next one runs right away, and makes up for the time
+    assert tasks.delay() == 0.0
+    assert tasks.overruns == 1
+    assert abs(tasks.delay() - 0.1) < 1e-9
+
+
+def test_measure_bounds_the_time_made_up_for(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler, 'perf_counter', clock)
+    tasks = TickScheduler(10.0, max_catchup=5)
+    assert tasks.measure() == tasks.period
+    clock.now += 0.35
+    assert abs(tasks.measure() - 0.35) < 1e-9
+    clock.now += 2.0
+    assert abs(tasks.measure() - 0.5) < 1e-9
+
+
+def test_delay_drops_frames_too_far_behind(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler, 'perf_counter', clock)
+    tasks = TickScheduler(10.0, max_catchup=5)
+    tasks.delay()
+    clock.now += 2.0
+    assert tasks.delay() == 0.0
+    assert tasks.overruns == 18
+    assert abs(tasks.delay() - 0.1) < 1e-9
+
+
+def test_tick_runs_tasks_by_priority_and_divisor():
+    tasks = TickScheduler(10.0)
+    ran = []
+    tasks.add_task(lambda dt: ran.append(('late', dt)), priority=10)
+    tasks.add_task(lambda dt: ran.append(('every other', dt)), divisor=2)
+    tasks.add_task(lambda dt: ran.append(('early', dt)), priority=-10)
+    tasks.tick(0.1)
+    tasks.tick(0.1)
+    tasks.tick(0.1)
+    assert [name for name, _ in ran] == ['early', 'every other', 'late', 'early', 'late',
+                                         'early', 'every other', 'late']
+    assert abs(ran[-2][1] - 0.2) < 1e-9  # The time since it last ran
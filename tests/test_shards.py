@@ -0,0 +1,46 @@
+from shards import ShardContext
+import multiprocessing
+import queue
+import shards
+
+
+def shard_contexts(count, monkeypatch):
+    # `count` shards in this process, sharing their loads like a ShardSupervisor's would
+    loads = multiprocessing.Array('i', count)
+    pending = multiprocessing.Array('i', count, lock=loads.get_lock())
+    placements = [queue.Queue() for _ in range(count)]
+    spawned = []
+    monkeypatch.setattr(shards, 'engine', spawned)  # Only its length counts
+    contexts = [ShardContext(shard_id, loads, placements, pending=pending) for shard_id in range(count)]
+    for context in contexts:
+        context.spawn_avatar = spawned.append
+    return contexts, loads, pending
+
+
+def test_avatars_go_to_the_least_loaded_shard(monkeypatch):
+    (primary, other), loads, pending = shard_contexts(2, monkeypatch)
+    loads[0] = 3
+    primary.place_avatar(100100)
+    assert list(pending) == [0, 1]
+    assert other.placements[1].get_nowait() == 100100
+
+
+def test_placements_count_until_spawned(monkeypatch):
+    (primary, other), loads, pending = shard_contexts(2, monkeypatch)
+    # A burst of logins alternates between the shards, even before the other one spawned any
+    for client_id in range(100100, 100104):
+        primary.place_avatar(client_id)
+    assert list(loads) == [2, 0]  # The primary's spawned right away
+    assert list(pending) == [0, 2]
+    other.poll(0.1)
+    assert list(pending) == [0, 0]
+    assert list(loads) == [2, 4]  # Both shards share one engine here
+
+
+def test_unsharded_context_spawns_locally():
+    context = ShardContext()
+    spawned = []
+    context.spawn_avatar = spawned.append
+    context.place_avatar(100100)
+    assert spawned == [100100]
+    assert context.least_loaded() == 0
@@ -0,0 +1,67 @@
+from smoothing import PositionSmoother, lerp_heading
+import pytest
+
+
+class Model:
+    def __init__(self):
+        self.pos = None
+
+    def set_pos_hpr(self, x, y, z, h, p, r):
+        self.pos = (x, y, z, h)
+
+
+class Task:
+    cont = 'cont'
+
+
+@pytest.fixture
+def tracked():
+    smoother = PositionSmoother(render_delay=0.1, max_extrapolation=0.2)
+    model = Model()
+    smoother.track(1, model)
+    return smoother, model
+
+
+def x_at(smoother, model, now):
+    assert smoother.update(Task, now=now) == Task.cont
+    return model.pos[0]
+
+
+def test_first_sample_is_shown_right_away(tracked):
+    smoother, model = tracked
+    smoother.add_sample(1, 1.0, 2.0, 0.0, 90.0, now=10.0)
+    assert model.pos == (1.0, 2.0, 0.0, 90.0)
+
+
+def test_draws_between_samples_a_render_delay_ago(tracked):
+    smoother, model = tracked
+    smoother.add_sample(1, 0.0, 0.0, 0.0, 0.0, now=10.0)
+    smoother.add_sample(1, 1.0, 0.0, 0.0, 0.0, now=10.1)
+    smoother.add_sample(1, 2.0, 0.0, 0.0, 0.0, now=10.2)
+    assert x_at(smoother, model, 10.1) == pytest.approx(0.0)
+    assert x_at(smoother, model, 10.15) == pytest.approx(0.5)
+    assert x_at(smoother, model, 10.25) == pytest.approx(1.5)
+    assert len(smoother.tracks[1].samples) == 2  # The first is no longer needed
+
+
+def test_extrapolates_for_a_while_then_eases_back(tracked):
+    smoother, model = tracked
+    smoother.add_sample(1, 0.0, 0.0, 0.0, 0.0, now=10.0)
+    smoother.add_sample(1, 1.0, 0.0, 0.0, 0.0, now=10.1)
+    assert x_at(smoother, model, 10.3) == pytest.approx(2.0)  # 0.1 s past the newest sample
+    assert x_at(smoother, model, 10.4) == pytest.approx(3.0)  # As far as it goes
+    assert x_at(smoother, model, 10.5) == pytest.approx(2.0)
+    assert x_at(smoother, model, 10.7) == pytest.approx(1.0)  # Back where it was last seen
+
+
+def test_starts_moving_again_from_when_the_next_sample_arrives(tracked):
+    smoother, model = tracked
+    smoother.add_sample(1, 0.0, 0.0, 0.0, 0.0, now=10.0)
+    smoother.add_sample(1, 1.0, 0.0, 0.0, 0.0, now=20.0)
+    assert x_at(smoother, model, 20.0) == pytest.approx(0.0)
+    assert x_at(smoother, model, 20.05) == pytest.approx(0.5)
+
+
+def test_headings_turn_the_shorter_way():
+    assert lerp_heading(350.0, 10.0, 0.5) == pytest.approx(360.0)
+    assert lerp_heading(10.0, 350.0, 0.5) == pytest.approx(0.0)
@@ -1,7 +1,11 @@
+from assets import models
 from astron.object_repository import DistributedObject
 from globals import *
-import numpy as np
-import random
+from movement import unpack_move, dequantize, apply_delta, decode_batch
+from prediction import Predictor
+from smoothing import smoother
+import importlib.util
+import sys
 
 """
 Note: Your IDE may highlight errors on this file due to sections
@@ -9,9 +13,6 @@ that use the Panda3D module. You can ignore these errors as these
 sections only run on the Panda clients, and will not run in services.
 """
 
-avatar_speed = 3.0
-avatar_rotation_speed = 90.0
-pos_float_accuracy = 3
 __PANDA_RUNNING__ = False
 
 try:  # If base built-in is defined (running on client), import Panda classes
@@ -22,6 +23,48 @@ except NameError:
     pass  # we're a panda-less service
 
 
+def lazy_import(name):
+    """
+    Returns module `name`, which is only actually loaded once one of its attributes is
+    used. The modules only the AI and UD views need (and with them NumPy, asyncio and
+    multiprocessing) are imported like this, so clients don't spend their startup
+    loading them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+auth = lazy_import('auth')
+avatar_engine = lazy_import('avatar_engine')
+broadcast = lazy_import('broadcast')
+checkpoint = lazy_import('checkpoint')
+interest = lazy_import('interest')
+runtime = lazy_import('runtime')
+shards = lazy_import('shards')
+
+# Listeners of client events on panda-less clients (e.g. bots.py), by event name
+HEADLESS_LISTENERS = {}
+# Client views of avatars, by repository and doId, that batched moves are applied to
+MOVING_AVATARS = {}
+# Repositories and doIds of the avatars owned there; their owner views draw them, with prediction
+OWNED_AVATARS = set()
+
+
+def send_client_event(event, args):
+    if __PANDA_RUNNING__:
+        base.messenger.send(event, args)
+    else:
+        for listener in HEADLESS_LISTENERS.get(event, ()):
+            listener(*args)
+
+
 # -------------------------------------------------------
 # Root
 # * Is a container for top-level objects,
@@ -101,8 +144,22 @@ class LoginManagerAE(DistributedObject):
     def login(self, client_channel, username, password):
         print("LoginManagerAE.login(" + username + ", <PASSWORD>) for %d in (%d, %d) for client %s" %
               (self.do_id, self.parent, self.zone, str(client_channel)))
-
-        if (username == "guest") and (password == "guest"):
+        # Credentials are checked off the server frame; the result is handled back on it.
+        runtime.runtime.spawn(self.authenticate(client_channel, username, password))
+
+    async def authenticate(self, client_channel, username, password):
+        # Note that if the client disconnects while its credentials are being verified,
+        # what follows still goes ahead: SET_STATE is dropped by its Client Agent, but the
+        # avatar is created anyway, and since ADD_SESSION_OBJECT is dropped as well,
+        # nothing deletes it again. Astron has no way of asking whether a client is
+        # still connected, so that window can only be kept short.
+        try:
+            valid = await auth.authenticator.verify(username, password)
+        except Exception:
+            # Don't leave the client waiting for an answer that never comes
+            self.send_CLIENTAGENT_EJECT(client_channel, 122, "Login failed")
+            raise
+        if valid:
             # Authenticate a client
             # "2" is the magic number for CLIENT_STATE_ESTABLISHED,
             # for which currently no mapping exists.
@@ -137,8 +194,8 @@ class LoginManagerAI(DistributedObject):
 
 # ----------------------------------------------------
 # DistributedWorld
-# * has all avatars in its zone 0
-# * generates new avatars
+# * has all avatars in the zones of its interest grid
+# * generates new avatars on the least loaded shard
 # ----------------------------------------------------
 
 
@@ -162,21 +219,28 @@ class DistributedWorldAI(DistributedObject):
     def create_avatar(self, client_id):
         print("DistributedWorldAI.create_avatar(" + str(client_id) + ") for %d in (%d, %d)" %
               (self.do_id, self.parent, self.zone))
-        # Create the avatar
-        avatar_doid = random.randint(1500000, 1599999)  # FIXME: Generate actual random channel for new do_id
-        self.repo.create_distobj('DistributedAvatar', avatar_doid, self.do_id, 0)
-        # Set the client to be interested in our zone 0. He can't do
-        # that himself (or rather: shouldn't be allowed to) as he has
-        # no visibility of this object.
+        shards.context.place_avatar(client_id)
+
+    @staticmethod
+    def spawn_avatar(repo, client_id):
+        # Create the avatar, with the shard running this as its AI
+        avatar_doid = shards.context.doids.allocate()
+        # Avatars spawn at the origin, in the zone of the grid cell there.
+        cell = interest.grid.cell_at(0.0, 0.0)
+        repo.create_distobj('DistributedAvatar', avatar_doid, DistributedWorldId, cell, set_ai=True)
+        avatar_engine.engine.set_owner(avatar_doid, client_id)
+        # Set the client to be interested in the zones around its avatar.
+        # He can't do that himself (or rather: shouldn't be allowed to) as
+        # he has no visibility of this object.
         # We're always using the interest_id 0 because different
         # clients use different ID spaces, so why make things more
         # complicated?
-        self.repo.send_CLIENTAGENT_ADD_INTEREST(client_id, 0, DistributedWorldId, 0)
+        interest.grid.enter(repo, avatar_doid, client_id, cell)
         # Set its owner to the client, upon which in the Clients repo
         # magically OV (OwnerView) is generated.
-        self.repo.send_STATESERVER_OBJECT_SET_OWNER(avatar_doid, client_id)
+        repo.send_STATESERVER_OBJECT_SET_OWNER(avatar_doid, client_id)
         # Declare this to be a session object.
-        self.repo.send_CLIENTAGENT_ADD_SESSION_OBJECT(avatar_doid, client_id)
+        repo.send_CLIENTAGENT_ADD_SESSION_OBJECT(avatar_doid, client_id)
 
 
 # -------------------------------------------------------------------
@@ -186,56 +250,115 @@ class DistributedWorldAI(DistributedObject):
 # * updates the actual position and orientation
 # -------------------------------------------------------------------
 
-class DistributedAvatar(DistributedObject):
+class MovingAvatar:
+    """
+    Client side of movement.py, shared by the avatar views: decodes the avatar's moves
+    and shows them, on its own model or to headless listeners.
+    """
+    move = None  # Quantized (x, y, h) applied last; None until the first keyframe
+
+    def track_moves(self):
+        MOVING_AVATARS.setdefault((self.repo, self.do_id), []).append(self)
+
+    def forget_moves(self):
+        views = MOVING_AVATARS.get((self.repo, self.do_id), [])
+        if self in views:
+            views.remove(self)
+        if not views:
+            MOVING_AVATARS.pop((self.repo, self.do_id), None)
+
+    def set_move(self, packed):
+        self.move = unpack_move(packed)
+        self.show_move()
+
+    def set_move_delta(self, dx, dy, dh):
+        if self.move is None:
+            return  # Got into interest after the last keyframe; wait for the next one
+        self.move = apply_delta(self.move, dx, dy, dh)
+        self.show_move()
+
+    def show_move(self):
+        x, y, h = dequantize(*self.move)
+        if __PANDA_RUNNING__:
+            smoother.add_sample(self.do_id, x, y, 0.0, h)
+        elif "set_move" in HEADLESS_LISTENERS:
+            send_client_event("set_move", [self])
+
+
+class DistributedAvatar(MovingAvatar, DistributedObject):
     def init(self):
         print("DistributedAvatar.init() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
-        if __PANDA_RUNNING__:
-            self.model = base.loader.load_model("./resources/smiley.egg")
-            self.model.reparent_to(base.render)
-            # Signal local client that this is its avatar
-            base.messenger.send("distributed_avatar", [self])
+        self.track_moves()
+        self.model = None
+        if (self.repo, self.do_id) not in OWNED_AVATARS:
+            self.show_model()
+        # Signal local client that this is its avatar
+        send_client_event("distributed_avatar", [self])
 
     def delete(self):
         print("DistributedAvatar.delete() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
-        if __PANDA_RUNNING__:
-            self.model.remove_node()
+        self.forget_moves()
+        self.hide_model()
 
-    def set_xyzh(self, x, y, z, h):
-        divisor = float(pow(10, pos_float_accuracy))
-        float_x, float_y, float_z = float(x), float(y), float(z)
-        float_x, float_y, float_z = float_x / divisor, float_y / divisor, float_z / divisor,
-        if __PANDA_RUNNING__:
-            self.model.set_pos(float_x, float_y, float_z)
-            self.model.set_h(h)
+    def show_model(self):
+        if __PANDA_RUNNING__ and self.model is None:
+            self.model = models.acquire(AVATAR_MODEL, base.render)
+            smoother.track(self.do_id, self.model)
+            smoother.start(base.task_mgr)
 
+    def hide_model(self):
+        if self.model is not None:
+            smoother.forget(self.do_id)
+            models.release(AVATAR_MODEL, self.model)
+            self.model = None
 
-class DistributedAvatarOV(DistributedObject):
+
+class DistributedAvatarOV(MovingAvatar, DistributedObject):
     def init(self):
         print("DistributedAvatarOV.init() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
+        self.track_moves()
+        # The client moves its own avatar itself; see `predict()`. Its other view
+        # would draw it a second time, trailing behind.
+        self.predictor = Predictor()
+        OWNED_AVATARS.add((self.repo, self.do_id))
+        for view in MOVING_AVATARS.get((self.repo, self.do_id), ()):
+            if isinstance(view, DistributedAvatar):
+                view.hide_model()
         if __PANDA_RUNNING__:
-            self.model = base.loader.load_model("./resources/smiley.egg")
-            self.model.reparent_to(base.render)
+            self.model = models.acquire(AVATAR_MODEL, base.render)
             base.camera.reparent_to(self.model)
             base.camera.set_pos(0, 20, 10)
             base.camera.look_at(0, 0, 0)
-            # Signal to client that its received its avatar OV
-            base.messenger.send("avatar_ov", [self])
+        # Signal to client that its received its avatar OV
+        send_client_event("avatar_ov", [self])
 
     def delete(self):
         print("DistributedAvatarOV.delete() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
+        self.forget_moves()
+        OWNED_AVATARS.discard((self.repo, self.do_id))
+        for view in MOVING_AVATARS.get((self.repo, self.do_id), ()):
+            if isinstance(view, DistributedAvatar):
+                view.show_model()
         if __PANDA_RUNNING__:
-            self.model.remove_node()
-
-    def indicate_intent(self, heading, speed):
-        self.send_update("indicate_intent", heading, speed)
-
-    def set_xyzh(self, x, y, z, h):
+            # Take the camera off the model first, or it would be pooled along with it.
+            base.camera.wrt_reparent_to(base.render)
+            models.release(AVATAR_MODEL, self.model)
+
+    def indicate_intent(self, heading, speed, seq=0):
+        self.send_update("indicate_intent", seq, heading, speed)
+
+    def predict(self, heading, speed, dt):
+        # Called once per client frame with the current intent
+        seq = self.predictor.sample(heading, speed, dt)
+        if seq is not None:
+            self.indicate_intent(heading, speed, seq)
+        if __PANDA_RUNNING__ and self.predictor.state is not None:
+            x, y, h = self.predictor.state
+            self.model.set_pos_hpr(x, y, 0.0, h, 0.0, 0.0)
+
+    def ack_move(self, seq, elapsed, x, y, h):
         divisor = float(pow(10, pos_float_accuracy))
-        float_x, float_y, float_z = float(x), float(y), float(z)
-        float_x, float_y, float_z = float_x / divisor, float_y / divisor, float_z / divisor,
-        if __PANDA_RUNNING__:
-            self.model.set_pos(float_x, float_y, float_z)
-            self.model.set_h(h)
+        self.predictor.reconcile(seq, elapsed / 1000.0, x / divisor, y / divisor, h / 100.0)
 
 
 class DistributedAvatarAE(DistributedObject):
@@ -244,26 +367,28 @@ class DistributedAvatarAE(DistributedObject):
 
 
 class DistributedAvatarAI(DistributedObject):
+    """
+    Since we don't have a Panda `NodePath` object as a Panda3D independent service,
+    the x, y, z, and h of every avatar are kept in the process-wide `AvatarEngine`.
+    This view only holds its slot in the engine, and reads and writes through it.
+    """
     def init(self):
         print("DistributedAvatarAI.init() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
-        """
-        Since we don't have a Panda `NodePath` object as a Panda3D independent service,
-        we have to define our own x, y, z, and h variables to keep track of.
-        """
-        self.x, self.y, self.z, self.h = 0.0, 0.0, 0.0, 0.0
-        """
-        Heading and speed are kept in a range of -1 to 1. (-1 <= n <= 1)
-        This value is sent by the client, and is checked to be in range to prevent cheating.
-        """
-        self.turn, self.forward = 0, 0
-        # Append `update_position()` method to tasks (ran every 'server frame')
-        AI_TASKS.append(self.update_position)
+        self.engine = avatar_engine.engine
+        self.slot = self.engine.add(self)
+        # Back where it was, if it's taken over from a previous run of this shard
+        checkpoint.checkpoints.adopt(self)
+        # Where the owner's prediction starts from
+        self.engine.acknowledge(self.slot)
 
     def delete(self):
         print("DistributedAvatarAI.delete() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
-        AI_TASKS.remove(self.update_position)
+        self.engine.remove(self.slot)
+        interest.grid.leave(self.do_id)
+        # The doId is reused by the next avatar spawned on this shard
+        shards.context.doids.free(self.do_id)
 
-    def indicate_intent(self, client_channel, turn, forward):
+    def indicate_intent(self, client_channel, seq, turn, forward):
         if (turn < -1.0) or (turn > 1.0) or (forward < -1.0) or (forward > 1.0):
             """
             The client is cheating! It has sent a heading or speed that is not in its programmed range.
@@ -271,52 +396,61 @@ class DistributedAvatarAI(DistributedObject):
             """
             self.send_CLIENTAGENT_EJECT(client_channel, 152, "Argument values out of range.")
             return
-        self.turn, self.forward = turn, forward
-
-    def update_position(self):
-        if (self.turn != 0.0) or (self.forward != 0.0):
-            # Get delta time (an estimate)
-            dt = 1.0 / float(AI_FRAME_RATE)
-
-            # Calculate new avatar heading
-            degrees = 360.0
-            if self.turn < 0:
-                degrees *= -1.0
-            h_added = (self.turn * avatar_rotation_speed * dt) % degrees
-            if (self.h + h_added) >= 360.0:
-                self.h = (self.h + h_added) - 360.0
-            elif (self.h + h_added) < 0.0:
-                self.h = (self.h + h_added) + 360.0
-            else:
-                self.h += h_added
-
-            # Apply Z-axis Euler angle 4x4 matrix rotation to our avatar's matrix
-            h_rads = np.radians(self.h)
-            rotation_matrix = np.array([[np.cos(h_rads), -1 * np.sin(h_rads), 0.0, 0.0],
-                                        [np.sin(h_rads), np.cos(h_rads), 0.0, 0.0],
-                                        [0.0, 0.0, 1.0, 0.0],
-                                        [0.0, 0.0, 0.0, 1.0]])
-
-            local_vec = np.array([0.0, -1.0 * avatar_speed * self.forward * dt, 0.0, 1.0])
-            global_vec = np.matmul(rotation_matrix, local_vec)
-
-            self.x += np.round(global_vec[0], pos_float_accuracy)
-            self.y += np.round(global_vec[1], pos_float_accuracy)
-            self.z += np.round(global_vec[2], pos_float_accuracy)
-
-            # limit x coord to (-10 < x < 10)
-            if self.x < -10.0:
-                self.x = -10.0
-            if self.x > 10.0:
-                self.x = 10.0
-            # limit y coord to (-10 < y < 10)
-            if self.y < -10.0:
-                self.y = -10.0
-            if self.y > 10.0:
-                self.y = 10.0
-
-            # Convert positions to integers to send over the network in a smaller data type
-            factor = pow(10, pos_float_accuracy)
-            int_x, int_y, int_z = int(self.x * factor), int(self.y * factor), int(self.z * factor)
-            # Send positions over the network
-            self.send_update('set_xyzh', int_x, int_y, int_z, int(self.h))
+        """
+        Heading and speed are kept in a range of -1 to 1. (-1 <= n <= 1)
+        Avatars with a nonzero intent are advanced by the engine every 'server frame'.
+        """
+        self.engine.set_intent(self.slot, turn, forward, seq)
+        self.engine.acknowledge(self.slot)
+
+    @property
+    def x(self):
+        return float(self.engine.x[self.slot])
+
+    @property
+    def y(self):
+        return float(self.engine.y[self.slot])
+
+    @property
+    def z(self):
+        return float(self.engine.z[self.slot])
+
+    @property
+    def h(self):
+        return float(self.engine.h[self.slot])
+
+    @property
+    def turn(self):
+        return float(self.engine.turn[self.slot])
+
+    @property
+    def forward(self):
+        return float(self.engine.forward[self.slot])
+
+
+# -------------------------------------------------------------------
+# DistributedMoveBatch
+# * one per AI shard in every zone of the world
+# * carries the moves of that shard's avatars in the zone
+# -------------------------------------------------------------------
+
+class DistributedMoveBatch(DistributedObject):
+    def init(self):
+        print("DistributedMoveBatch.init() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
+
+    def set_moves(self, blob):
+        keyframes, deltas = decode_batch(blob)
+        for do_id, packed in keyframes:
+            for view in MOVING_AVATARS.get((self.repo, do_id), ()):
+                view.set_move(packed)
+        for do_id, dx, dy, dh in deltas:
+            for view in MOVING_AVATARS.get((self.repo, do_id), ()):
+                view.set_move_delta(dx, dy, dh)
+
+
+class DistributedMoveBatchAI(DistributedObject):
+    def init(self):
+        print("DistributedMoveBatchAI.init() for %d in (%d, %d)" % (self.do_id, self.parent, self.zone))
+        # Moves of this shard's avatars in this zone are sent through here from now on
+        broadcast.moves.batches[self.zone] = self
+        checkpoint.checkpoints.adopt_batch(self)
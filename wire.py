@@ -0,0 +1,257 @@
+import struct
+
+"""
+Astron wire format: message types, and reading and writing of raw datagrams.
+
+On both the Message Director and the Client Agent connection, every datagram is
+prefixed with its uint16 length, and all integers are little endian. Internal (MD)
+datagrams start with a uint8 recipient count and that many uint64 channels; unless
+the only recipient is CONTROL_CHANNEL, a uint64 sender follows. Then comes the
+uint16 message type. Client datagrams start directly with the message type.
+"""
+
+CONTROL_CHANNEL = 1
+
+# Control messages
+CONTROL_ADD_CHANNEL = 9000
+CONTROL_REMOVE_CHANNEL = 9001
+CONTROL_ADD_RANGE = 9002
+CONTROL_REMOVE_RANGE = 9003
+CONTROL_ADD_POST_REMOVE = 9010
+CONTROL_CLEAR_POST_REMOVES = 9011
+CONTROL_SET_CON_NAME = 9012
+CONTROL_SET_CON_URL = 9013
+CONTROL_LOG_MESSAGE = 9014
+
+# Client messages
+CLIENT_HELLO = 1
+CLIENT_HELLO_RESP = 2
+CLIENT_DISCONNECT = 3
+CLIENT_EJECT = 4
+CLIENT_HEARTBEAT = 5
+CLIENT_OBJECT_SET_FIELD = 120
+CLIENT_OBJECT_SET_FIELDS = 121
+CLIENT_OBJECT_LEAVING = 132
+CLIENT_OBJECT_LEAVING_OWNER = 161
+CLIENT_ENTER_OBJECT_REQUIRED = 142
+CLIENT_ENTER_OBJECT_REQUIRED_OTHER = 143
+CLIENT_ENTER_OBJECT_REQUIRED_OWNER = 172
+CLIENT_ENTER_OBJECT_REQUIRED_OTHER_OWNER = 173
+CLIENT_OBJECT_LOCATION = 140
+CLIENT_ADD_INTEREST = 200
+CLIENT_ADD_INTEREST_MULTIPLE = 201
+CLIENT_REMOVE_INTEREST = 203
+CLIENT_DONE_INTEREST_RESP = 204
+
+# Client Agent messages
+CLIENTAGENT_SET_STATE = 1000
+CLIENTAGENT_SET_CLIENT_ID = 1001
+CLIENTAGENT_SEND_DATAGRAM = 1002
+CLIENTAGENT_EJECT = 1004
+CLIENTAGENT_DROP = 1005
+CLIENTAGENT_ADD_SESSION_OBJECT = 1012
+CLIENTAGENT_REMOVE_SESSION_OBJECT = 1013
+CLIENTAGENT_OPEN_CHANNEL = 1100
+CLIENTAGENT_CLOSE_CHANNEL = 1101
+CLIENTAGENT_ADD_INTEREST = 1200
+CLIENTAGENT_ADD_INTEREST_MULTIPLE = 1201
+CLIENTAGENT_REMOVE_INTEREST = 1203
+
+# State Server messages
+STATESERVER_CREATE_OBJECT_WITH_REQUIRED = 2000
+STATESERVER_CREATE_OBJECT_WITH_REQUIRED_OTHER = 2001
+STATESERVER_DELETE_AI_OBJECTS = 2009
+STATESERVER_OBJECT_DELETE_RAM = 2007
+STATESERVER_OBJECT_SET_FIELD = 2020
+STATESERVER_OBJECT_SET_FIELDS = 2021
+STATESERVER_OBJECT_SET_LOCATION = 2040
+STATESERVER_OBJECT_CHANGING_LOCATION = 2041
+STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED = 2042
+STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER = 2043
+STATESERVER_OBJECT_SET_AI = 2050
+STATESERVER_OBJECT_CHANGING_AI = 2051
+STATESERVER_OBJECT_ENTER_AI_WITH_REQUIRED = 2052
+STATESERVER_OBJECT_ENTER_AI_WITH_REQUIRED_OTHER = 2053
+STATESERVER_OBJECT_ENTER_INTEREST_WITH_REQUIRED = 2066
+STATESERVER_OBJECT_ENTER_INTEREST_WITH_REQUIRED_OTHER = 2067
+STATESERVER_OBJECT_SET_OWNER = 2070
+STATESERVER_OBJECT_CHANGING_OWNER = 2071
+STATESERVER_OBJECT_ENTER_OWNER_WITH_REQUIRED = 2072
+STATESERVER_OBJECT_ENTER_OWNER_WITH_REQUIRED_OTHER = 2073
+STATESERVER_OBJECT_GET_ZONES_OBJECTS = 2102
+STATESERVER_OBJECT_GET_ZONES_COUNT_RESP = 2113
+
+# Message types whose body starts with the uint32 doId and uint16 number of the field set
+FIELD_UPDATES = (CLIENT_OBJECT_SET_FIELD, STATESERVER_OBJECT_SET_FIELD)
+
+
+def location_channel(parent, zone):
+    return (parent << 32) | zone
+
+
+class DatagramReader:
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def read(self, fmt):
+        value, = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def uint8(self):
+        return self.read('<B')
+
+    def uint16(self):
+        return self.read('<H')
+
+    def uint32(self):
+        return self.read('<I')
+
+    def uint64(self):
+        return self.read('<Q')
+
+    def blob(self):
+        length = self.uint16()
+        self.offset += length
+        return self.data[self.offset - length:self.offset]
+
+    def string(self):
+        return self.blob().decode('utf-8')
+
+    def remainder(self):
+        return self.data[self.offset:]
+
+
+class DatagramWriter:
+    def __init__(self):
+        self.parts = []
+
+    def add(self, fmt, *values):
+        self.parts.append(struct.pack(fmt, *values))
+        return self
+
+    def uint8(self, value):
+        return self.add('<B', value)
+
+    def uint16(self, value):
+        return self.add('<H', value)
+
+    def uint32(self, value):
+        return self.add('<I', value)
+
+    def uint64(self, value):
+        return self.add('<Q', value)
+
+    def blob(self, value):
+        self.parts.append(struct.pack('<H', len(value)) + value)
+        return self
+
+    def string(self, value):
+        return self.blob(value.encode('utf-8'))
+
+    def raw(self, value):
+        self.parts.append(value)
+        return self
+
+    def data(self):
+        return b''.join(self.parts)
+
+
+def internal_datagram(recipients, sender, msgtype):
+    writer = DatagramWriter().uint8(len(recipients))
+    for channel in recipients:
+        writer.uint64(channel)
+    return writer.uint64(sender).uint16(msgtype)
+
+
+def client_datagram(msgtype):
+    return DatagramWriter().uint16(msgtype)
+
+
+def frame(datagram):
+    return struct.pack('<H', len(datagram)) + datagram
+
+
+def split_frames(buffer):
+    """
+    Splits complete length-prefixed datagrams off the front of `buffer`, and returns
+    them along with whatever incomplete rest remains.
+    """
+    datagrams, offset = [], 0
+    while len(buffer) - offset >= 2:
+        length, = struct.unpack_from('<H', buffer, offset)
+        if len(buffer) - offset - 2 < length:
+            break
+        datagrams.append(bytes(buffer[offset + 2:offset + 2 + length]))
+        offset += 2 + length
+    return datagrams, buffer[offset:]
+
+
+class DatagramStream:
+    """
+    Reassembles datagrams from a byte stream that may split them anywhere.
+    """
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        datagrams, self.buffer = split_frames(self.buffer + data if self.buffer else data)
+        return datagrams
+
+
+class StandInSocket:
+    """
+    Stands in for a repository's socket. Reads come from the socket it wraps, or for a
+    `fed` stand-in, from the data fed into `pending`; writes go to the socket it wraps,
+    or are swallowed if there is none. Everything else is passed on to the wrapped
+    socket. Subclasses see the data going through in `received()` and `sent()`.
+    """
+    fed = False
+
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.pending = bytearray()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def recv(self, size, *args):
+        if not self.fed:
+            data = self.sock.recv(size, *args)
+        elif self.pending:
+            data = bytes(self.pending[:size])
+            del self.pending[:size]
+        else:
+            raise BlockingIOError()
+        self.received(data)
+        return data
+
+    def send(self, data, *args):
+        sent = self.sock.send(data, *args) if self.sock is not None else len(data)
+        self.sent(data if sent == len(data) else data[:sent])
+        return sent
+
+    def sendall(self, data, *args):
+        if self.sock is not None:
+            self.sock.sendall(data, *args)
+        self.sent(data)
+
+    def received(self, data):
+        pass
+
+    def sent(self, data):
+        pass
+
+
+def read_internal_header(data):
+    """
+    Returns the recipients, sender (None for control messages) and message type of an
+    internal datagram, and a reader positioned at its body.
+    """
+    reader = DatagramReader(data)
+    recipients = [reader.uint64() for _ in range(reader.uint8())]
+    sender = None
+    if recipients != [CONTROL_CHANNEL]:
+        sender = reader.uint64()
+    return recipients, sender, reader.uint16(), reader